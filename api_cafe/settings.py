@@ -20,13 +20,17 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'cafe.middleware.InstrumentationMiddleware',
+    'cafe.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
+    'cafe.middleware.ImageUploadMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'cafe.middleware.ETagMiddleware',
 ]
 
 ROOT_URLCONF = 'api_cafe.urls'
@@ -51,11 +55,30 @@ WSGI_APPLICATION = 'api_cafe.wsgi.application'
 
 DATABASES = {
     "default": {
-        "ENGINE": "django.db.backends.mysql",
+        "ENGINE": "cafe.db.backends.mysql",
         "NAME": "c107330_api_cafe_na4u_ru",
         "USER": "c107330_api_cafe_na4u_ru",
         "PASSWORD": "XeRyeHisfopuv54",
         "HOST": "localhost",
+        # Пул соединений cafe.db.pool: соединение возвращается в пул в конце
+        # запроса, поэтому CONN_MAX_AGE должен оставаться 0. Без ключа POOL
+        # бэкенд ведёт себя как стандартный django.db.backends.mysql
+        "POOL": {
+            "MAX_SIZE": 20,
+            "MAX_IDLE": 10,
+            "MAX_AGE": 600,
+            "PRE_PING": True,
+            "TIMEOUT": 30,
+        },
+    }
+}
+
+# Кэш Django в таблице базы: общий для всех воркеров, в нём хранятся ответы
+# Idempotency-Key. Таблица создаётся командой manage.py createcachetable
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
+        'LOCATION': 'cafe_cache',
     }
 }
 
@@ -83,3 +106,121 @@ STATIC_URL = 'static/'
 STATICFILES_DIRS = [os.path.join(BASE_DIR, 'static')]
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
+
+# Кэш проверенных учётных данных для BasicAuth (TTL в секундах)
+CAFE_AUTH_CACHE = {
+    'ENABLED': False,
+    'MAX_SIZE': 1024,
+    'TTL': 300,
+}
+
+# Индекс прав пользователей для check_permission: права в памяти процесса, поколение
+# прав - в таблице CacheVersion, общей для воркеров; TTL - предельный срок записи
+CAFE_PERMISSION_INDEX = {
+    'MAX_SIZE': 4096,
+    'TTL': 600,
+}
+
+# Keyset-пагинация списков заказов, оплат, бронирований и столиков
+CAFE_PAGINATION = {
+    'PAGE_SIZE': 50,
+    'MAX_PAGE_SIZE': 500,
+}
+
+# Кэш ответов публичных эндпоинтов меню. Версии разделов хранятся в таблице
+# CacheVersion, общей для всех воркеров, поэтому сами ответы можно держать
+# в памяти процесса ('locmem') или в кэше из CACHES с алиасом ALIAS ('django')
+CAFE_CACHE = {
+    'BACKEND': 'locmem',
+    'ALIAS': 'default',
+    'MAX_SIZE': 512,
+    'TTL': 3600,
+}
+
+# Уменьшенные копии изображений меню: разрешённые ширины и дисковый кэш с LRU-вытеснением
+CAFE_IMAGE_VARIANTS = {
+    'DIR': BASE_DIR / 'cache' / 'variants',
+    'MAX_BYTES': 256 * 1024 * 1024,
+    'WIDTHS': [160, 320, 640, 1280],
+    'QUALITY': 80,
+}
+
+# Ограничения потоковой загрузки изображений меню: запрос с телом больше
+# MAX_BYTES + MAX_FORM_BYTES (остальные поля формы) отклоняется по Content-Length
+CAFE_UPLOADS = {
+    'MAX_BYTES': 5 * 1024 * 1024,
+    'MAX_PIXELS': 24_000_000,
+    'MAX_DIMENSION': 8000,
+    'CHUNK_SIZE': 64 * 1024,
+    'FORMATS': ('JPEG', 'PNG', 'WEBP'),
+    'MAX_FORM_BYTES': 64 * 1024,
+}
+
+# События для экранов кухни и зала: история для long-polling и Last-Event-ID,
+# буфер на подписчика SSE, интервал keepalive и таймаут long-polling в секундах
+CAFE_EVENTS = {
+    'HISTORY': 1000,
+    'BUFFER': 256,
+    'KEEPALIVE': 15,
+    'LONG_POLL_TIMEOUT': 25,
+}
+
+# Потоковая выгрузка заказов и оплат: сколько заказов читать одним запросом
+CAFE_EXPORT = {
+    'BATCH_SIZE': 2000,
+}
+
+# Замеры запросов API: заголовок Server-Timing (SQL, сериализация, всего; раскрывает
+# устройство сервиса, поэтому только при DEBUG) и запись в лог cafe.instrumentation
+# о запросах дольше SLOW_REQUEST_MS или с числом SQL от SLOW_QUERY_COUNT,
+# с SLOWEST самыми медленными запросами
+CAFE_INSTRUMENTATION = {
+    'ENABLED': True,
+    'SERVER_TIMING': DEBUG,
+    'SLOW_REQUEST_MS': 500,
+    'SLOW_QUERY_COUNT': 50,
+    'SLOWEST': 5,
+}
+
+# Метрики Prometheus на /api/metrics: корзины гистограммы длительности в секундах,
+# токен Bearer для сборщика (None - доступ только при DEBUG) и каталог для суммирования
+# метрик воркеров gunicorn (None - метрики только текущего процесса)
+CAFE_METRICS = {
+    'ENABLED': True,
+    'BUCKETS': [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10],
+    'TOKEN': None,
+    'MULTIPROCESS_DIR': None,
+    'FLUSH_INTERVAL': 5,
+}
+
+# Заголовок Idempotency-Key на создании заказов, позиций и чеков: ответы хранятся
+# TTL секунд в кэше ALIAS из CACHES ('django', общий для воркеров) или в памяти
+# процесса ('locmem' - только для одного воркера: повтор, попавший в другой
+# воркер, выполнится ещё раз), дубликат ждёт выполняющийся запрос до WAIT_TIMEOUT секунд
+CAFE_IDEMPOTENCY = {
+    'BACKEND': 'django',
+    'ALIAS': 'default',
+    'MAX_SIZE': 10000,
+    'TTL': 24 * 60 * 60,
+    'LOCK_TTL': 60,
+    'WAIT_TIMEOUT': 10,
+}
+
+# Ограничение частоты запросов (token bucket) на пользователя, без авторизации - на IP:
+# RATE - скорость пополнения корзины, BURST - её ёмкость. ROUTES задаёт отдельные
+# бюджеты по шаблону маршрута, остальные маршруты делят бюджет DEFAULT. LOGIN - бюджет
+# неудачных входов с одного IP, проверяется до проверки пароля.
+# BACKEND 'locmem' - корзины в памяти процесса, 'django' - в кэше ALIAS, общем для воркеров
+# (async-роутер /api/async обращается к такому кэшу через sync_to_async, вне цикла событий)
+CAFE_THROTTLE = {
+    'ENABLED': True,
+    'BACKEND': 'locmem',
+    'ALIAS': 'default',
+    'MAX_KEYS': 100000,
+    'DEFAULT': { 'RATE': '20/s', 'BURST': 40 },
+    'ROUTES': {
+        'api/menu': { 'RATE': '5/s', 'BURST': 20 },
+        'api/basic': { 'RATE': '30/m', 'BURST': 10 },
+    },
+    'LOGIN': { 'RATE': '10/m', 'BURST': 5 },
+}
@@ -42,7 +42,12 @@ class PaymentAdmin(admin.StackedInline):
 
 class OrderAdmin(admin.ModelAdmin):
     list_display = ['table', 'reservation', 'totalAmount', 'status', 'created_at',]
+    readonly_fields = ['totalAmount']
     inlines = [OrderItemAdmin, PaymentAdmin]
+
+    def save_related(self, request, form, formsets, change):
+        super().save_related(request, form, formsets, change)
+        form.instance.recalculate_total()
 admin.site.register(Order, OrderAdmin)
 
 
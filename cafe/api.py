@@ -1,29 +1,68 @@
 from ninja import NinjaAPI, Query, UploadedFile, File
-from ninja.security import HttpBasicAuth
-from ninja.errors import HttpError, AuthenticationError
+from ninja.pagination import paginate
+from ninja.security import HttpBasicAuth, HttpBearer
+from ninja.errors import HttpError, AuthenticationError, Throttled
 
+import hmac
+import math
 from typing import List
+from datetime import date, datetime
 
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
 from django.shortcuts import get_object_or_404
-from django.contrib.auth import authenticate
 
 from .models import Category, Menu, Table, Reservation, Order, OrderItem, \
     OrderStatus, TableStatus, Payment
 from .schemas import CategoryIn, CategoryOut, MenuIn, MenuOut, TableIn, \
     TableOut, ReservationIn, ReservationOut, OrderIn, OrderOut, \
-    OrderItemIn, OrderItemOut, PaymentIn, PaymentOut
+    OrderItemIn, OrderItemOut, OrderItemsIn, PaymentIn, PaymentOut, EventsOut, \
+    DailyRevenueOut, DishSalesOut, TableSalesOut, MenuImportReport
 from .decorators import *
+from .auth import credential_cache
+from .metrics import auth_failed, metrics_config, collect as collect_metrics, render as render_metrics
+from .planner import planned, apply_plan
+from .pagination import CursorPagination
+from .cache import cache_response, conditional, get_version, skip_cache
+from .search import NAMESPACE as SEARCH_NAMESPACE, search_index
+from .images import FORMATS, allowed_widths, variant_cache
+from .uploads import ImageRejected, store_image
+from .orders import add_item, add_items, change_quantity
+from .reservations import ReservationConflict, available_tables, reserve
+from .events import event_broker, parse_types, poll
+from .reports import pay, daily_revenue, top_dishes, table_turnover
+from .imports import ImportFormatError, import_menu, parse_rows
+from .instrumentation import TimedJSONRenderer
+from .idempotency import idempotent
+from .throttling import api_throttle, request_throttle
+from .exports import ORDER_COLUMNS, PAYMENT_COLUMNS, FORMATS as EXPORT_FORMATS, export_response, order_rows, payment_rows
+from .api_async import router as async_router
 
 
 class BasicAuth(HttpBasicAuth):
+    def __call__(self, request):
+        request_throttle.check_login(request)
+        if not request.headers.get(self.header):
+            auth_failed('missing')
+        return super().__call__(request)
+
     def authenticate(self, request, username, password):
-        user = authenticate(username = username, password = password)
+        user = credential_cache.authenticate(username, password)
         if user:
             return user
-        raise AuthenticationError('Ошибка авторизации!')
+        auth_failed('invalid')
+        request_throttle.login_failed(request)
+        raise AuthenticationError(message = 'Ошибка авторизации!')
+
+
+api = NinjaAPI(csrf = True, auth = BasicAuth(), renderer = TimedJSONRenderer(), throttle = api_throttle())
 
 
-api = NinjaAPI(csrf = True, auth = BasicAuth())
+@api.exception_handler(Throttled)
+def throttled(request, exc):
+    response = api.create_response(request, { 'detail': 'Слишком много запросов, повторите позже!' }, status = 429)
+    response['Retry-After'] = str(max(1, math.ceil(exc.wait or 1)))
+    return response
 
 
 ''' API для авторизации '''
@@ -38,6 +77,9 @@ def basic(request):
 
 
 @api.get('/menu', response = List[CategoryOut], summary = 'Получить список категорий меню')
+@conditional('menu')
+@cache_response('menu', List[CategoryOut])
+@planned(CategoryOut)
 def get_categories(request):
     return Category.objects.all()
 
@@ -66,25 +108,77 @@ def delete_category(request, category_id: int):
 ''' API для позиций меню '''
 
 
+def _search_results(request, search: str, category_id: int = None, limit: int = 20):
+    version = get_version(SEARCH_NAMESPACE)
+    menu_ids = search_index.search(search, category_id = category_id, limit = limit, version = version)
+    if search_index.version != version:
+        # индекс воркера отстаёт от базы и перестраивается в фоне: такой ответ не кэшируется
+        skip_cache(request)
+    menu = apply_plan(Menu.objects.all(), MenuOut).in_bulk(menu_ids)
+    return [menu[menu_id] for menu_id in menu_ids if menu_id in menu]
+
+
+@api.get('/menu/search', response = List[MenuOut], summary = 'Поиск позиций меню по всем категориям')
+@cache_response('menu', List[MenuOut])
+def search_all_menu(request, search: str = Query(..., description = 'Поиск'), limit: int = Query(20, ge = 1, le = 100)):
+    return _search_results(request, search, limit = limit)
+
+
+@api.post('/menu/import', response = { 200: MenuImportReport, 400: MenuImportReport }, summary = 'Импорт позиций меню и прайс-листа из CSV или JSON')
+@check_permission(('cafe.add_menu', 'cafe.change_menu', 'cafe.add_category', 'cafe.change_category'), raise_exception = True, use_auth = True)
+def import_menu_file(request, file: UploadedFile = File(...), dry_run: bool = Query(False, description = 'Только проверить файл')):
+    format = file.name.rsplit('.', 1)[-1].lower() if '.' in file.name else ''
+    try:
+        report = import_menu(parse_rows(file.read(), format), dry_run = dry_run)
+    except ImportFormatError as error:
+        raise HttpError(400, str(error))
+    return (400 if report['errors'] else 200), report
+
+
 @api.get('/menu/{category_id}', response = List[MenuOut], summary = 'Получить позиции меню по категории')
+@conditional('menu')
+@cache_response('menu', List[MenuOut])
+@planned(MenuOut)
 def get_menu(request, category_id: int):
     category = get_object_or_404(Category, id = category_id)
     menu = Menu.objects.filter(category = category)
     return menu
 
 
-@api.get('/menu/{category_id}/sort', response = List[MenuOut], summary = 'Сортировка позиций меню по цене')
-def menu_sort(request, category_id: int, sort: str = Query(None, description = 'Введите asc или desc')):
-    category = get_object_or_404(Category, id = category_id)
-    menu = Menu.objects.filter(category = category)
-
-    if sort == 'asc':
-        menu = menu.order_by('price')
-    elif sort == 'desc':
-        menu = menu.order_by('-price')
-    else:
+MENU_SORTING = {
+    'asc': ('price', 'id'),
+    'desc': ('-price', '-id'),
+    'price': ('price', 'id'),
+    '-price': ('-price', '-id'),
+    'name': ('name', 'id'),
+    '-name': ('-name', '-id'),
+}
+
+
+@api.get('/menu/{category_id}/sort', response = List[MenuOut], summary = 'Сортировка и фильтрация позиций меню')
+@cache_response('menu', List[MenuOut])
+@planned(MenuOut)
+def menu_sort(request, category_id: int,
+              sort: str = Query('asc', description = 'asc/desc (по цене), price, -price, name или -name'),
+              price_min: float = Query(None, description = 'Минимальная цена'),
+              price_max: float = Query(None, description = 'Максимальная цена'),
+              weight_min: float = Query(None, description = 'Минимальный вес'),
+              weight_max: float = Query(None, description = 'Максимальный вес'),
+              capacity_min: float = Query(None, description = 'Минимальный объем'),
+              capacity_max: float = Query(None, description = 'Максимальный объем'),
+              name: str = Query(None, description = 'Начало названия')):
+    if sort not in MENU_SORTING:
         raise HttpError(400, 'Неккоректный запрос!')
-    return menu
+
+    category = get_object_or_404(Category, id = category_id)
+    filters = {
+        'price__gte': price_min, 'price__lte': price_max,
+        'weight__gte': weight_min, 'weight__lte': weight_max,
+        'capacity__gte': capacity_min, 'capacity__lte': capacity_max,
+        'name__istartswith': name,
+    }
+    menu = Menu.objects.filter(category = category, **{ lookup: value for lookup, value in filters.items() if value is not None })
+    return menu.order_by(*MENU_SORTING[sort])
 
 
 @api.post('/menu', response = MenuOut, summary = 'Добавить позицию меню')
@@ -94,7 +188,9 @@ def create_menu(request, payload: MenuIn, image: UploadedFile = File(...)):
         payload_dict = payload.dict()
         category = get_object_or_404(Category, id = payload_dict.pop('category'))
         menu = Menu(**payload_dict, category = category)
-        menu.image.save(image.name, image)
+        store_image(image, menu.image)
+    except ImageRejected as error:
+        raise HttpError(error.status, str(error))
     except:
         raise HttpError(400, 'Неккоректный запрос!')
     return menu
@@ -128,10 +224,24 @@ def delete_menu(request, menu_id: int):
     return {'Сообщение': 'Позиция меню была удалена!'}
 
 
+@api.get('/menu/{menu_id}/image', summary = 'Получить уменьшенное изображение позиции меню')
+def get_menu_image(request, menu_id: int, width: int = Query(..., description = 'Ширина в пикселях'), format: str = Query('webp', description = 'webp или jpeg')):
+    if width not in allowed_widths() or format not in FORMATS:
+        raise HttpError(400, 'Неккоректный запрос!')
+    menu = get_object_or_404(Menu.objects.only('id', 'image'), id = menu_id)
+    if not menu.image:
+        raise HttpError(404, 'Изображение не найдено!')
+    return FileResponse(variant_cache.open(menu.image, width, format), content_type = FORMATS[format][1])
+
+
 @api.get('/menu/{category_id}/search', response = List[MenuOut], summary = 'Поиск позиции меню по названию')
-def search_menu(request, category_id: int, search: str = Query(None, description = 'Поиск')):
+@cache_response('menu', List[MenuOut])
+@planned(MenuOut)
+def search_menu(request, category_id: int, search: str = Query(None, description = 'Поиск'), limit: int = Query(20, ge = 1, le = 100)):
     category = get_object_or_404(Category, id = category_id)
-    return Menu.objects.filter(category = category, name__icontains = search)
+    if not search:
+        return Menu.objects.filter(category = category)
+    return _search_results(request, search, category_id = category.id, limit = limit)
 
 
 ''' API для позиций столиков '''
@@ -139,6 +249,9 @@ def search_menu(request, category_id: int, search: str = Query(None, description
 
 @api.get('/tables', response = List[TableOut], summary = 'Получить список столиков')
 @check_permission('cafe.view_table', raise_exception = True, use_auth = True)
+@conditional('tables')
+@paginate(CursorPagination, ordering = ('number', ))
+@planned(TableOut)
 def get_tables(request):
     return Table.objects.all()
 
@@ -185,23 +298,30 @@ def change_table_status(request, table_id: int, status_id: int):
 
 @api.get('/reservations', response = List[ReservationOut], summary = 'Получить список бронирований')
 @check_permission('cafe.view_reservation', raise_exception = True, use_auth = True)
+@paginate(CursorPagination, ordering = ('datetime', 'id'))
+@planned(ReservationOut)
 def get_reservations(request):
     return Reservation.objects.all()
 
 
+@api.get('/reservations/available', response = List[TableOut], summary = 'Свободные столики на интервал времени')
+@check_permission(('cafe.view_table', 'cafe.view_reservation'), raise_exception = True, use_auth = True)
+@planned(TableOut)
+def get_available_tables(request, start: datetime, end: datetime, guests: int = Query(1, ge = 1)):
+    if end <= start:
+        raise HttpError(400, 'Неккоректный запрос!')
+    return available_tables(start, end, guests)
+
+
 @api.post('/reservations', response = ReservationOut, summary = 'Добавить бронирование')
 @check_permission('cafe.add_reservation', raise_exception = True, use_auth = True)
 def create_reservation(request, payload: ReservationIn):
     try:
         payload_dict = payload.dict()
         table = get_object_or_404(Table, id = payload_dict.pop('table'))
-        if table.status.id == 3:
-            status = get_object_or_404(TableStatus, id = 2)
-            table.status = status
-            reservation = Reservation(**payload_dict, table = table)
-        else:
-            raise HttpError(406, 'Столик уже занят!')
-        reservation.save()
+        reservation = reserve(Reservation(**payload_dict, table = table))
+    except ReservationConflict as error:
+        raise HttpError(406, str(error))
     except:
         raise HttpError(400, 'Неккоректный запрос!')
     return reservation
@@ -211,19 +331,17 @@ def create_reservation(request, payload: ReservationIn):
 @check_permission('cafe.change_reservation', raise_exception = True, use_auth = True)
 def update_reservation(request, reservation_id: int, payload: ReservationIn):
     reservation = get_object_or_404(Reservation, id = reservation_id)
-    for attribute, value in payload.dict().items():
-        if attribute == 'table':
-            table = get_object_or_404(Table, id = value)
-            if table.status.id == 3:
-                status = get_object_or_404(TableStatus, id = 2)
-                table.status = status
-                setattr(reservation, attribute, table)
+    try:
+        for attribute, value in payload.dict().items():
+            if attribute == 'table':
+                setattr(reservation, attribute, get_object_or_404(Table, id = value))
             else:
-                raise HttpError(406, 'Столик уже занят!')
-        else:
-            setattr(reservation, attribute, value)
-        reservation.save()
-    return reservation
+                setattr(reservation, attribute, value)
+        return reserve(reservation)
+    except ReservationConflict as error:
+        raise HttpError(406, str(error))
+    except:
+        raise HttpError(400, 'Неккоректный запрос!')
 
 
 @api.delete('/reservations/{reservation_id}', summary = 'Удалить бронирование')
@@ -242,12 +360,15 @@ def delete_reservation(request, reservation_id: int):
 
 @api.get('/orders', response = List[OrderItemOut], summary = 'Получить список заказов')
 @check_permission('cafe.view_orderitem', raise_exception = True, use_auth = True)
+@paginate(CursorPagination, ordering = ('order', 'id'))
+@planned(OrderItemOut)
 def get_orders(request):
     return OrderItem.objects.all()
 
 
 @api.get('/order/{order_id}/', response = List[OrderItemOut], summary = 'Получить информацию о заказе')
 @check_permission('cafe.view_orderitem', raise_exception = True, use_auth = True)
+@planned(OrderItemOut)
 def get_order(request, order_id: int):
     try:
         order = get_object_or_404(Order, id = order_id)
@@ -259,6 +380,7 @@ def get_order(request, order_id: int):
 
 @api.post('/order', response = OrderOut, summary = 'Создать заказ')
 @check_permission('cafe.add_order', raise_exception = True, use_auth = True)
+@idempotent(OrderOut)
 def create_order(request, payload: OrderIn):
     try:
         payload_dict = payload.dict()
@@ -272,6 +394,7 @@ def create_order(request, payload: OrderIn):
         if table.status.id != 3:
             raise HttpError(406, 'Столик уже занят!')            
 
+        payload_dict.pop('totalAmount', None)
         if reservation is not None:
             order = Order(**payload_dict, table = table, status = status, reservation = reservation) 
         else:
@@ -284,47 +407,39 @@ def create_order(request, payload: OrderIn):
 
 @api.post('/order/add_item', response = OrderItemOut, summary = 'Добавить позицию заказа в заказ')
 @check_permission('cafe.add_orderitem', raise_exception = True, use_auth = True)
+@idempotent(OrderItemOut)
 def add_order_item(request, payload: OrderItemIn):
     try:
-        payload_dict = payload.dict()
-        order = get_object_or_404(Order, id = payload_dict.pop('order'))
-        menu = get_object_or_404(Menu, id = payload_dict.pop('menu'))
-        order_item, created = OrderItem.objects.get_or_create(order = order, menu = menu, **payload_dict)
-        if not created:
-            order_item.quantity += 1
-        order_item.price = order_item.get_amount()
-        order_item.save() 
+        order_item = add_item(payload.order, payload.menu, payload.quantity)
     except:
         raise HttpError(400, 'Неккоректный запрос!')
-    return order_item
+    return get_object_or_404(apply_plan(OrderItem.objects.all(), OrderItemOut), id = order_item.id)
+
+
+@api.post('/order/{order_id}/items', response = OrderOut, summary = 'Добавить в заказ несколько позиций')
+@check_permission(('cafe.add_orderitem', 'cafe.change_orderitem'), raise_exception = True, use_auth = True)
+@idempotent(OrderOut)
+def add_order_items(request, order_id: int, payload: OrderItemsIn):
+    order = add_items(order_id, payload.items)
+    return get_object_or_404(apply_plan(Order.objects.all(), OrderOut), id = order.id)
 
 
 @api.post('/order/{order_item_id}/append', response = OrderItemOut, summary = 'Увеличить количество позиций заказа на 1')
 @check_permission('cafe.change_orderitem', raise_exception = True, use_auth = True)
 def append_order_item(request, order_item_id: int):
     try:
-        order_item = get_object_or_404(OrderItem, id = order_item_id)
-        order_item.quantity += 1
-        order_item.save()
+        return change_quantity(order_item_id, 1, apply_plan(OrderItem.objects.all(), OrderItemOut))
     except:
         raise HttpError(400, 'Неккоректный запрос!')
-    return order_item
 
 
 @api.post('/order/{order_item_id}/delete', response = OrderItemOut, summary = 'Уменьшить количество позиций заказа на 1')
 @check_permission('cafe.change_orderitem', raise_exception = True, use_auth = True)
 def delete_order_item(request, order_item_id: int):
     try:
-        order_item = get_object_or_404(OrderItem, id = order_item_id)
-        order_item.quantity -= 1
-        if order_item.quantity == 0:
-            order_item.delete()
-        else:
-            order_item.save()
-        order_item.save()
+        return change_quantity(order_item_id, -1, apply_plan(OrderItem.objects.all(), OrderItemOut))
     except:
         raise HttpError(400, 'Неккоректный запрос!')
-    return order_item
 
 
 @api.post('/order/{order_id}/change_status', response = OrderOut, summary = 'Изменить статус заказа')
@@ -345,6 +460,8 @@ def change_order_status(request, order_id: int, status_id: int):
 
 @api.get('/payments', response = List[PaymentOut], summary = 'Получить список всех чеков на оплату')
 @check_permission('cafe.view_payment', raise_exception = True, use_auth = True)
+@paginate(CursorPagination, ordering = ('id', ))
+@planned(PaymentOut)
 def get_payments(request):
     return Payment.objects.all()
 
@@ -353,13 +470,14 @@ def get_payments(request):
 @check_permission('cafe.view_payment', raise_exception = True, use_auth = True)
 def get_payment(request, payment_id: int):
     try:
-        return get_object_or_404(Payment, id = payment_id)
+        return get_object_or_404(apply_plan(Payment.objects.all(), PaymentOut), id = payment_id)
     except:
         raise HttpError(400, 'Неккоректный запрос!')   
 
 
 @api.post('/payments', response = PaymentOut, summary = 'Добавить чек на оплату')
 @check_permission('cafe.add_payment', raise_exception = True, use_auth = True)
+@idempotent(PaymentOut)
 def create_payment(request, payload: PaymentIn):
     try:
         payload_dict = payload.dict()
@@ -375,9 +493,91 @@ def create_payment(request, payload: PaymentIn):
 @check_permission('cafe.change_payment', raise_exception = True, use_auth = True)
 def change_payment_status(request, payment_id: int):
     try:
-        payment = get_object_or_404(Payment, id = payment_id)
-        payment.status = True
-        payment.save()
+        get_object_or_404(Payment.objects.only('id'), id = payment_id)
+        pay(payment_id)
     except:
         raise HttpError(400, 'Неккоректный запрос!')
-    return payment
\ No newline at end of file
+    return get_object_or_404(apply_plan(Payment.objects.all(), PaymentOut), id = payment_id)
+
+
+''' API для отчётов по продажам '''
+
+
+@api.get('/reports/revenue', response = List[DailyRevenueOut], summary = 'Выручка и число оплаченных заказов по дням')
+@check_permission('cafe.view_dailytablesales', raise_exception = True, use_auth = True)
+def get_daily_revenue(request, date_from: date = Query(None, description = 'С даты'), date_to: date = Query(None, description = 'По дату')):
+    return list(daily_revenue(date_from, date_to))
+
+
+@api.get('/reports/top_dishes', response = List[DishSalesOut], summary = 'Самые продаваемые позиции меню за период')
+@check_permission('cafe.view_dailymenusales', raise_exception = True, use_auth = True)
+def get_top_dishes(request, date_from: date = Query(None, description = 'С даты'), date_to: date = Query(None, description = 'По дату'),
+                   limit: int = Query(10, ge = 1, le = 100)):
+    return list(top_dishes(date_from, date_to, limit))
+
+
+@api.get('/reports/tables', response = List[TableSalesOut], summary = 'Оплаченные заказы и выручка по столикам за период')
+@check_permission('cafe.view_dailytablesales', raise_exception = True, use_auth = True)
+def get_table_turnover(request, date_from: date = Query(None, description = 'С даты'), date_to: date = Query(None, description = 'По дату')):
+    return list(table_turnover(date_from, date_to))
+
+
+''' API выгрузок для бухгалтерии '''
+
+
+@api.get('/export/orders', summary = 'Выгрузка позиций заказов за период в CSV или NDJSON')
+@check_permission(('cafe.view_order', 'cafe.view_orderitem'), raise_exception = True, use_auth = True)
+def export_orders(request, format: str = Query('csv', description = 'csv или ndjson'),
+                  date_from: date = Query(None, description = 'С даты'), date_to: date = Query(None, description = 'По дату')):
+    if format not in EXPORT_FORMATS:
+        raise HttpError(400, 'Неккоректный запрос!')
+    return export_response(order_rows(date_from, date_to), ORDER_COLUMNS, format, 'orders', date_from, date_to)
+
+
+@api.get('/export/payments', summary = 'Выгрузка чеков на оплату за период в CSV или NDJSON')
+@check_permission('cafe.view_payment', raise_exception = True, use_auth = True)
+def export_payments(request, format: str = Query('csv', description = 'csv или ndjson'),
+                    date_from: date = Query(None, description = 'С даты'), date_to: date = Query(None, description = 'По дату')):
+    if format not in EXPORT_FORMATS:
+        raise HttpError(400, 'Неккоректный запрос!')
+    return export_response(payment_rows(date_from, date_to), PAYMENT_COLUMNS, format, 'payments', date_from, date_to)
+
+
+''' API событий для экранов кухни и зала '''
+
+
+@api.get('/events', response = EventsOut, summary = 'Ожидать изменения заказов, столиков и оплат (long-polling)')
+@check_permission('cafe.view_orderitem', raise_exception = True, use_auth = True)
+def get_events(request, since: int = Query(None, description = 'Номер последнего полученного события'),
+               types: str = Query(None, description = 'Типы через запятую: order, order_item, table, payment'),
+               timeout: float = Query(None, ge = 0, le = 60, description = 'Сколько секунд ждать событий')):
+    if since is None:
+        return { 'last': event_broker.seq, 'reset': True, 'events': [] }
+    return poll(since, parse_types(types), timeout)
+
+
+''' API мониторинга '''
+
+
+class MetricsToken(HttpBearer):
+    ''' Bearer-токен сборщика метрик из CAFE_METRICS; без токена в настройках доступ открыт только при DEBUG '''
+
+    def __call__(self, request):
+        if not metrics_config()['TOKEN']:
+            return True if settings.DEBUG else None
+        return super().__call__(request)
+
+    def authenticate(self, request, token):
+        if hmac.compare_digest(token.encode(), metrics_config()['TOKEN'].encode()):
+            return True
+
+
+@api.get('/metrics', auth = MetricsToken(), throttle = [], include_in_schema = False, summary = 'Метрики в формате Prometheus')
+def get_metrics(request):
+    return HttpResponse(render_metrics(collect_metrics()), content_type = 'text/plain; version=0.0.4; charset=utf-8')
+
+
+''' Асинхронные варианты API '''
+
+
+api.add_router('/async', async_router)
@@ -0,0 +1,280 @@
+from ninja import Router, Query
+from ninja.pagination import paginate
+from ninja.security import HttpBasicAuth
+from ninja.errors import HttpError, AuthenticationError
+
+from typing import List
+from datetime import datetime
+
+from asgiref.sync import sync_to_async
+from django.http import Http404, StreamingHttpResponse
+
+from .models import Category, Menu, Table, Reservation, Order, OrderItem, \
+    OrderStatus, Payment
+from .schemas import CategoryOut, MenuOut, TableOut, ReservationIn, ReservationOut, \
+    OrderIn, OrderOut, OrderItemIn, OrderItemOut, OrderItemsIn, PaymentOut, EventsOut
+from .decorators import check_permission
+from .auth import credential_cache
+from .metrics import auth_failed
+from .planner import planned, apply_plan
+from .pagination import CursorPagination
+from .cache import cache_response, conditional
+from .orders import add_item, add_items, change_quantity
+from .reservations import ReservationConflict, available_tables, reserve
+from .events import event_broker, parse_types, apoll, stream
+from .throttling import request_throttle
+from .idempotency import idempotent
+
+
+''' Асинхронные варианты API для запуска под ASGI (uvicorn) '''
+
+
+class AsyncBasicAuth(HttpBasicAuth):
+    def __call__(self, request):
+        if not request.headers.get(self.header):
+            auth_failed('missing')
+        return super().__call__(request)
+
+    async def authenticate(self, request, username, password):
+        # корзина может лежать в кэше Django, поэтому обращения к ней - через sync_to_async
+        await sync_to_async(request_throttle.check_login)(request)
+        user = await credential_cache.aauthenticate(username, password)
+        if user:
+            await request_throttle.acheck_request(request, user)
+            return user
+        auth_failed('invalid')
+        await sync_to_async(request_throttle.login_failed)(request)
+        raise AuthenticationError(message = 'Ошибка авторизации!')
+
+
+# Лимит запросов проверяет AsyncBasicAuth: throttle-ы ninja синхронны и заблокировали бы цикл событий
+router = Router(auth = AsyncBasicAuth(), throttle = [], tags = ['async'])
+
+
+async def aget_object_or_404(queryset, **kwargs):
+    try:
+        return await queryset.aget(**kwargs)
+    except queryset.model.DoesNotExist:
+        raise Http404(f'{queryset.model._meta.object_name} не найден!')
+
+
+async def planned_object(queryset, schema, **kwargs):
+    ''' Перечитывает объект по плану схемы ответа, чтобы сериализация не ходила в БД '''
+    return await aget_object_or_404(apply_plan(queryset, schema), **kwargs)
+
+
+# Операции с блокировками строк выполняются в transaction.atomic, который в Django
+# есть только синхронным, поэтому они уходят в поток через sync_to_async.
+aadd_item = sync_to_async(add_item)
+aadd_items = sync_to_async(add_items)
+achange_quantity = sync_to_async(change_quantity)
+areserve = sync_to_async(reserve)
+
+
+''' API для категорий и позиций меню '''
+
+
+@router.get('/menu', response = List[CategoryOut], summary = 'Получить список категорий меню')
+@conditional('menu')
+@cache_response('menu', List[CategoryOut])
+@planned(CategoryOut)
+async def get_categories(request):
+    return Category.objects.all()
+
+
+@router.get('/menu/{category_id}', response = List[MenuOut], summary = 'Получить позиции меню по категории')
+@conditional('menu')
+@cache_response('menu', List[MenuOut])
+@planned(MenuOut)
+async def get_menu(request, category_id: int):
+    category = await aget_object_or_404(Category.objects.only('id'), id = category_id)
+    return Menu.objects.filter(category = category)
+
+
+''' API для столиков и бронирований '''
+
+
+@router.get('/tables', response = List[TableOut], summary = 'Получить список столиков')
+@check_permission('cafe.view_table', raise_exception = True, use_auth = True)
+@conditional('tables')
+@paginate(CursorPagination, ordering = ('number', ))
+async def get_tables(request):
+    return apply_plan(Table.objects.all(), TableOut)
+
+
+@router.get('/reservations', response = List[ReservationOut], summary = 'Получить список бронирований')
+@check_permission('cafe.view_reservation', raise_exception = True, use_auth = True)
+@paginate(CursorPagination, ordering = ('datetime', 'id'))
+async def get_reservations(request):
+    return apply_plan(Reservation.objects.all(), ReservationOut)
+
+
+@router.get('/reservations/available', response = List[TableOut], summary = 'Свободные столики на интервал времени')
+@check_permission(('cafe.view_table', 'cafe.view_reservation'), raise_exception = True, use_auth = True)
+@planned(TableOut)
+async def get_available_tables(request, start: datetime, end: datetime, guests: int = Query(1, ge = 1)):
+    if end <= start:
+        raise HttpError(400, 'Неккоректный запрос!')
+    return available_tables(start, end, guests)
+
+
+@router.post('/reservations', response = ReservationOut, summary = 'Добавить бронирование')
+@check_permission('cafe.add_reservation', raise_exception = True, use_auth = True)
+async def create_reservation(request, payload: ReservationIn):
+    try:
+        payload_dict = payload.dict()
+        table = await aget_object_or_404(Table.objects.all(), id = payload_dict.pop('table'))
+        reservation = await areserve(Reservation(**payload_dict, table = table))
+    except ReservationConflict as error:
+        raise HttpError(406, str(error))
+    except:
+        raise HttpError(400, 'Неккоректный запрос!')
+    return await planned_object(Reservation.objects.all(), ReservationOut, id = reservation.id)
+
+
+@router.put('/reservations/{reservation_id}', response = ReservationOut, summary = 'Изменить информацию о бронировании')
+@check_permission('cafe.change_reservation', raise_exception = True, use_auth = True)
+async def update_reservation(request, reservation_id: int, payload: ReservationIn):
+    reservation = await aget_object_or_404(Reservation.objects.all(), id = reservation_id)
+    try:
+        for attribute, value in payload.dict().items():
+            if attribute == 'table':
+                setattr(reservation, attribute, await aget_object_or_404(Table.objects.all(), id = value))
+            else:
+                setattr(reservation, attribute, value)
+        await areserve(reservation)
+    except ReservationConflict as error:
+        raise HttpError(406, str(error))
+    except:
+        raise HttpError(400, 'Неккоректный запрос!')
+    return await planned_object(Reservation.objects.all(), ReservationOut, id = reservation.id)
+
+
+''' API для заказов '''
+
+
+@router.get('/orders', response = List[OrderItemOut], summary = 'Получить список заказов')
+@check_permission('cafe.view_orderitem', raise_exception = True, use_auth = True)
+@paginate(CursorPagination, ordering = ('order', 'id'))
+async def get_orders(request):
+    return apply_plan(OrderItem.objects.all(), OrderItemOut)
+
+
+@router.get('/order/{order_id}/', response = List[OrderItemOut], summary = 'Получить информацию о заказе')
+@check_permission('cafe.view_orderitem', raise_exception = True, use_auth = True)
+@planned(OrderItemOut)
+async def get_order(request, order_id: int):
+    order = await aget_object_or_404(Order.objects.only('id'), id = order_id)
+    return OrderItem.objects.filter(order = order)
+
+
+@router.post('/order', response = OrderOut, summary = 'Создать заказ')
+@check_permission('cafe.add_order', raise_exception = True, use_auth = True)
+@idempotent(OrderOut)
+async def create_order(request, payload: OrderIn):
+    try:
+        payload_dict = payload.dict()
+        status = await aget_object_or_404(OrderStatus.objects.all(), id = payload_dict.pop('status'))
+        table = await aget_object_or_404(Table.objects.all(), id = payload_dict.pop('table'))
+        reservation = await Reservation.objects.filter(id = payload_dict.pop('reservation')).afirst()
+
+        if table.status_id != 3:
+            raise HttpError(406, 'Столик уже занят!')
+
+        payload_dict.pop('totalAmount', None)
+        order = await Order.objects.acreate(**payload_dict, table = table, status = status, reservation = reservation)
+    except:
+        raise HttpError(400, 'Неккоректный запрос!')
+    return await planned_object(Order.objects.all(), OrderOut, id = order.id)
+
+
+@router.post('/order/add_item', response = OrderItemOut, summary = 'Добавить позицию заказа в заказ')
+@check_permission('cafe.add_orderitem', raise_exception = True, use_auth = True)
+@idempotent(OrderItemOut)
+async def add_order_item(request, payload: OrderItemIn):
+    try:
+        order_item = await aadd_item(payload.order, payload.menu, payload.quantity)
+    except:
+        raise HttpError(400, 'Неккоректный запрос!')
+    return await planned_object(OrderItem.objects.all(), OrderItemOut, id = order_item.id)
+
+
+@router.post('/order/{order_id}/items', response = OrderOut, summary = 'Добавить в заказ несколько позиций')
+@check_permission(('cafe.add_orderitem', 'cafe.change_orderitem'), raise_exception = True, use_auth = True)
+@idempotent(OrderOut)
+async def add_order_items(request, order_id: int, payload: OrderItemsIn):
+    order = await aadd_items(order_id, payload.items)
+    return await planned_object(Order.objects.all(), OrderOut, id = order.id)
+
+
+@router.post('/order/{order_item_id}/append', response = OrderItemOut, summary = 'Увеличить количество позиций заказа на 1')
+@check_permission('cafe.change_orderitem', raise_exception = True, use_auth = True)
+async def append_order_item(request, order_item_id: int):
+    try:
+        return await achange_quantity(order_item_id, 1, apply_plan(OrderItem.objects.all(), OrderItemOut))
+    except:
+        raise HttpError(400, 'Неккоректный запрос!')
+
+
+@router.post('/order/{order_item_id}/delete', response = OrderItemOut, summary = 'Уменьшить количество позиций заказа на 1')
+@check_permission('cafe.change_orderitem', raise_exception = True, use_auth = True)
+async def delete_order_item(request, order_item_id: int):
+    try:
+        return await achange_quantity(order_item_id, -1, apply_plan(OrderItem.objects.all(), OrderItemOut))
+    except:
+        raise HttpError(400, 'Неккоректный запрос!')
+
+
+@router.post('/order/{order_id}/change_status', response = OrderOut, summary = 'Изменить статус заказа')
+@check_permission('cafe.change_order', raise_exception = True, use_auth = True)
+async def change_order_status(request, order_id: int, status_id: int):
+    try:
+        order = await aget_object_or_404(Order.objects.all(), id = order_id)
+        order.status = await aget_object_or_404(OrderStatus.objects.all(), id = status_id)
+        await order.asave()
+    except:
+        raise HttpError(400, 'Неккоректный запрос!')
+    return await planned_object(Order.objects.all(), OrderOut, id = order.id)
+
+
+''' API для чеков на оплату '''
+
+
+@router.get('/payments', response = List[PaymentOut], summary = 'Получить список всех чеков на оплату')
+@check_permission('cafe.view_payment', raise_exception = True, use_auth = True)
+@paginate(CursorPagination, ordering = ('id', ))
+async def get_payments(request):
+    return apply_plan(Payment.objects.all(), PaymentOut)
+
+
+@router.get('/payments/{payment_id}', response = PaymentOut, summary = 'Получить информацию о чеке на оплату')
+@check_permission('cafe.view_payment', raise_exception = True, use_auth = True)
+async def get_payment(request, payment_id: int):
+    return await planned_object(Payment.objects.all(), PaymentOut, id = payment_id)
+
+
+''' API событий для экранов кухни и зала '''
+
+
+@router.get('/events', response = EventsOut, summary = 'Ожидать изменения заказов, столиков и оплат (long-polling)')
+@check_permission('cafe.view_orderitem', raise_exception = True, use_auth = True)
+async def get_events(request, since: int = Query(None, description = 'Номер последнего полученного события'),
+                     types: str = Query(None, description = 'Типы через запятую: order, order_item, table, payment'),
+                     timeout: float = Query(None, ge = 0, le = 60, description = 'Сколько секунд ждать событий')):
+    if since is None:
+        return { 'last': event_broker.seq, 'reset': True, 'events': [] }
+    return await apoll(since, parse_types(types), timeout)
+
+
+@router.get('/events/stream', summary = 'Поток изменений заказов, столиков и оплат (Server-Sent Events)')
+@check_permission('cafe.view_orderitem', raise_exception = True, use_auth = True)
+async def stream_events(request, types: str = Query(None, description = 'Типы через запятую: order, order_item, table, payment')):
+    last_event_id = request.headers.get('Last-Event-ID')
+    try:
+        last_event_id = int(last_event_id) if last_event_id else None
+    except ValueError:
+        raise HttpError(400, 'Неккоректный запрос!')
+    response = StreamingHttpResponse(stream(last_event_id, parse_types(types)), content_type = 'text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
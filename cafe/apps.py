@@ -5,3 +5,6 @@ class CafeConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'cafe'
     verbose_name = 'Кафе'
+
+    def ready(self):
+        from . import signals
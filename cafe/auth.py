@@ -0,0 +1,82 @@
+import hashlib
+import hmac
+import secrets
+
+from django.conf import settings
+from django.contrib.auth import aauthenticate, authenticate, get_user_model
+
+from .cache import LRUCache
+
+
+class CredentialCache:
+    ''' Кэш успешно проверенных учётных данных.
+
+    Пользователь читается из базы на каждый запрос, а кэшируется только то, что
+    пароль подходит к сохранённому хэшу: ключ - HMAC от логина, пароля и хэша
+    из базы на случайной соли процесса, значение - id пользователя. Смена
+    пароля меняет хэш, а is_active берётся из свежей записи, поэтому изменения
+    из любого воркера действуют сразу. Открытый пароль в памяти не хранится,
+    неудачные попытки не кэшируются.
+    '''
+
+    def __init__(self, enabled: bool = False, max_size: int = 1024, ttl: float = 300):
+        self.enabled = enabled
+        self._salt = secrets.token_bytes(32)
+        self._cache = LRUCache(max_size = max_size, ttl = ttl)
+
+    def _key(self, username: str, password: str, password_hash: str) -> bytes:
+        message = b'\0'.join(value.encode() for value in (username, password, password_hash))
+        return hmac.new(self._salt, message, hashlib.sha256).digest()
+
+    def _users(self, username: str):
+        User = get_user_model()
+        return User._default_manager.filter(**{ User.USERNAME_FIELD: username })
+
+    def _verified(self, user, username: str, password: str) -> bool:
+        if user is None or not getattr(user, 'is_active', True):
+            return False
+        return self._cache.get(self._key(username, password, user.password)) == user.pk
+
+    def _remember(self, user, username: str, password: str):
+        if user is not None:
+            self._cache.set(self._key(username, password, user.password), user.pk)
+
+    def authenticate(self, username: str, password: str):
+        if not self.enabled:
+            return authenticate(username = username, password = password)
+
+        user = self._users(username).first()
+        if self._verified(user, username, password):
+            return user
+        user = authenticate(username = username, password = password)
+        self._remember(user, username, password)
+        return user
+
+    async def aauthenticate(self, username: str, password: str):
+        if not self.enabled:
+            return await aauthenticate(username = username, password = password)
+
+        user = await self._users(username).afirst()
+        if self._verified(user, username, password):
+            return user
+        user = await aauthenticate(username = username, password = password)
+        self._remember(user, username, password)
+        return user
+
+    def clear(self):
+        self._cache.clear()
+
+    def stats(self):
+        return self._cache.stats()
+
+
+def _build_credential_cache():
+    config = getattr(settings, 'CAFE_AUTH_CACHE', {})
+    return CredentialCache(
+        enabled = config.get('ENABLED', False),
+        max_size = config.get('MAX_SIZE', 1024),
+        ttl = config.get('TTL', 300),
+    )
+
+
+credential_cache = _build_credential_cache()
@@ -0,0 +1,352 @@
+import base64
+import http.client
+import json
+import math
+import random
+import secrets
+import string
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+from decimal import Decimal
+from urllib.parse import quote
+
+from django.contrib.auth.models import User
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.servers.basehttp import ThreadedWSGIServer, WSGIRequestHandler
+from django.db import connection
+from django.db.models import Max, Min
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from .cache import bump_version
+from .models import Category, Menu, Order, OrderItem, OrderStatus, Payment, Reservation, Table, TableStatus
+from .reports import rebuild
+from .search import NAMESPACE as SEARCH_NAMESPACE, search_index
+
+
+''' Нагрузочный прогон API на синтетических данных '''
+
+
+BENCH_USER = ('bench', 'bench-password')
+
+WORDS = (
+    'борщ', 'солянка', 'пельмени', 'вареники', 'блины', 'сырники', 'оливье', 'винегрет', 'шашлык', 'плов',
+    'котлета', 'пюре', 'гречка', 'окрошка', 'уха', 'пирог', 'морс', 'компот', 'квас', 'чай',
+    'кофе', 'салат', 'стейк', 'паста', 'пицца', 'суп', 'рагу', 'жаркое', 'голубцы', 'драники',
+)
+
+
+def _next_id(model) -> int:
+    return (model.objects.aggregate(last = Max('id'))['last'] or 0) + 1
+
+
+def seed(tables: int = 300, categories: int = 40, menu: int = 3000, orders: int = 100000,
+         days: int = 90, batch_size: int = 2000, seed: int = 1, stdout = None) -> dict:
+    ''' Заполняет базу реалистичным набором данных через bulk_create.
+
+    id задаются явно, поэтому связи строятся без перечитывания вставленных строк
+    (MySQL не возвращает id из bulk_create). Заказы распределены по последним days
+    дням, у каждого есть бронь, 1-5 позиций и чек; старые чеки оплачены.
+    '''
+    rng = random.Random(seed)
+    now = timezone.now()
+
+    TableStatus.objects.bulk_create([TableStatus(id = i, name = name) for i, name in enumerate(('Занят', 'Забронирован', 'Свободен'), start = 1)], ignore_conflicts = True)
+    OrderStatus.objects.bulk_create([OrderStatus(id = i, name = name) for i, name in enumerate(('Новый', 'Готовится', 'Выдан', 'Закрыт'), start = 1)], ignore_conflicts = True)
+
+    first = _next_id(Table)
+    number = (Table.objects.aggregate(last = Max('number'))['last'] or 0) + 1
+    table_ids = [first + i for i in range(tables)]
+    Table.objects.bulk_create([
+        Table(id = table_id, number = number + i, status_id = rng.choice((1, 2, 3)), seats = rng.choice((2, 4, 4, 6, 8)))
+        for i, table_id in enumerate(table_ids)
+    ], batch_size = batch_size)
+
+    first = _next_id(Category)
+    category_ids = [first + i for i in range(categories)]
+    Category.objects.bulk_create([
+        Category(id = category_id, name = f'Категория {category_id}', slug = f'bench-category-{category_id}')
+        for category_id in category_ids
+    ], batch_size = batch_size)
+
+    first = _next_id(Menu)
+    prices = {}
+    dishes = []
+    for menu_id in range(first, first + menu):
+        name = f'{rng.choice(WORDS).capitalize()} {rng.choice(WORDS)} №{menu_id}'
+        prices[menu_id] = Decimal(rng.randrange(50, 2000)).quantize(Decimal('0.01'))
+        dishes.append(Menu(
+            id = menu_id, category_id = rng.choice(category_ids), name = name, slug = f'bench-menu-{menu_id}',
+            weight = rng.randrange(50, 600), capacity = 0, price = prices[menu_id],
+            description = ' '.join(rng.sample(WORDS, 5)),
+        ))
+    Menu.objects.bulk_create(dishes, batch_size = batch_size)
+    menu_ids = list(prices)
+
+    reservation_id, order_id, item_id, payment_id = (_next_id(model) for model in (Reservation, Order, OrderItem, Payment))
+    for offset in range(0, orders, batch_size):
+        reservations, batch, items, payments, dates = [], [], [], [], []
+        for _ in range(min(batch_size, orders - offset)):
+            created_at = now - timedelta(seconds = rng.randrange(days * 86400))
+            table_id = rng.choice(table_ids)
+            reservations.append(Reservation(
+                id = reservation_id, table_id = table_id, client_name = 'Гость', client_phone = '+70000000000',
+                datetime = created_at, ends_at = created_at + timedelta(minutes = 120), quest_count = rng.randint(1, 6), comment = '',
+            ))
+            total = Decimal(0)
+            for _ in range(rng.randint(1, 5)):
+                menu_id, quantity = rng.choice(menu_ids), rng.randint(1, 3)
+                price = prices[menu_id] * quantity
+                total += price
+                items.append(OrderItem(id = item_id, order_id = order_id, menu_id = menu_id, price = price, quantity = quantity))
+                item_id += 1
+            batch.append(Order(
+                id = order_id, table_id = table_id, reservation_id = reservation_id, status_id = rng.randint(1, 4),
+                totalAmount = total,
+            ))
+            dates.append(created_at)
+            payments.append(Payment(id = payment_id, order_id = order_id, status = now - created_at > timedelta(days = 1)))
+            reservation_id, order_id, payment_id = reservation_id + 1, order_id + 1, payment_id + 1
+
+        Reservation.objects.bulk_create(reservations)
+        Order.objects.bulk_create(batch)
+        # auto_now_add проставляет created_at при вставке, поэтому даты заказов записываются отдельным UPDATE
+        for order, created_at in zip(batch, dates):
+            order.created_at = created_at
+        Order.objects.bulk_update(batch, ['created_at'])
+        OrderItem.objects.bulk_create(items, batch_size = batch_size)
+        Payment.objects.bulk_create(payments)
+        if stdout is not None:
+            stdout.write(f'Заказов загружено: {offset + len(batch)} из {orders}')
+
+    rebuild()
+    bump_version('menu')
+    bump_version('tables')
+    bump_version(SEARCH_NAMESPACE)
+    search_index.rebuild()
+    if not User.objects.filter(username = BENCH_USER[0]).exists():
+        User.objects.create_superuser(BENCH_USER[0], password = BENCH_USER[1])
+    return dataset()
+
+
+def dataset() -> dict:
+    ''' Диапазоны id загруженных данных, из которых сценарии выбирают объекты '''
+    def bounds(model):
+        row = model.objects.aggregate(first = Min('id'), last = Max('id'))
+        return row['first'], row['last']
+
+    return {
+        'categories': list(Category.objects.values_list('id', flat = True)),
+        'menu': bounds(Menu),
+        'tables': Table.objects.count(),
+        'orders': bounds(Order),
+        'order_items': bounds(OrderItem),
+        'payments': bounds(Payment),
+    }
+
+
+''' Сценарии: (имя, вес, функция (данные, rng) -> (метод, путь, тело)) '''
+
+
+def _between(rng, bounds):
+    return rng.randint(*bounds)
+
+
+def _available(data, rng):
+    start = timezone.localtime() + timedelta(days = rng.randint(1, 30), hours = rng.randint(0, 12))
+    end = start + timedelta(hours = 2)
+    return 'get', f'/api/reservations/available?start={start:%Y-%m-%dT%H:%M}&end={end:%Y-%m-%dT%H:%M}&guests={rng.randint(1, 6)}', None
+
+
+def _add_item(data, rng):
+    return 'post', '/api/order/add_item', {
+        'order': _between(rng, data['orders']), 'menu': _between(rng, data['menu']), 'price': 0, 'quantity': rng.randint(1, 2),
+    }
+
+
+MIX = (
+    ('menu', 20, lambda data, rng: ('get', '/api/menu', None)),
+    ('menu_category', 20, lambda data, rng: ('get', f'/api/menu/{rng.choice(data["categories"])}', None)),
+    ('menu_sort', 5, lambda data, rng: ('get', f'/api/menu/{rng.choice(data["categories"])}/sort?sort=-price&price_max=1000', None)),
+    ('menu_search', 8, lambda data, rng: ('get', f'/api/menu/search?search={quote(rng.choice(WORDS)[:rng.randint(3, 6)])}', None)),
+    ('tables', 8, lambda data, rng: ('get', '/api/tables', None)),
+    ('reservations_available', 5, _available),
+    ('orders_page', 5, lambda data, rng: ('get', '/api/orders', None)),
+    ('order', 10, lambda data, rng: ('get', f'/api/order/{_between(rng, data["orders"])}/', None)),
+    ('payment', 5, lambda data, rng: ('get', f'/api/payments/{_between(rng, data["payments"])}', None)),
+    ('report_revenue', 2, lambda data, rng: ('get', '/api/reports/revenue', None)),
+    ('report_top_dishes', 2, lambda data, rng: ('get', '/api/reports/top_dishes?limit=10', None)),
+    ('add_item', 6, _add_item),
+    ('append_item', 4, lambda data, rng: ('post', f'/api/order/{_between(rng, data["order_items"])}/append', None)),
+)
+
+
+# сценарии, у которых есть двойник на async-роутере /api/async/
+ASYNC_SCENARIOS = ('menu', 'menu_category', 'tables', 'reservations_available', 'orders_page', 'order', 'payment', 'add_item', 'append_item')
+
+
+def async_mix(mix = MIX) -> tuple:
+    ''' Те же сценарии с путями async-роутера; сценарии без двойника отбрасываются '''
+    def prefixed(build):
+        def build_async(data, rng):
+            method, path, body = build(data, rng)
+            return method, '/api/async/' + path[len('/api/'):], body
+        return build_async
+
+    return tuple((name, weight, prefixed(build)) for name, weight, build in mix if name in ASYNC_SCENARIOS)
+
+
+def plan(data: dict, requests: int, seed: int = 1, mix = MIX) -> list:
+    ''' Детерминированная последовательность запросов: (сценарий, метод, путь, тело) '''
+    rng = random.Random(seed)
+    scenarios = rng.choices(mix, weights = [weight for name, weight, build in mix], k = requests)
+    return [(name, *build(data, rng)) for name, weight, build in scenarios]
+
+
+''' Статистика '''
+
+
+def percentile(values: list, p: float) -> float:
+    ''' Перцентиль по ближайшему рангу на отсортированном списке '''
+    if not values:
+        return 0.0
+    return values[max(0, math.ceil(p / 100 * len(values)) - 1)]
+
+
+def summarize(samples: list, elapsed: float) -> dict:
+    ''' samples: (сценарий, статус, секунды, запросов к БД) -> метрики по сценариям и общие '''
+    groups = {}
+    for name, status, seconds, queries in samples:
+        groups.setdefault(name, []).append((status, seconds, queries))
+    groups['total'] = [(status, seconds, queries) for name, status, seconds, queries in samples]
+
+    report = {}
+    for name, rows in sorted(groups.items()):
+        latencies = sorted(seconds * 1000 for status, seconds, queries in rows)
+        queries = [queries for status, seconds, queries in rows if queries is not None]
+        statuses = {}
+        for status, seconds, count in rows:
+            statuses[str(status)] = statuses.get(str(status), 0) + 1
+        report[name] = {
+            'requests': len(rows),
+            'errors': sum(1 for status, seconds, count in rows if status >= 500 or status == 0),
+            'statuses': statuses,
+            'throughput_rps': round(len(rows) / elapsed, 2) if elapsed else None,
+            'latency_ms': {
+                'mean': round(sum(latencies) / len(latencies), 3),
+                'p50': round(percentile(latencies, 50), 3),
+                'p95': round(percentile(latencies, 95), 3),
+                'p99': round(percentile(latencies, 99), 3),
+                'max': round(latencies[-1], 3),
+            },
+            'queries': {
+                'mean': round(sum(queries) / len(queries), 2) if queries else None,
+                'max': max(queries) if queries else None,
+            },
+        }
+    return report
+
+
+def _authorization() -> str:
+    return 'Basic ' + base64.b64encode(':'.join(BENCH_USER).encode()).decode()
+
+
+''' Прогон через тестовый клиент Django (без сети, один поток) '''
+
+
+def run_client(requests: list, warmup: int = 0) -> dict:
+    client = Client(HTTP_AUTHORIZATION = _authorization())
+    samples = []
+    started = None
+    for index, (name, method, path, body) in enumerate(requests):
+        if index == warmup:
+            started = time.perf_counter()
+        kwargs = { 'data': json.dumps(body), 'content_type': 'application/json' } if body is not None else {}
+        with CaptureQueriesContext(connection) as context:
+            begin = time.perf_counter()
+            response = getattr(client, method)(path, **kwargs)
+            seconds = time.perf_counter() - begin
+        if index >= warmup:
+            samples.append((name, response.status_code, seconds, len(context)))
+    elapsed = time.perf_counter() - started if started is not None else 0
+    return { 'elapsed_s': round(elapsed, 3), 'endpoints': summarize(samples, elapsed) }
+
+
+''' Прогон через локальный HTTP-сервер с параллельными клиентами '''
+
+
+class QueryCountingApp:
+    ''' WSGI-обёртка: считает запросы к БД на время обработки и отдачи тела ответа
+    и возвращает их число в заголовке X-Bench-Queries '''
+
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        count = [0]
+        captured = []
+
+        def counter(execute, sql, params, many, context):
+            count[0] += 1
+            return execute(sql, params, many, context)
+
+        with connection.execute_wrapper(counter):
+            result = self.application(environ, lambda status, headers, exc_info = None: captured.append((status, headers)))
+            try:
+                body = b''.join(result)
+            finally:
+                if hasattr(result, 'close'):
+                    result.close()
+        status, headers = captured[-1]
+        start_response(status, [*headers, ('X-Bench-Queries', str(count[0]))])
+        return [body]
+
+
+class _QuietHandler(WSGIRequestHandler):
+    def log_message(self, *args):
+        pass
+
+
+def run_live(requests: list, concurrency: int = 8, warmup: int = 0) -> dict:
+    server = ThreadedWSGIServer(('127.0.0.1', 0), _QuietHandler, allow_reuse_address = False)
+    server.set_app(QueryCountingApp(WSGIHandler()))
+    thread = threading.Thread(target = server.serve_forever, kwargs = { 'poll_interval': 0.05 }, daemon = True)
+    thread.start()
+    host, port = server.server_address
+    authorization = _authorization()
+    # API защищено от CSRF: клиент присылает одинаковый токен в cookie и заголовке
+    csrf_token = ''.join(secrets.choice(string.ascii_letters + string.digits) for _ in range(32))
+
+    def send(request):
+        name, method, path, body = request
+        headers = { 'Authorization': authorization, 'Cookie': f'csrftoken={csrf_token}', 'X-CSRFToken': csrf_token }
+        payload = None
+        if body is not None:
+            payload = json.dumps(body).encode()
+            headers['Content-Type'] = 'application/json'
+        client = http.client.HTTPConnection(host, port, timeout = 60)
+        begin = time.perf_counter()
+        try:
+            client.request(method.upper(), path, body = payload, headers = headers)
+            response = client.getresponse()
+            response.read()
+            status, queries = response.status, response.getheader('X-Bench-Queries')
+        except OSError:
+            status, queries = 0, None
+        finally:
+            client.close()
+        return name, status, time.perf_counter() - begin, int(queries) if queries is not None else None
+
+    try:
+        with ThreadPoolExecutor(max_workers = concurrency) as executor:
+            list(executor.map(send, requests[:warmup]))
+            started = time.perf_counter()
+            samples = list(executor.map(send, requests[warmup:]))
+            elapsed = time.perf_counter() - started
+    finally:
+        server.shutdown()
+        server.server_close()
+    return { 'elapsed_s': round(elapsed, 3), 'concurrency': concurrency, 'endpoints': summarize(samples, elapsed) }
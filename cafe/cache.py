@@ -0,0 +1,255 @@
+import threading
+import time
+from collections import OrderedDict
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction
+from django.conf import settings
+from django.db.models import F, QuerySet
+from django.http import HttpResponse, HttpResponseNotModified
+from django.http.response import HttpResponseBase
+from django.utils.http import parse_etags
+from pydantic import TypeAdapter
+
+from .instrumentation import TimedJSONRenderer
+from .models import CacheVersion
+
+
+class LRUCache:
+    ''' Ограниченный по размеру LRU-кэш с временем жизни записей и счётчиками попаданий '''
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default = None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl: float = None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last = False)
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def evict(self, predicate):
+        with self._lock:
+            for key in [key for key, (value, expires) in self._data.items() if predicate(value)]:
+                del self._data[key]
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        return { 'size': len(self._data), 'max_size': self.max_size, 'hits': self.hits, 'misses': self.misses }
+
+    def __len__(self):
+        return len(self._data)
+
+
+''' Версионируемый кэш ответов '''
+
+
+class LocMemBackend:
+    ''' Кэш ответов в памяти процесса. Ключи включают версию из базы, общую для
+    всех воркеров, поэтому устаревшая запись после изменения уже не читается
+    и просто вытесняется по LRU или TTL.
+    '''
+
+    def __init__(self, max_size: int = 512, ttl: float = 3600):
+        self._cache = LRUCache(max_size = max_size, ttl = ttl)
+
+    def get(self, key):
+        return self._cache.get(key)
+
+    def set(self, key, value):
+        self._cache.set(key, value)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+class DjangoCacheBackend:
+    ''' Кэш ответов на фреймворке кэширования Django (алиас из CACHES) '''
+
+    def __init__(self, alias: str = 'default', ttl: float = 3600, prefix: str = 'cafe'):
+        from django.core.cache import caches
+        self._cache = caches[alias]
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, key):
+        return self._cache.get(f'{self.prefix}:{key}')
+
+    def set(self, key, value):
+        self._cache.set(f'{self.prefix}:{key}', value, self.ttl)
+
+    def stats(self):
+        return {}
+
+
+def _build_backend():
+    config = getattr(settings, 'CAFE_CACHE', {})
+    if config.get('BACKEND', 'locmem') == 'django':
+        return DjangoCacheBackend(alias = config.get('ALIAS', 'default'), ttl = config.get('TTL', 3600))
+    return LocMemBackend(max_size = config.get('MAX_SIZE', 512), ttl = config.get('TTL', 3600))
+
+
+cache_backend = _build_backend()
+
+
+def get_version(namespace: str) -> int:
+    ''' Текущая версия namespace из таблицы CacheVersion, общей для всех воркеров '''
+    version = CacheVersion.objects.filter(namespace = namespace).values_list('version', flat = True).first()
+    if version is None:
+        version = CacheVersion.objects.get_or_create(namespace = namespace, defaults = { 'version': time.time_ns() })[0].version
+    return version
+
+
+async def aget_version(namespace: str) -> int:
+    version = await CacheVersion.objects.filter(namespace = namespace).values_list('version', flat = True).afirst()
+    if version is None:
+        version = (await CacheVersion.objects.aget_or_create(namespace = namespace, defaults = { 'version': time.time_ns() }))[0].version
+    return version
+
+
+def bump_version(namespace: str) -> int:
+    ''' Сдвигает версию одним UPDATE с F-выражением. Внутри транзакции новая версия
+    становится видна другим воркерам только вместе с изменёнными данными, поэтому
+    ответ со старыми данными не может попасть в кэш под новой версией.
+    Возвращает новую версию, которую видит эта транзакция.
+    '''
+    versions = CacheVersion.objects.filter(namespace = namespace)
+    if not versions.update(version = F('version') + 1):
+        get_version(namespace)
+        versions.update(version = F('version') + 1)
+    return versions.values_list('version', flat = True).get()
+
+
+def request_version(request, namespace: str) -> int:
+    ''' Версия читается один раз за запрос, даже если её спрашивают несколько декораторов '''
+    versions = request.__dict__.setdefault('_cache_versions', {})
+    if namespace not in versions:
+        versions[namespace] = get_version(namespace)
+    return versions[namespace]
+
+
+async def arequest_version(request, namespace: str) -> int:
+    versions = request.__dict__.setdefault('_cache_versions', {})
+    if namespace not in versions:
+        versions[namespace] = await aget_version(namespace)
+    return versions[namespace]
+
+
+def skip_cache(request):
+    ''' Ответ текущего запроса не сохраняется в кэш: он собран по данным, отстающим от версии '''
+    request.__dict__['_skip_response_cache'] = True
+
+
+def cache_response(namespace: str, response):
+    ''' Кэширует сериализованный ответ обработчика с ключом по версии namespace и URL '''
+    adapter = TypeAdapter(response)
+    renderer = TimedJSONRenderer()
+    content_type = renderer.media_type + '; charset=' + renderer.charset
+
+    def render(request, result):
+        data = adapter.dump_python(adapter.validate_python(result, from_attributes = True))
+        return renderer.render(request, data, response_status = 200)
+
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapped_view(request, *args, **kwargs):
+                key = f'{namespace}:{await arequest_version(request, namespace)}:{request.get_full_path()}'
+                cached = cache_backend.get(key)
+                if cached is not None:
+                    return HttpResponse(cached, content_type = content_type)
+
+                result = await view_func(request, *args, **kwargs)
+                if isinstance(result, HttpResponseBase):
+                    return result
+                if isinstance(result, QuerySet):
+                    result = [obj async for obj in result]
+                content = render(request, result)
+                if not request.__dict__.get('_skip_response_cache'):
+                    cache_backend.set(key, content)
+                return HttpResponse(content, content_type = content_type)
+            return async_wrapped_view
+
+        @wraps(view_func)
+        def wrapped_view(request, *args, **kwargs):
+            key = f'{namespace}:{request_version(request, namespace)}:{request.get_full_path()}'
+            cached = cache_backend.get(key)
+            if cached is not None:
+                return HttpResponse(cached, content_type = content_type)
+
+            result = view_func(request, *args, **kwargs)
+            if isinstance(result, HttpResponseBase):
+                return result
+            content = render(request, result)
+            if not request.__dict__.get('_skip_response_cache'):
+                cache_backend.set(key, content)
+            return HttpResponse(content, content_type = content_type)
+        return wrapped_view
+    return decorator
+
+
+def conditional(namespace: str):
+    ''' Условный GET по ETag из версии namespace.
+
+    Версия читается до выполнения обработчика, поэтому совпавший If-None-Match
+    отдаёт 304 после одного чтения строки CacheVersion по первичному ключу, без
+    запросов к данным. Заголовок ETag на ответ 200 ставит cafe.middleware.ETagMiddleware.
+    '''
+    def not_modified(request, version: int):
+        etag = f'"{namespace}-{version}"'
+        if_none_match = request.headers.get('If-None-Match')
+        if if_none_match:
+            etags = [tag.removeprefix('W/') for tag in parse_etags(if_none_match)]
+            if '*' in etags or etag in etags:
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+        request.etag = etag
+
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapped_view(request, *args, **kwargs):
+                response = not_modified(request, await arequest_version(request, namespace))
+                if response is not None:
+                    return response
+                return await view_func(request, *args, **kwargs)
+            return async_wrapped_view
+
+        @wraps(view_func)
+        def wrapped_view(request, *args, **kwargs):
+            response = not_modified(request, request_version(request, namespace))
+            if response is not None:
+                return response
+            return view_func(request, *args, **kwargs)
+        return wrapped_view
+    return decorator
@@ -0,0 +1,10 @@
+from django.db.backends.mysql import base
+
+from cafe.db.pool import PooledConnectionMixin
+
+
+class DatabaseWrapper(PooledConnectionMixin, base.DatabaseWrapper):
+    ''' MySQL с пулом соединений (настройки - ключ POOL в DATABASES) '''
+
+    def ping(self, connection):
+        connection.ping()
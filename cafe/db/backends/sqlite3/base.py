@@ -0,0 +1,11 @@
+from django.db.backends.sqlite3 import base
+
+from cafe.db.pool import PooledConnectionMixin
+
+
+class DatabaseWrapper(PooledConnectionMixin, base.DatabaseWrapper):
+    ''' SQLite с пулом соединений - локальная замена MySQL для разработки и тестов пула '''
+
+    def pool_enabled(self):
+        # Закрытие соединения с БД в памяти уничтожает её, Django их и так не закрывает
+        return super().pool_enabled() and not self.is_in_memory_db()
@@ -0,0 +1,213 @@
+import os
+import threading
+import time
+from collections import deque
+
+from django.db import OperationalError
+
+
+''' Пул соединений с БД для бэкендов cafe.db.backends '''
+
+
+class ConnectionPool:
+    ''' Потокобезопасный пул открытых DB-API соединений одной базы.
+
+    Свободные соединения выдаются в порядке LIFO (самые "тёплые" первыми),
+    перед выдачей проверяются пингом и возрастом. MAX_SIZE ограничивает число
+    открытых соединений процесса: при исчерпании запрос ждёт освобождения
+    до TIMEOUT секунд. После fork (gunicorn --preload) пул начинается заново,
+    унаследованные от родителя соединения не переиспользуются.
+    '''
+
+    def __init__(self, label: str, max_size: int = None, max_idle: int = 5, max_age: float = 600,
+                 pre_ping: bool = True, timeout: float = 30):
+        self.label = label
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.max_age = max_age
+        self.pre_ping = pre_ping
+        self.timeout = timeout
+        self.pid = os.getpid()
+        self._idle = deque()
+        self._open = 0
+        self._condition = threading.Condition()
+        self._counters = dict.fromkeys(('created', 'reused', 'expired', 'failed_ping', 'discarded', 'waits', 'timeouts'), 0)
+
+    def _check_fork(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self._idle.clear()
+            self._open = 0
+
+    def _expired(self, created: float) -> bool:
+        return self.max_age is not None and time.monotonic() - created >= self.max_age
+
+    def _close(self, connection, counter: str):
+        with self._condition:
+            self._open -= 1
+            self._counters[counter] += 1
+            self._condition.notify()
+        try:
+            connection.close()
+        except Exception:
+            pass
+
+    def acquire(self, connect, ping):
+        ''' Возвращает (соединение, время создания): свободное из пула или новое через connect() '''
+        deadline = time.monotonic() + self.timeout
+        while True:
+            with self._condition:
+                self._check_fork()
+                entry = self._idle.pop() if self._idle else None
+                if entry is None:
+                    if self.max_size is None or self._open < self.max_size:
+                        self._open += 1
+                    else:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            self._counters['timeouts'] += 1
+                            raise OperationalError(f'Пул соединений {self.label} исчерпан ({self.max_size})')
+                        self._counters['waits'] += 1
+                        self._condition.wait(remaining)
+                        continue
+
+            if entry is None:
+                try:
+                    connection = connect()
+                except BaseException:
+                    with self._condition:
+                        self._open -= 1
+                        self._condition.notify()
+                    raise
+                with self._condition:
+                    self._counters['created'] += 1
+                return connection, time.monotonic()
+
+            connection, created = entry
+            if self._expired(created):
+                self._close(connection, 'expired')
+                continue
+            if self.pre_ping:
+                try:
+                    ping(connection)
+                except Exception:
+                    self._close(connection, 'failed_ping')
+                    continue
+            with self._condition:
+                self._counters['reused'] += 1
+            return connection, created
+
+    def release(self, connection, created: float, reusable: bool = True):
+        ''' Возвращает соединение в пул или закрывает его, если оно непригодно или лишнее '''
+        with self._condition:
+            if self.pid != os.getpid():
+                return
+            if reusable and not self._expired(created) and len(self._idle) < self.max_idle:
+                self._idle.append((connection, created))
+                self._condition.notify()
+                return
+        self._close(connection, 'discarded')
+
+    def clear(self):
+        with self._condition:
+            idle, self._idle = list(self._idle), deque()
+        for connection, created in idle:
+            self._close(connection, 'discarded')
+
+    def stats(self):
+        with self._condition:
+            return {
+                **self._counters,
+                'open': self._open,
+                'idle': len(self._idle),
+                'in_use': self._open - len(self._idle),
+                'max_size': self.max_size,
+            }
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias: str, conn_params: dict, options: dict) -> ConnectionPool:
+    ''' Пул на алиас и параметры подключения: смена NAME (тестовая БД) даёт отдельный пул '''
+    key = (alias, repr(sorted(conn_params.items(), key = lambda item: item[0])))
+    pool = _pools.get(key)
+    if pool is None:
+        with _pools_lock:
+            pool = _pools.get(key)
+            if pool is None:
+                pool = _pools[key] = ConnectionPool(
+                    label = alias,
+                    max_size = options.get('MAX_SIZE'),
+                    max_idle = options.get('MAX_IDLE', 5),
+                    max_age = options.get('MAX_AGE', 600),
+                    pre_ping = options.get('PRE_PING', True),
+                    timeout = options.get('TIMEOUT', 30),
+                )
+    return pool
+
+
+def pool_stats() -> dict:
+    ''' Метрики всех пулов процесса по алиасам баз '''
+    stats = {}
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        current = stats.setdefault(pool.label, dict.fromkeys(pool.stats(), 0))
+        for name, value in pool.stats().items():
+            current[name] = value if name == 'max_size' else current[name] + value
+    return stats
+
+
+def close_pools():
+    ''' Закрывает свободные соединения всех пулов процесса '''
+    with _pools_lock:
+        pools = list(_pools.values())
+    for pool in pools:
+        pool.clear()
+
+
+class PooledConnectionMixin:
+    ''' Подмешивается к DatabaseWrapper бэкенда: get_new_connection берёт соединение
+    из пула, а закрытие (конец запроса при CONN_MAX_AGE = 0) возвращает его обратно.
+
+    Соединение с ошибками или закрытое посреди транзакции в пул не возвращается,
+    незавершённая транзакция вне atomic откатывается перед возвратом.
+    '''
+
+    _pool_checkout = None
+
+    def pool_enabled(self) -> bool:
+        return bool(self.settings_dict.get('POOL'))
+
+    def ping(self, connection):
+        cursor = connection.cursor()
+        try:
+            cursor.execute('SELECT 1')
+        finally:
+            cursor.close()
+
+    def get_new_connection(self, conn_params):
+        connect = super().get_new_connection
+        if not self.pool_enabled():
+            return connect(conn_params)
+        pool = get_pool(self.alias, conn_params, self.settings_dict['POOL'])
+        connection, created = pool.acquire(lambda: connect(conn_params), self.ping)
+        self._pool_checkout = (pool, connection, created)
+        return connection
+
+    def _close(self):
+        checkout = self._pool_checkout
+        if checkout is None or checkout[1] is not self.connection:
+            return super()._close()
+
+        self._pool_checkout = None
+        pool, connection, created = checkout
+        reusable = not self.errors_occurred and not self.in_atomic_block
+        if reusable and not self.autocommit:
+            try:
+                connection.rollback()
+            except Exception:
+                reusable = False
+        pool.release(connection, created, reusable)
@@ -1,18 +1,39 @@
 from functools import wraps
+from typing import Iterable, Union
+from asgiref.sync import iscoroutinefunction
 from django.http import HttpResponse
 
+from .metrics import permission_denied
+from .permissions import permission_index
+
+
+def _denied(permissions: frozenset, raise_exception: bool):
+    permission_denied(permissions)
+    if raise_exception:
+        return HttpResponse('У вас недостаточно прав для совершения данной операции!', status = 403)
+    return HttpResponse('Требуется авторизация!', status = 401)
+
+
+def check_permission(permission_codename: Union[str, Iterable[str]], use_auth: bool = True, raise_exception: bool = True):
+    permissions = frozenset([permission_codename] if isinstance(permission_codename, str) else permission_codename)
 
-def check_permission(permission_codename: str, use_auth: bool = True, raise_exception: bool = True):
     def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapped_view(request, *args, **kwargs):
+                user_obj = request.auth if use_auth else await request.auser()
+
+                if await permission_index.ahas_perms(user_obj, permissions, request):
+                    return await view_func(request, *args, **kwargs)
+                return _denied(permissions, raise_exception)
+            return async_wrapped_view
+
         @wraps(view_func)
         def wrapped_view(request, *args, **kwargs):
             user_obj = request.auth if use_auth else request.user
             
-            if user_obj and user_obj.has_perm(permission_codename):
+            if permission_index.has_perms(user_obj, permissions, request):
                 return view_func(request, *args, **kwargs)
-            
-            if raise_exception:
-                return HttpResponse('У вас недостаточно прав для совершения данной операции!', status = 403)
-            return HttpResponse('Требуется авторизация!', status = 401)
+            return _denied(permissions, raise_exception)
         return wrapped_view
-    return decorator
\ No newline at end of file
+    return decorator
@@ -0,0 +1,246 @@
+import asyncio
+import json
+import threading
+import time
+from collections import deque
+from decimal import Decimal
+
+from django.conf import settings
+from django.db import transaction
+
+
+''' Поток изменений заказов, столиков и оплат для кухни и зала '''
+
+
+# Поля, которые попадают в событие: компактный срез строки без вложенных объектов
+EVENT_FIELDS = {
+    'order': ('id', 'table_id', 'status_id', 'totalAmount'),
+    'order_item': ('id', 'order_id', 'menu_id', 'quantity', 'price'),
+    'table': ('id', 'number', 'status_id'),
+    'payment': ('id', 'order_id', 'status'),
+}
+
+
+def _value(value):
+    return float(value) if isinstance(value, Decimal) else value
+
+
+class Subscription:
+    ''' Подписчик SSE с ограниченным буфером, ожидающий события в своём цикле asyncio.
+
+    Если подписчик не успевает читать и буфер переполняется, старые события
+    вытесняются, а следующее чтение вернёт признак reset - клиенту нужно
+    перечитать состояние целиком через обычные эндпоинты.
+    '''
+
+    def __init__(self, broker, size: int, loop, types = None):
+        self.broker = broker
+        self.types = types
+        self.overflowed = False
+        self._events = deque(maxlen = size)
+        self._loop = loop
+        self._ready = asyncio.Event()
+
+    def push(self, event):
+        if self.types is not None and event['type'] not in self.types:
+            return
+        if len(self._events) == self._events.maxlen:
+            self.overflowed = True
+        self._events.append(event)
+        self._loop.call_soon_threadsafe(self._ready.set)
+
+    def drain(self):
+        ''' Возвращает (события, reset) и очищает буфер '''
+        events, reset = [], self.overflowed
+        self.overflowed = False
+        while self._events:
+            events.append(self._events.popleft())
+        self._ready.clear()
+        return events, reset
+
+    async def wait(self, timeout: float) -> bool:
+        if self._events:
+            return True
+        try:
+            await asyncio.wait_for(self._ready.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        return True
+
+    def close(self):
+        self.broker.unsubscribe(self)
+
+
+class EventBroker:
+    ''' Рассылка событий внутри процесса.
+
+    Каждое событие получает возрастающий номер seq и попадает в кольцевой буфер
+    истории (для long-polling и Last-Event-ID) и в буферы подписчиков SSE.
+    Брокер живёт в памяти процесса: события видят клиенты того воркера,
+    в котором произошло изменение.
+    '''
+
+    def __init__(self, history: int = 1000, buffer: int = 256):
+        self.buffer = buffer
+        self.seq = 0
+        self._history = deque(maxlen = history)
+        self._subscribers = set()
+        self._condition = threading.Condition()
+
+    def publish(self, type: str, **data) -> dict:
+        with self._condition:
+            self.seq += 1
+            event = { 'seq': self.seq, 'type': type, 'ts': round(time.time(), 3), **data }
+            self._history.append(event)
+            subscribers = list(self._subscribers)
+            self._condition.notify_all()
+        for subscription in subscribers:
+            try:
+                subscription.push(event)
+            except RuntimeError:
+                # цикл событий подписчика уже закрыт
+                self.unsubscribe(subscription)
+        return event
+
+    def since(self, seq: int, types = None):
+        ''' События после seq из истории: (события, reset, последний seq).
+
+        reset означает, что часть событий после seq уже вытеснена из истории
+        (или seq выдан до перезапуска процесса).
+        '''
+        with self._condition:
+            history = list(self._history)
+            last = self.seq
+        if seq > last:
+            return [], True, last
+        reset = seq < last and (not history or history[0]['seq'] > seq + 1)
+        events = [event for event in history if event['seq'] > seq and (types is None or event['type'] in types)]
+        return events, reset, last
+
+    def wait(self, seq: int, timeout: float) -> bool:
+        ''' Ждёт в текущем потоке, пока не появится событие после seq '''
+        with self._condition:
+            return self._condition.wait_for(lambda: self.seq != seq, timeout)
+
+    def subscribe(self, loop, types = None) -> Subscription:
+        subscription = Subscription(self, self.buffer, loop, types = types)
+        with self._condition:
+            self._subscribers.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self._condition:
+            self._subscribers.discard(subscription)
+
+    def stats(self):
+        return { 'seq': self.seq, 'history': len(self._history), 'subscribers': len(self._subscribers) }
+
+
+def _build_broker():
+    config = getattr(settings, 'CAFE_EVENTS', {})
+    return EventBroker(history = config.get('HISTORY', 1000), buffer = config.get('BUFFER', 256))
+
+
+def events_config():
+    ''' (интервал keepalive SSE, таймаут long-polling) в секундах '''
+    config = getattr(settings, 'CAFE_EVENTS', {})
+    return config.get('KEEPALIVE', 15), config.get('LONG_POLL_TIMEOUT', 25)
+
+
+event_broker = _build_broker()
+
+
+''' Публикация изменений после коммита '''
+
+
+def payload(type: str, instance) -> dict:
+    return { field: _value(getattr(instance, field)) for field in EVENT_FIELDS[type] }
+
+
+def publish_instance(type: str, instance, deleted: bool = False):
+    data = payload(type, instance)
+    if deleted:
+        data['deleted'] = True
+    transaction.on_commit(lambda: event_broker.publish(type, **data))
+
+
+def publish_rows(type: str, queryset):
+    ''' Публикует текущее состояние строк queryset после коммита.
+
+    Нужен там, где строки меняются без сигналов: UPDATE с F-выражениями,
+    bulk_create и bulk_update. Строки читаются одним запросом уже после коммита;
+    ошибка этого чтения только пишется в лог, так как изменение уже сохранено.
+    '''
+    def publish():
+        for row in queryset.values(*EVENT_FIELDS[type]):
+            event_broker.publish(type, **{ key: _value(value) for key, value in row.items() })
+    transaction.on_commit(publish, robust = True)
+
+
+''' Чтение событий: long-polling и SSE '''
+
+
+def parse_types(types: str):
+    if not types:
+        return None
+    return frozenset(type for type in types.split(',') if type in EVENT_FIELDS) or None
+
+
+def sse(event: dict) -> str:
+    return f'id: {event["seq"]}\nevent: {event["type"]}\ndata: {json.dumps(event, ensure_ascii = False)}\n\n'
+
+
+def poll(since: int, types = None, timeout: float = None) -> dict:
+    ''' Long-polling в потоке воркера: ждёт событий после since не дольше timeout секунд '''
+    timeout = events_config()[1] if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    events, reset, last = event_broker.since(since, types)
+    while not events and not reset:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not event_broker.wait(last, remaining):
+            break
+        events, reset, last = event_broker.since(since, types)
+    return { 'last': last, 'reset': reset, 'events': events }
+
+
+async def apoll(since: int, types = None, timeout: float = None) -> dict:
+    ''' Long-polling без занятого потока: ожидание через подписку в цикле asyncio '''
+    timeout = events_config()[1] if timeout is None else timeout
+    events, reset, last = event_broker.since(since, types)
+    if not events and not reset:
+        subscription = event_broker.subscribe(asyncio.get_running_loop(), types)
+        try:
+            events, reset, last = event_broker.since(since, types)
+            if not events and not reset and await subscription.wait(timeout):
+                events, reset, last = event_broker.since(since, types)
+        finally:
+            subscription.close()
+    return { 'last': last, 'reset': reset, 'events': events }
+
+
+async def stream(last_event_id: int = None, types = None):
+    ''' Поток Server-Sent Events: догоняет историю после Last-Event-ID и шлёт новые события '''
+    keepalive = events_config()[0]
+    subscription = event_broker.subscribe(asyncio.get_running_loop(), types)
+    try:
+        yield f'retry: {keepalive * 1000}\n\n'
+        seen = event_broker.seq
+        if last_event_id is not None:
+            events, reset, seen = event_broker.since(last_event_id, types)
+            if reset:
+                yield sse({ 'seq': seen, 'type': 'reset' })
+            for event in events:
+                yield sse(event)
+        while True:
+            if not await subscription.wait(keepalive):
+                yield ': keepalive\n\n'
+                continue
+            events, reset = subscription.drain()
+            if reset:
+                yield sse({ 'seq': seen, 'type': 'reset' })
+            for event in events:
+                if event['seq'] > seen:
+                    seen = event['seq']
+                    yield sse(event)
+    finally:
+        subscription.close()
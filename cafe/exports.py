@@ -0,0 +1,129 @@
+import csv
+import json
+from datetime import datetime, time, timedelta
+
+from django.conf import settings
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils import timezone
+
+from .models import Order, OrderItem, Payment
+
+
+''' Потоковая выгрузка заказов и оплат для бухгалтерии '''
+
+
+# (колонка, поле для values_list): плоская проекция с JOIN вместо вложенных схем
+ORDER_COLUMNS = (
+    ('order_id', 'order_id'),
+    ('created_at', 'order__created_at'),
+    ('table', 'order__table__number'),
+    ('status', 'order__status__name'),
+    ('total', 'order__totalAmount'),
+    ('item_id', 'id'),
+    ('menu', 'menu__name'),
+    ('quantity', 'quantity'),
+    ('price', 'price'),
+)
+
+PAYMENT_COLUMNS = (
+    ('payment_id', 'id'),
+    ('order_id', 'order_id'),
+    ('created_at', 'order__created_at'),
+    ('table', 'order__table__number'),
+    ('total', 'order__totalAmount'),
+    ('paid', 'status'),
+)
+
+FORMATS = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson; charset=utf-8',
+}
+
+
+def _batch_size():
+    return getattr(settings, 'CAFE_EXPORT', {}).get('BATCH_SIZE', 2000)
+
+
+def _order_batches(date_from, date_to, batch_size: int):
+    ''' id заказов за период пачками по индексу (created_at, id).
+
+    Каждая пачка - отдельный короткий запрос с условием "ключ больше последнего",
+    поэтому память не растёт даже там, где драйвер буферизует весь результат
+    запроса на клиенте (mysqlclient без серверного курсора).
+    '''
+    orders = Order.objects.order_by('created_at', 'id')
+    if date_from:
+        orders = orders.filter(created_at__gte = timezone.make_aware(datetime.combine(date_from, time.min)))
+    if date_to:
+        orders = orders.filter(created_at__lt = timezone.make_aware(datetime.combine(date_to + timedelta(days = 1), time.min)))
+
+    last = None
+    while True:
+        batch = orders
+        if last is not None:
+            batch = batch.filter(Q(created_at__gt = last[0]) | Q(created_at = last[0], id__gt = last[1]))
+        keys = list(batch.values_list('created_at', 'id')[:batch_size])
+        if keys:
+            yield [order_id for created_at, order_id in keys]
+        if len(keys) < batch_size:
+            return
+        last = keys[-1]
+
+
+def _rows(queryset, columns, date_from, date_to):
+    fields = [field for column, field in columns]
+    ordering = ('order__created_at', 'order_id', 'id')
+    batch_size = _batch_size()
+    for order_ids in _order_batches(date_from, date_to, batch_size):
+        yield queryset.filter(order_id__in = order_ids).order_by(*ordering).values_list(*fields) \
+            .iterator(chunk_size = batch_size)
+
+
+def order_rows(date_from = None, date_to = None):
+    return _rows(OrderItem.objects.all(), ORDER_COLUMNS, date_from, date_to)
+
+
+def payment_rows(date_from = None, date_to = None):
+    return _rows(Payment.objects.all(), PAYMENT_COLUMNS, date_from, date_to)
+
+
+def _value(value):
+    if isinstance(value, datetime):
+        return timezone.localtime(value).isoformat()
+    return value
+
+
+class _Echo:
+    def write(self, value):
+        return value
+
+
+def _csv(batches, columns):
+    writer = csv.writer(_Echo())
+    # BOM, чтобы Excel открывал UTF-8 без мастера импорта
+    yield '\ufeff' + writer.writerow([column for column, field in columns])
+    for rows in batches:
+        yield ''.join(writer.writerow([_value(value) for value in row]) for row in rows)
+
+
+def _ndjson(batches, columns):
+    names = [column for column, field in columns]
+    for rows in batches:
+        yield ''.join(
+            json.dumps(dict(zip(names, map(_value, row))), cls = DjangoJSONEncoder, ensure_ascii = False) + '\n'
+            for row in rows
+        )
+
+
+def export_response(batches, columns, format: str, name: str, date_from = None, date_to = None):
+    ''' StreamingHttpResponse: заголовок уходит сразу, строки - по мере чтения пачек '''
+    content = _csv(batches, columns) if format == 'csv' else _ndjson(batches, columns)
+    response = StreamingHttpResponse(content, content_type = FORMATS[format])
+    period = '_'.join(str(value) for value in (date_from, date_to) if value)
+    filename = f'{name}_{period}.{format}' if period else f'{name}.{format}'
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['Cache-Control'] = 'no-cache'
+    response['X-Accel-Buffering'] = 'no'
+    return response
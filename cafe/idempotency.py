@@ -0,0 +1,224 @@
+import asyncio
+import hashlib
+import threading
+import time
+from functools import wraps
+
+from asgiref.sync import iscoroutinefunction, sync_to_async
+from django.conf import settings
+from django.http import HttpResponse
+from django.http.response import HttpResponseBase
+from ninja.errors import HttpError
+from pydantic import TypeAdapter
+
+from .cache import LRUCache
+from .instrumentation import TimedJSONRenderer
+
+
+''' Повтор запросов записи по заголовку Idempotency-Key '''
+
+
+HEADER = 'Idempotency-Key'
+MAX_KEY_LENGTH = 255
+POLL_INTERVAL = 0.05
+
+
+class LocMemStore:
+    ''' Сохранённые ответы в памяти процесса и ожидание выполняющихся запросов через Event '''
+
+    def __init__(self, max_size: int = 10000, ttl: float = 86400):
+        self._results = LRUCache(max_size = max_size, ttl = ttl)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def result(self, key):
+        return self._results.get(key)
+
+    def claim(self, key) -> bool:
+        ''' Захватывает ключ для выполнения; False, если он уже выполняется или выполнен '''
+        with self._lock:
+            if key in self._pending or self._results.get(key) is not None:
+                return False
+            self._pending[key] = threading.Event()
+            return True
+
+    def complete(self, key, value):
+        self._results.set(key, value)
+        self.release(key)
+
+    def release(self, key):
+        with self._lock:
+            event = self._pending.pop(key, None)
+        if event is not None:
+            event.set()
+
+    def wait(self, key, timeout: float) -> bool:
+        with self._lock:
+            event = self._pending.get(key)
+        return event is None or event.wait(max(timeout, 0))
+
+
+class DjangoCacheStore:
+    ''' Ответы в кэше Django, общем для воркеров; захват ключа - атомарный cache.add '''
+
+    POLL_INTERVAL = POLL_INTERVAL
+
+    def __init__(self, alias: str = 'default', ttl: float = 86400, lock_ttl: float = 60, prefix: str = 'cafe:idempotency'):
+        from django.core.cache import caches
+        self._cache = caches[alias]
+        self.ttl = ttl
+        self.lock_ttl = lock_ttl
+        self.prefix = prefix
+
+    def result(self, key):
+        return self._cache.get(f'{self.prefix}:{key}')
+
+    def claim(self, key) -> bool:
+        return self._cache.add(f'{self.prefix}:lock:{key}', 1, self.lock_ttl)
+
+    def complete(self, key, value):
+        self._cache.set(f'{self.prefix}:{key}', value, self.ttl)
+        self.release(key)
+
+    def release(self, key):
+        self._cache.delete(f'{self.prefix}:lock:{key}')
+
+    def wait(self, key, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while self._cache.get(f'{self.prefix}:lock:{key}') is not None:
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.POLL_INTERVAL)
+        return True
+
+
+def _build_store():
+    config = getattr(settings, 'CAFE_IDEMPOTENCY', {})
+    if config.get('BACKEND', 'locmem') == 'django':
+        return DjangoCacheStore(alias = config.get('ALIAS', 'default'), ttl = config.get('TTL', 86400),
+                                lock_ttl = config.get('LOCK_TTL', 60))
+    return LocMemStore(max_size = config.get('MAX_SIZE', 10000), ttl = config.get('TTL', 86400))
+
+
+idempotency_store = _build_store()
+
+
+def _wait_timeout() -> float:
+    return getattr(settings, 'CAFE_IDEMPOTENCY', {}).get('WAIT_TIMEOUT', 10)
+
+
+def _scope(request, key: str) -> str:
+    ''' Ключ хранилища: пользователь, метод, путь и Idempotency-Key одним хэшем '''
+    user_id = getattr(request.auth, 'pk', None) if getattr(request, 'auth', None) else None
+    return hashlib.sha256(f'{user_id}:{request.method}:{request.path}:{key}'.encode()).hexdigest()
+
+
+def idempotent(response):
+    ''' Сохраняет сериализованный ответ обработчика записи под заголовком Idempotency-Key.
+
+    Повтор с тем же ключом отдаёт сохранённый ответ без обращения к моделям,
+    параллельный дубликат ждёт завершения первого запроса (до WAIT_TIMEOUT секунд).
+    Ответ сохраняется только при успехе: после ошибки запрос можно повторить.
+    Тот же ключ с другим телом запроса отклоняется с 422. Без заголовка
+    обработчик выполняется как обычно. Для async обработчиков обращения к хранилищу
+    идут через sync_to_async, а дубликат опрашивает хранилище, не блокируя цикл событий.
+    '''
+    adapter = TypeAdapter(response)
+    renderer = TimedJSONRenderer()
+    content_type = renderer.media_type + '; charset=' + renderer.charset
+
+    def replay(stored, fingerprint: str):
+        stored_fingerprint, status, content = stored
+        if stored_fingerprint != fingerprint:
+            raise HttpError(422, 'Idempotency-Key уже использован для другого запроса!')
+        replayed = HttpResponse(content, status = status, content_type = content_type)
+        replayed['Idempotent-Replayed'] = 'true'
+        return replayed
+
+    def key_of(request):
+        key = request.headers.get(HEADER)
+        if key and len(key) > MAX_KEY_LENGTH:
+            raise HttpError(400, 'Неккоректный запрос!')
+        return key
+
+    def serialize(request, result):
+        status = 200
+        if isinstance(result, tuple) and len(result) == 2:
+            status, result = result
+        data = adapter.dump_python(adapter.validate_python(result, from_attributes = True))
+        return status, renderer.render(request, data, response_status = status)
+
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapped_view(request, *args, **kwargs):
+                key = key_of(request)
+                if not key:
+                    return await view_func(request, *args, **kwargs)
+
+                scope = _scope(request, key)
+                fingerprint = hashlib.sha256(request.body).hexdigest()
+                deadline = time.monotonic() + _wait_timeout()
+                while True:
+                    stored = await sync_to_async(idempotency_store.result)(scope)
+                    if stored is not None:
+                        return replay(stored, fingerprint)
+                    if await sync_to_async(idempotency_store.claim)(scope):
+                        stored = await sync_to_async(idempotency_store.result)(scope)
+                        if stored is not None:
+                            await sync_to_async(idempotency_store.release)(scope)
+                            return replay(stored, fingerprint)
+                        break
+                    if time.monotonic() >= deadline:
+                        raise HttpError(409, 'Запрос с этим Idempotency-Key ещё выполняется!')
+                    await asyncio.sleep(POLL_INTERVAL)
+
+                try:
+                    result = await view_func(request, *args, **kwargs)
+                    if isinstance(result, HttpResponseBase):
+                        await sync_to_async(idempotency_store.release)(scope)
+                        return result
+                    status, content = serialize(request, result)
+                except BaseException:
+                    await sync_to_async(idempotency_store.release)(scope)
+                    raise
+                await sync_to_async(idempotency_store.complete)(scope, (fingerprint, status, content))
+                return HttpResponse(content, status = status, content_type = content_type)
+            return async_wrapped_view
+
+        @wraps(view_func)
+        def wrapped_view(request, *args, **kwargs):
+            key = key_of(request)
+            if not key:
+                return view_func(request, *args, **kwargs)
+
+            scope = _scope(request, key)
+            fingerprint = hashlib.sha256(request.body).hexdigest()
+            deadline = time.monotonic() + _wait_timeout()
+            while True:
+                stored = idempotency_store.result(scope)
+                if stored is not None:
+                    return replay(stored, fingerprint)
+                if idempotency_store.claim(scope):
+                    # первый запрос мог завершиться между чтением результата и захватом
+                    stored = idempotency_store.result(scope)
+                    if stored is not None:
+                        idempotency_store.release(scope)
+                        return replay(stored, fingerprint)
+                    break
+                if not idempotency_store.wait(scope, deadline - time.monotonic()):
+                    raise HttpError(409, 'Запрос с этим Idempotency-Key ещё выполняется!')
+
+            try:
+                result = view_func(request, *args, **kwargs)
+                if isinstance(result, HttpResponseBase):
+                    idempotency_store.release(scope)
+                    return result
+                status, content = serialize(request, result)
+            except BaseException:
+                idempotency_store.release(scope)
+                raise
+            idempotency_store.complete(scope, (fingerprint, status, content))
+            return HttpResponse(content, status = status, content_type = content_type)
+        return wrapped_view
+    return decorator
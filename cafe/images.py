@@ -0,0 +1,136 @@
+import hashlib
+import os
+import tempfile
+import threading
+from pathlib import Path
+
+from django.conf import settings
+from PIL import Image, ImageOps
+
+
+''' Уменьшенные копии изображений позиций меню '''
+
+
+FORMATS = {
+    'webp': ('WEBP', 'image/webp'),
+    'jpeg': ('JPEG', 'image/jpeg'),
+}
+
+
+class VariantCache:
+    ''' Дисковый кэш уменьшенных копий с ограничением по суммарному размеру.
+
+    При переполнении удаляются давно не запрашивавшиеся файлы (mtime обновляется
+    при каждом попадании). Одновременные запросы одной и той же копии ждут
+    первого и не рендерят её повторно.
+    '''
+
+    def __init__(self, directory, max_bytes: int, quality: int = 80):
+        self.directory = Path(directory)
+        self.max_bytes = max_bytes
+        self.quality = quality
+        self._size = None
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def _scan(self):
+        self.directory.mkdir(parents = True, exist_ok = True)
+        return sum(entry.stat().st_size for entry in os.scandir(self.directory) if entry.is_file())
+
+    def _path(self, image_name: str, width: int, format: str) -> Path:
+        digest = hashlib.sha1(image_name.encode()).hexdigest()[:16]
+        return self.directory / f'{digest}-{width}.{format}'
+
+    def get(self, image_field, width: int, format: str) -> Path:
+        path = self._path(image_field.name, width, format)
+        if self._touch(path):
+            return path
+
+        with self._lock:
+            render_lock = self._inflight.setdefault(path, threading.Lock())
+        with render_lock:
+            try:
+                if not self._touch(path):
+                    self._render(image_field, path, width, format)
+            finally:
+                with self._lock:
+                    self._inflight.pop(path, None)
+        return path
+
+    def open(self, image_field, width: int, format: str, attempts: int = 3):
+        ''' Открывает копию на чтение. Открытый файл переживает вытеснение, а копия,
+        вытесненная другим потоком или процессом до открытия, рендерится заново.
+        '''
+        for attempt in range(attempts):
+            try:
+                return open(self.get(image_field, width, format), 'rb')
+            except FileNotFoundError:
+                if attempt == attempts - 1:
+                    raise
+
+    def _touch(self, path: Path) -> bool:
+        ''' Обновляет mtime найденной копии; False, если копии нет или её уже вытеснили '''
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def _render(self, image_field, path: Path, width: int, format: str):
+        pil_format = FORMATS[format][0]
+        with image_field.open('rb') as source, Image.open(source) as image:
+            image = ImageOps.exif_transpose(image)
+            if image.width > width:
+                image.thumbnail((width, image.height * width // image.width + 1), Image.Resampling.LANCZOS)
+            if pil_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+
+            if self._size is None:
+                self._size = self._scan()
+            descriptor, temp_name = tempfile.mkstemp(dir = self.directory, suffix = '.tmp')
+            try:
+                with os.fdopen(descriptor, 'wb') as target:
+                    image.save(target, pil_format, quality = self.quality)
+                os.replace(temp_name, path)
+            except BaseException:
+                os.unlink(temp_name)
+                raise
+
+        with self._lock:
+            self._size += path.stat().st_size
+            if self._size > self.max_bytes:
+                self._evict(keep = path)
+
+    def _evict(self, keep: Path):
+        entries = sorted(
+            (entry for entry in os.scandir(self.directory)
+             if entry.is_file() and not entry.name.endswith('.tmp') and entry.path != str(keep)),
+            key = lambda entry: entry.stat().st_mtime,
+        )
+        size = sum(entry.stat().st_size for entry in entries) + keep.stat().st_size
+        target = self.max_bytes * 0.9
+        for entry in entries:
+            if size <= target:
+                break
+            try:
+                size -= entry.stat().st_size
+                os.unlink(entry.path)
+            except FileNotFoundError:
+                pass
+        self._size = size
+
+
+def _build_variant_cache():
+    config = getattr(settings, 'CAFE_IMAGE_VARIANTS', {})
+    return VariantCache(
+        directory = config.get('DIR', Path(settings.BASE_DIR) / 'cache' / 'variants'),
+        max_bytes = config.get('MAX_BYTES', 256 * 1024 * 1024),
+        quality = config.get('QUALITY', 80),
+    )
+
+
+def allowed_widths():
+    return getattr(settings, 'CAFE_IMAGE_VARIANTS', {}).get('WIDTHS', [160, 320, 640, 1280])
+
+
+variant_cache = _build_variant_cache()
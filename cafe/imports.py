@@ -0,0 +1,146 @@
+import csv
+import io
+import json
+
+from django.db import connection, transaction
+from pydantic import ValidationError
+
+from .cache import bump_version
+from .models import Category, Menu
+from .schemas import MenuImportRow
+from .search import NAMESPACE as SEARCH_NAMESPACE, search_index
+
+
+''' Массовый импорт позиций меню и прайс-листов '''
+
+
+MENU_FIELDS = ('name', 'price', 'weight', 'capacity', 'description')
+
+
+def _provided(row) -> set:
+    ''' Поля позиции меню, заданные в строке: пустые ячейки CSV и null значение не меняют '''
+    return { field for field in MENU_FIELDS if getattr(row, field) is not None }
+
+
+class ImportFormatError(Exception):
+    pass
+
+
+def parse_rows(content: bytes, format: str) -> list:
+    ''' Разбирает CSV (разделитель , или ;) или JSON (список объектов или {"rows": [...]}) '''
+    try:
+        text = content.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        raise ImportFormatError('Файл должен быть в кодировке UTF-8!')
+
+    if format == 'json':
+        try:
+            data = json.loads(text)
+        except ValueError:
+            raise ImportFormatError('Некорректный JSON!')
+        rows = data.get('rows') if isinstance(data, dict) else data
+        if not isinstance(rows, list):
+            raise ImportFormatError('Ожидается список позиций меню!')
+        return rows
+
+    if format == 'csv':
+        try:
+            dialect = csv.Sniffer().sniff(text[:4096], delimiters = ',;')
+        except csv.Error:
+            dialect = csv.excel
+        return [
+            { key.strip(): (value.strip() or None) if isinstance(value, str) else value for key, value in row.items() if key }
+            for row in csv.DictReader(io.StringIO(text), dialect = dialect)
+        ]
+
+    raise ImportFormatError('Поддерживаются форматы csv и json!')
+
+
+def _errors(error: ValidationError) -> list:
+    return [f'{".".join(str(part) for part in item["loc"]) or "row"}: {item["msg"]}' for item in error.errors()]
+
+
+def _upsert_categories(names: dict):
+    ''' Создаёт категории или обновляет их названия одним INSERT ... ON CONFLICT/ON DUPLICATE KEY '''
+    if not names:
+        return
+    # MySQL не позволяет указывать unique_fields - конфликт определяется любым уникальным ключом
+    unique_fields = ['slug'] if connection.features.supports_update_conflicts_with_target else None
+    Category.objects.bulk_create(
+        [Category(slug = slug, name = name) for slug, name in names.items()],
+        update_conflicts = True, unique_fields = unique_fields, update_fields = ['name'],
+    )
+
+
+def import_menu(raw_rows: list, dry_run: bool = False) -> dict:
+    ''' Создаёт и обновляет позиции меню по slug одной транзакцией.
+
+    Строка обновляет только переданные поля, новая позиция требует name,
+    category и price. Категория указывается slug-ом и создаётся, если передан
+    category_name. При любой ошибке в строках ничего не записывается, отчёт
+    содержит ошибки по номерам строк. Версия кэша меню сдвигается один раз.
+    '''
+    report = { 'created': 0, 'updated': 0, 'categories': 0, 'errors': [], 'dry_run': dry_run }
+    rows, seen = [], set()
+    for number, raw in enumerate(raw_rows, start = 1):
+        try:
+            row = MenuImportRow.model_validate(raw)
+        except ValidationError as error:
+            report['errors'].append({ 'row': number, 'slug': raw.get('slug') if isinstance(raw, dict) else None, 'errors': _errors(error) })
+            continue
+        if row.slug in seen:
+            report['errors'].append({ 'row': number, 'slug': row.slug, 'errors': ['slug: повторяется в файле'] })
+            continue
+        seen.add(row.slug)
+        rows.append((number, row))
+
+    category_names = { row.category: row.category_name for number, row in rows if row.category and row.category_name }
+    category_slugs = { row.category for number, row in rows if row.category }
+    category_ids = dict(Category.objects.filter(slug__in = category_slugs).values_list('slug', 'id'))
+    report['categories'] = len(category_names)
+
+    fields = sorted(set().union(*(_provided(row) for number, row in rows)))
+    if any(row.category for number, row in rows):
+        fields.append('category')
+    existing = {}
+    for menu in Menu.objects.filter(slug__in = [row.slug for number, row in rows]).only('id', 'slug', *fields).order_by('id'):
+        existing.setdefault(menu.slug, menu)
+
+    to_update, to_create = [], []
+    for number, row in rows:
+        errors = []
+        if row.category and row.category not in category_ids and row.category not in category_names:
+            errors.append(f'category: категория "{row.category}" не найдена')
+        menu = existing.get(row.slug)
+        if menu is None:
+            errors += [f'{field}: обязательно для новой позиции' for field in ('name', 'category', 'price') if getattr(row, field) is None]
+        if errors:
+            report['errors'].append({ 'row': number, 'slug': row.slug, 'errors': errors })
+            continue
+        if menu is None:
+            menu = Menu(slug = row.slug)
+            to_create.append((menu, row))
+        else:
+            to_update.append((menu, row))
+        for field in _provided(row):
+            setattr(menu, field, getattr(row, field))
+
+    report['created'], report['updated'] = len(to_create), len(to_update)
+    report['errors'].sort(key = lambda error: error['row'])
+    if report['errors'] or dry_run:
+        return report
+
+    with transaction.atomic():
+        _upsert_categories(category_names)
+        if category_names:
+            category_ids = dict(Category.objects.filter(slug__in = category_slugs).values_list('slug', 'id'))
+        for menu, row in to_update + to_create:
+            if row.category:
+                menu.category_id = category_ids[row.category]
+        if fields:
+            Menu.objects.bulk_update([menu for menu, row in to_update], fields, batch_size = 500)
+        Menu.objects.bulk_create([menu for menu, row in to_create], batch_size = 500)
+        bump_version('menu')
+        bump_version(SEARCH_NAMESPACE)
+        transaction.on_commit(search_index.rebuild)
+    return report
@@ -0,0 +1,138 @@
+import heapq
+import json
+import logging
+import time
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.signals import connection_created
+from ninja.renderers import JSONRenderer
+
+
+''' Замеры SQL и времени обработки запросов API '''
+
+
+logger = logging.getLogger('cafe.instrumentation')
+
+_current = ContextVar('cafe_request_metrics', default = None)
+
+
+def instrumentation_config() -> dict:
+    config = getattr(settings, 'CAFE_INSTRUMENTATION', {})
+    return {
+        'ENABLED': config.get('ENABLED', False),
+        'SERVER_TIMING': config.get('SERVER_TIMING', False),
+        'SLOW_REQUEST_MS': config.get('SLOW_REQUEST_MS', 500),
+        'SLOW_QUERY_COUNT': config.get('SLOW_QUERY_COUNT', 50),
+        'SLOWEST': config.get('SLOWEST', 5),
+        'SQL_MAX_LENGTH': config.get('SQL_MAX_LENGTH', 500),
+    }
+
+
+class RequestMetrics:
+    ''' Счётчики одного запроса: число и суммарное время SQL, самые медленные
+    запросы (не более slowest) и время сериализации ответа '''
+
+    def __init__(self, slowest: int = 5):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_time = 0.0
+        self.serialize_time = 0.0
+        self._slowest = []
+        self._limit = slowest
+
+    def add_query(self, sql: str, duration: float):
+        self.queries += 1
+        self.db_time += duration
+        if len(self._slowest) < self._limit:
+            heapq.heappush(self._slowest, (duration, sql))
+        elif self._slowest and duration > self._slowest[0][0]:
+            heapq.heapreplace(self._slowest, (duration, sql))
+
+    def slowest(self) -> list:
+        return sorted(self._slowest, reverse = True)
+
+    def total_time(self) -> float:
+        return time.perf_counter() - self.started
+
+
+def _record(execute, sql, params, many, context):
+    ''' execute_wrapper: замеряет запрос, если он выполняется в рамках измеряемого запроса API '''
+    metrics = _current.get()
+    if metrics is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        metrics.add_query(sql, time.perf_counter() - started)
+
+
+def _install(connection, **kwargs):
+    if _record not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_record)
+
+
+def install():
+    ''' Подключает замер SQL ко всем соединениям процесса, в том числе будущим.
+
+    Обёртка ставится один раз на соединение и хранит данные в ContextVar, поэтому
+    видит и запросы из sync_to_async, которые выполняются в другом потоке.
+    '''
+    connection_created.connect(_install, dispatch_uid = 'cafe_instrumentation')
+    for connection in connections.all(initialized_only = True):
+        _install(connection)
+
+
+def start(slowest: int = 5):
+    metrics = RequestMetrics(slowest)
+    return metrics, _current.set(metrics)
+
+
+def finish(token):
+    _current.reset(token)
+
+
+class TimedJSONRenderer(JSONRenderer):
+    ''' JSONRenderer, добавляющий время рендеринга ответа в замеры текущего запроса '''
+
+    def render(self, request, data, *, response_status):
+        metrics = _current.get()
+        if metrics is None:
+            return super().render(request, data, response_status = response_status)
+        started = time.perf_counter()
+        try:
+            return super().render(request, data, response_status = response_status)
+        finally:
+            metrics.serialize_time += time.perf_counter() - started
+
+
+def server_timing(metrics: RequestMetrics, total: float) -> str:
+    return ', '.join((
+        f'db;dur={metrics.db_time * 1000:.2f};desc="{metrics.queries} queries"',
+        f'serialize;dur={metrics.serialize_time * 1000:.2f}',
+        f'total;dur={total * 1000:.2f}',
+    ))
+
+
+def log_slow(request, response, metrics: RequestMetrics, total: float, config: dict):
+    ''' Пишет структурированную запись, если запрос превысил порог по времени или числу SQL '''
+    if total * 1000 < config['SLOW_REQUEST_MS'] and metrics.queries < config['SLOW_QUERY_COUNT']:
+        return
+    match = getattr(request, 'resolver_match', None)
+    record = {
+        'method': request.method,
+        'path': request.path,
+        'route': match.route if match is not None else None,
+        'status': response.status_code,
+        'total_ms': round(total * 1000, 2),
+        'db_ms': round(metrics.db_time * 1000, 2),
+        'serialize_ms': round(metrics.serialize_time * 1000, 2),
+        'queries': metrics.queries,
+        'slowest': [
+            { 'ms': round(duration * 1000, 2), 'sql': sql[:config['SQL_MAX_LENGTH']] }
+            for duration, sql in metrics.slowest()
+        ],
+    }
+    logger.warning('slow request %s', json.dumps(record, ensure_ascii = False), extra = { 'request_metrics': record })
@@ -0,0 +1,92 @@
+import argparse
+import json
+import platform
+
+import django
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test.utils import setup_databases, setup_test_environment, teardown_databases, teardown_test_environment
+
+from cafe.auth import credential_cache
+from cafe.benchmark import MIX, async_mix, dataset, plan, run_client, run_live, seed
+from cafe.models import Order
+from cafe.throttling import request_throttle
+
+
+class Command(BaseCommand):
+    help = ('Нагрузочный прогон API на синтетических данных во временной тестовой базе: '
+            'латентность p50/p95/p99, пропускная способность и число SQL-запросов по эндпоинтам в JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices = ['client', 'live', 'both'], default = 'both',
+                            help = 'client - тестовый клиент Django, live - локальный HTTP-сервер с параллельными клиентами')
+        parser.add_argument('--router', choices = ['sync', 'async'], default = 'sync',
+                            help = 'async - те же сценарии через /api/async/; сервер в режиме live остаётся WSGI, '
+                                   'сравнение uvicorn с WSGI делается отдельным прогоном против развёрнутых серверов')
+        parser.add_argument('--requests', type = int, default = 2000, help = 'Число запросов в прогоне')
+        parser.add_argument('--warmup', type = int, default = 100, help = 'Запросы прогрева, не попадающие в статистику')
+        parser.add_argument('--concurrency', type = int, default = 8, help = 'Параллельных клиентов в режиме live')
+        parser.add_argument('--tables', type = int, default = 300)
+        parser.add_argument('--categories', type = int, default = 40)
+        parser.add_argument('--menu', type = int, default = 3000)
+        parser.add_argument('--orders', type = int, default = 100000)
+        parser.add_argument('--seed', type = int, default = 1, help = 'Зерно генератора данных и последовательности запросов')
+        parser.add_argument('--auth-cache', action = argparse.BooleanOptionalAction, default = True,
+                            help = 'Кэшировать проверенные пароли (CAFE_AUTH_CACHE): без кэша каждый запрос тратит время на PBKDF2')
+        parser.add_argument('--throttle', action = argparse.BooleanOptionalAction, default = False,
+                            help = 'Ограничение частоты запросов (CAFE_THROTTLE): весь прогон идёт от одного пользователя')
+        parser.add_argument('--keepdb', action = 'store_true', help = 'Не удалять тестовую базу и не загружать данные повторно')
+        parser.add_argument('--output', help = 'Файл для JSON-отчёта, по умолчанию - stdout')
+
+    def handle(self, *args, **options):
+        auth_cache = credential_cache.enabled
+        credential_cache.enabled = options['auth_cache']
+        throttle = request_throttle.enabled
+        request_throttle.enabled = throttle and options['throttle']
+        setup_test_environment(debug = False)
+        old_config = setup_databases(verbosity = 0, interactive = False, keepdb = options['keepdb'])
+        try:
+            if options['keepdb'] and Order.objects.exists():
+                data = dataset()
+            else:
+                self.stderr.write('Загрузка данных...')
+                data = seed(
+                    tables = options['tables'], categories = options['categories'], menu = options['menu'],
+                    orders = options['orders'], seed = options['seed'], stdout = self.stderr,
+                )
+            mix = async_mix() if options['router'] == 'async' else MIX
+            requests = plan(data, options['warmup'] + options['requests'], seed = options['seed'], mix = mix)
+
+            report = {
+                'environment': {
+                    'python': platform.python_version(),
+                    'django': django.get_version(),
+                    'database': connection.vendor,
+                },
+                'options': { key: options[key] for key in ('router', 'requests', 'warmup', 'concurrency', 'seed', 'auth_cache', 'throttle') },
+                'dataset': {
+                    'tables': data['tables'],
+                    'categories': len(data['categories']),
+                    'menu': data['menu'][1] - data['menu'][0] + 1,
+                    'orders': data['orders'][1] - data['orders'][0] + 1,
+                },
+            }
+            if options['mode'] in ('client', 'both'):
+                self.stderr.write('Прогон через тестовый клиент...')
+                report['client'] = run_client(requests, warmup = options['warmup'])
+            if options['mode'] in ('live', 'both'):
+                self.stderr.write(f'Прогон через HTTP-сервер, клиентов: {options["concurrency"]}...')
+                report['live'] = run_live(requests, concurrency = options['concurrency'], warmup = options['warmup'])
+        finally:
+            teardown_databases(old_config, verbosity = 0, keepdb = options['keepdb'])
+            teardown_test_environment()
+            credential_cache.enabled = auth_cache
+            request_throttle.enabled = throttle
+
+        output = json.dumps(report, ensure_ascii = False, indent = 2)
+        if options['output']:
+            with open(options['output'], 'w', encoding = 'utf-8') as file:
+                file.write(output + '\n')
+            self.stderr.write(self.style.SUCCESS(f'Отчёт записан в {options["output"]}'))
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,29 @@
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from cafe.imports import ImportFormatError, import_menu, parse_rows
+
+
+class Command(BaseCommand):
+    help = 'Импортирует позиции меню и прайс-лист из CSV или JSON файла (upsert по slug)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help = 'Путь к файлу .csv или .json')
+        parser.add_argument('--format', choices = ['csv', 'json'], help = 'Формат файла, по умолчанию - по расширению')
+        parser.add_argument('--dry-run', action = 'store_true', help = 'Только проверить файл, ничего не меняя')
+
+    def handle(self, *args, **options):
+        path = Path(options['path'])
+        format = options['format'] or path.suffix.lstrip('.').lower()
+        try:
+            report = import_menu(parse_rows(path.read_bytes(), format), dry_run = options['dry_run'])
+        except (OSError, ImportFormatError) as error:
+            raise CommandError(str(error))
+
+        for error in report['errors']:
+            self.stderr.write(f'Строка {error["row"]} ({error["slug"]}): {"; ".join(error["errors"])}')
+        if report['errors']:
+            raise CommandError(f'Ошибок в строках: {len(report["errors"])}, ничего не изменено')
+        message = f'Создано позиций: {report["created"]}, обновлено: {report["updated"]}, категорий: {report["categories"]}'
+        self.stdout.write(self.style.SUCCESS(('Проверка: ' if report['dry_run'] else '') + message))
@@ -0,0 +1,17 @@
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from cafe.reports import rebuild
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает дневные агрегаты продаж по позициям меню и столикам из оплаченных заказов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--date-from', type = date.fromisoformat, help = 'Начало периода (ГГГГ-ММ-ДД), по умолчанию - вся история')
+        parser.add_argument('--date-to', type = date.fromisoformat, help = 'Конец периода (ГГГГ-ММ-ДД) включительно')
+
+    def handle(self, *args, **options):
+        menu_rows, table_rows = rebuild(options['date_from'], options['date_to'])
+        self.stdout.write(self.style.SUCCESS(f'Строк по позициям меню: {menu_rows}, по столикам: {table_rows}'))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from cafe.models import Order
+
+
+class Command(BaseCommand):
+    help = 'Пересчитывает итоговую стоимость заказов по позициям заказа на стороне БД'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--check', action = 'store_true', help = 'Только найти заказы с неверной суммой, ничего не меняя')
+
+    def handle(self, *args, **options):
+        wrong = Order.objects.with_wrong_total()
+        if options['check']:
+            for order_id, total, items_total in wrong.values_list('id', 'totalAmount', 'items_total'):
+                self.stdout.write(f'Заказ №{order_id}: {total} вместо {items_total}')
+            self.stdout.write(f'Заказов с неверной суммой: {wrong.count()}')
+            return
+        updated = Order.objects.filter(pk__in = list(wrong.values_list('id', flat = True))).recalculate_totals()
+        self.stdout.write(self.style.SUCCESS(f'Пересчитано заказов: {updated}'))
@@ -0,0 +1,387 @@
+import atexit
+import glob
+import json
+import os
+import threading
+import time
+import weakref
+from bisect import bisect_left
+from contextlib import contextmanager
+
+from django.conf import settings
+
+
+''' Метрики API в текстовом формате Prometheus '''
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+# имя -> (тип, описание)
+METRICS = {
+    'cafe_http_requests_total': ('counter', 'Обработанные запросы по маршруту, методу и статусу'),
+    'cafe_http_request_duration_seconds': ('histogram', 'Время обработки запроса по маршруту и методу'),
+    'cafe_http_requests_in_flight': ('gauge', 'Запросы, обрабатываемые в данный момент'),
+    'cafe_auth_failures_total': ('counter', 'Неудачные попытки авторизации BasicAuth'),
+    'cafe_permission_denied_total': ('counter', 'Отказы check_permission по набору прав'),
+    'cafe_throttled_total': ('counter', 'Запросы, отклонённые ограничением частоты, по бюджету'),
+    'cafe_db_pool_connections': ('gauge', 'Соединения пула по алиасу базы и состоянию (open, idle, in_use)'),
+    'cafe_db_pool_max_size': ('gauge', 'Предельное число открытых соединений пула'),
+    'cafe_db_pool_events_total': ('counter', 'События пула: created, reused, expired, failed_ping, discarded, waits, timeouts'),
+    'cafe_cache_entries': ('gauge', 'Записей в кэшах процесса: credentials, permissions, responses'),
+    'cafe_cache_lookups_total': ('counter', 'Обращения к кэшам процесса по результату (hit, miss)'),
+}
+
+
+def metrics_config() -> dict:
+    config = getattr(settings, 'CAFE_METRICS', {})
+    return {
+        'ENABLED': config.get('ENABLED', False),
+        'BUCKETS': tuple(config.get('BUCKETS', DEFAULT_BUCKETS)),
+        'MULTIPROCESS_DIR': config.get('MULTIPROCESS_DIR'),
+        'FLUSH_INTERVAL': config.get('FLUSH_INTERVAL', 5),
+        'TOKEN': config.get('TOKEN'),
+    }
+
+
+class _Shard:
+    ''' Значения, накопленные одним потоком: пишет в них только он сам '''
+
+    def __init__(self):
+        self.counters = {}
+        self.gauges = {}
+        self.histograms = {}
+
+
+class MetricsRegistry:
+    ''' Счётчики, гистограммы и gauge-и процесса без блокировок на горячем пути.
+
+    Каждый поток пишет в собственный шард, общий lock берётся только при
+    регистрации нового потока и при сборе. Шарды завершившихся потоков при
+    сборе сливаются в общий остаток, чтобы их список не рос.
+    '''
+
+    def __init__(self, buckets = DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.pid = os.getpid()
+        self._local = threading.local()
+        self._shards = []
+        self._retired = _Shard()
+        self._lock = threading.Lock()
+
+    def _shard(self) -> _Shard:
+        shard = getattr(self._local, 'shard', None)
+        if shard is None or self.pid != os.getpid():
+            shard = self._local.shard = _Shard()
+            with self._lock:
+                if self.pid != os.getpid():
+                    # после fork значения родителя не должны попасть в метрики воркера
+                    self.pid = os.getpid()
+                    self._shards, self._retired = [], _Shard()
+                self._shards.append((weakref.ref(threading.current_thread()), shard))
+        return shard
+
+    def inc(self, name: str, value: float = 1, **labels):
+        counters = self._shard().counters
+        key = (name, tuple(sorted(labels.items())))
+        counters[key] = counters.get(key, 0) + value
+
+    def add(self, name: str, value: float, **labels):
+        gauges = self._shard().gauges
+        key = (name, tuple(sorted(labels.items())))
+        gauges[key] = gauges.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels):
+        histograms = self._shard().histograms
+        key = (name, tuple(sorted(labels.items())))
+        values = histograms.get(key)
+        if values is None:
+            # счётчики по корзинам (последняя - +Inf), сумма и количество
+            values = histograms[key] = [0] * (len(self.buckets) + 3)
+        values[bisect_left(self.buckets, value)] += 1
+        values[-2] += value
+        values[-1] += 1
+
+    def snapshot(self) -> dict:
+        ''' Сумма всех шардов: { 'counters': ..., 'gauges': ..., 'histograms': ... } '''
+        with self._lock:
+            alive = []
+            for thread, shard in self._shards:
+                if thread() is None or not thread().is_alive():
+                    _merge(self._retired, _copy(shard))
+                else:
+                    alive.append((thread, shard))
+            self._shards = alive
+            total = _copy(self._retired)
+            shards = [shard for thread, shard in alive]
+        for shard in shards:
+            _merge(total, _copy(shard))
+        return { 'counters': total.counters, 'gauges': total.gauges, 'histograms': total.histograms }
+
+
+def _copy(shard: _Shard) -> _Shard:
+    copy = _Shard()
+    copy.counters = dict(shard.counters)
+    copy.gauges = dict(shard.gauges)
+    copy.histograms = { key: list(values) for key, values in list(shard.histograms.items()) }
+    return copy
+
+
+def _merge(target: _Shard, source: _Shard):
+    for key, value in source.counters.items():
+        target.counters[key] = target.counters.get(key, 0) + value
+    for key, value in source.gauges.items():
+        target.gauges[key] = target.gauges.get(key, 0) + value
+    for key, values in source.histograms.items():
+        current = target.histograms.get(key)
+        target.histograms[key] = list(values) if current is None else [a + b for a, b in zip(current, values)]
+
+
+registry = MetricsRegistry(metrics_config()['BUCKETS'])
+
+
+def _state() -> tuple:
+    ''' Счётчики и gauge-и, которые модули процесса ведут сами: читаются в момент сбора '''
+    from .auth import credential_cache
+    from .cache import cache_backend
+    from .db.pool import pool_stats
+    from .permissions import permission_index
+
+    counters, gauges = {}, {}
+    for alias, stats in pool_stats().items():
+        for state in ('open', 'idle', 'in_use'):
+            gauges[('cafe_db_pool_connections', (('alias', alias), ('state', state)))] = stats[state]
+        if stats['max_size'] is not None:
+            gauges[('cafe_db_pool_max_size', (('alias', alias), ))] = stats['max_size']
+        for event in ('created', 'reused', 'expired', 'failed_ping', 'discarded', 'waits', 'timeouts'):
+            counters[('cafe_db_pool_events_total', (('alias', alias), ('event', event)))] = stats[event]
+    for name, cache in (('credentials', credential_cache), ('permissions', permission_index), ('responses', cache_backend)):
+        stats = cache.stats()
+        # кэш ответов в CACHES Django статистики не ведёт
+        if not stats:
+            continue
+        gauges[('cafe_cache_entries', (('cache', name), ))] = stats['size']
+        counters[('cafe_cache_lookups_total', (('cache', name), ('result', 'hit')))] = stats['hits']
+        counters[('cafe_cache_lookups_total', (('cache', name), ('result', 'miss')))] = stats['misses']
+    return counters, gauges
+
+
+def process_snapshot() -> dict:
+    ''' Снимок реестра процесса вместе с состоянием пулов соединений и кэшей '''
+    snapshot = registry.snapshot()
+    counters, gauges = _state()
+    snapshot['counters'].update(counters)
+    snapshot['gauges'].update(gauges)
+    return snapshot
+
+
+def auth_failed(reason: str):
+    registry.inc('cafe_auth_failures_total', reason = reason)
+
+
+def permission_denied(permissions):
+    registry.inc('cafe_permission_denied_total', permission = ','.join(sorted(permissions)))
+
+
+''' Режим нескольких процессов (gunicorn): снимки воркеров в общем каталоге '''
+
+
+class _Flusher:
+    ''' Периодически сохраняет снимок процесса в MULTIPROCESS_DIR/cafe-metrics-<pid>.json '''
+
+    def __init__(self):
+        self.last = 0.0
+        self._lock = threading.Lock()
+
+    def flush(self, force: bool = False):
+        config = metrics_config()
+        directory = config['MULTIPROCESS_DIR']
+        if not directory:
+            return
+        now = time.monotonic()
+        if not force and now - self.last < config['FLUSH_INTERVAL']:
+            return
+        if not self._lock.acquire(blocking = force):
+            return
+        try:
+            self.last = now
+            write_snapshot(directory, process_name(), process_snapshot())
+        finally:
+            self._lock.release()
+
+
+flusher = _Flusher()
+atexit.register(lambda: flusher.flush(force = True))
+
+
+def _encode(values: dict) -> list:
+    return [[name, [list(label) for label in labels], value] for (name, labels), value in values.items()]
+
+
+def _decode(rows: list) -> dict:
+    return { (name, tuple(tuple(label) for label in labels)): value for name, labels, value in rows }
+
+
+RETIRED = 'cafe-metrics-retired.json'
+
+_process = (None, None)
+
+
+def process_name() -> str:
+    ''' Имя снимка процесса: pid и время запуска. Процесс, получивший pid
+    завершившегося воркера, пишет в свой файл, а не поверх его итогов '''
+    global _process
+    pid = os.getpid()
+    if _process[0] != pid:
+        _process = (pid, f'{pid}-{time.time_ns()}')
+    return _process[1]
+
+
+def _write(path: str, data: dict):
+    temporary = f'{path}.tmp'
+    with open(temporary, 'w', encoding = 'utf-8') as file:
+        json.dump(data, file)
+    os.replace(temporary, path)
+
+
+def _read(path: str):
+    try:
+        with open(path, encoding = 'utf-8') as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+
+def write_snapshot(directory: str, name: str, snapshot: dict):
+    os.makedirs(directory, exist_ok = True)
+    _write(os.path.join(directory, f'cafe-metrics-{name}.json'), {
+        'pid': os.getpid(), 'written': time.time(), **{ kind: _encode(values) for kind, values in snapshot.items() },
+    })
+
+
+@contextmanager
+def _locked(directory: str):
+    ''' Блокировка каталога снимков между процессами на время свёртки '''
+    import fcntl
+
+    with open(os.path.join(directory, 'cafe-metrics.lock'), 'a') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+def _retire(directory: str) -> _Shard:
+    ''' Сворачивает снимки завершившихся воркеров в RETIRED и удаляет их файлы.
+
+    Воркер считается завершившимся, если его pid не существует или pid уже
+    занят процессом с более свежим снимком. Возвращает свёрнутые значения.
+    '''
+    retired = _Shard()
+    data = _read(os.path.join(directory, RETIRED))
+    if data is not None:
+        retired.counters, retired.histograms = _decode(data['counters']), _decode(data['histograms'])
+
+    by_pid = {}
+    for path in glob.glob(os.path.join(directory, 'cafe-metrics-*.json')):
+        if os.path.basename(path) == RETIRED:
+            continue
+        data = _read(path)
+        if data is not None:
+            by_pid.setdefault(data['pid'], []).append((data.get('written', 0), path, data))
+
+    dead = []
+    for pid, snapshots in by_pid.items():
+        snapshots.sort(key = lambda snapshot: snapshot[0])
+        dead += snapshots if not _alive(pid) else snapshots[:-1]
+    if dead:
+        for written, path, data in dead:
+            shard = _Shard()
+            shard.counters, shard.histograms = _decode(data['counters']), _decode(data['histograms'])
+            _merge(retired, shard)
+        _write(os.path.join(directory, RETIRED), { 'counters': _encode(retired.counters), 'histograms': _encode(retired.histograms) })
+        for written, path, data in dead:
+            os.remove(path)
+    return retired
+
+
+def collect() -> dict:
+    ''' Метрики для выдачи: процесс или сумма всех воркеров из MULTIPROCESS_DIR.
+
+    Счётчики и гистограммы завершившихся воркеров сворачиваются в один файл
+    и продолжают суммироваться, чтобы итоговые значения не уменьшались,
+    их gauge-и отбрасываются. Снимки других воркеров отстают не более чем
+    на FLUSH_INTERVAL секунд.
+    '''
+    snapshot = process_snapshot()
+    directory = metrics_config()['MULTIPROCESS_DIR']
+    if not directory:
+        return snapshot
+
+    write_snapshot(directory, process_name(), snapshot)
+    with _locked(directory):
+        total = _retire(directory)
+        for path in glob.glob(os.path.join(directory, 'cafe-metrics-*.json')):
+            data = _read(path) if os.path.basename(path) != RETIRED else None
+            if data is None:
+                continue
+            shard = _Shard()
+            shard.counters = _decode(data['counters'])
+            shard.gauges = _decode(data['gauges'])
+            shard.histograms = _decode(data['histograms'])
+            _merge(total, shard)
+    return { 'counters': total.counters, 'gauges': total.gauges, 'histograms': total.histograms }
+
+
+''' Текстовый формат Prometheus '''
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(labels) -> str:
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"' for name, value in labels) + '}'
+
+
+def _number(value) -> str:
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(snapshot: dict, buckets = None) -> str:
+    buckets = registry.buckets if buckets is None else buckets
+    series = {}
+    for kind in ('counters', 'gauges', 'histograms'):
+        for (name, labels), value in snapshot[kind].items():
+            series.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name in sorted(set(METRICS) | set(series)):
+        type, description = METRICS.get(name, ('untyped', name))
+        lines.append(f'# HELP {name} {description}')
+        lines.append(f'# TYPE {name} {type}')
+        if name == 'cafe_http_requests_in_flight' and name not in series:
+            lines.append(f'{name} 0')
+        for labels, value in sorted(series.get(name, [])):
+            if type != 'histogram':
+                lines.append(f'{name}{_labels(labels)} {_number(value)}')
+                continue
+            cumulative = 0
+            for bound, count in zip((*map(_number, buckets), '+Inf'), value[:-2]):
+                cumulative += count
+                lines.append(f'{name}_bucket{_labels((*labels, ("le", bound)))} {cumulative}')
+            lines.append(f'{name}_sum{_labels(labels)} {_number(value[-2])}')
+            lines.append(f'{name}_count{_labels(labels)} {value[-1]}')
+    return '\n'.join(lines) + '\n'
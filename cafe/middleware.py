@@ -0,0 +1,168 @@
+import time
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.core.exceptions import MiddlewareNotUsed
+from django.http import JsonResponse
+
+from .instrumentation import finish, install, instrumentation_config, log_slow, server_timing, start
+from .metrics import flusher, metrics_config, registry
+from .uploads import IMAGE_ROUTES, ImageUploadHandler, max_request_bytes
+
+
+class ETagMiddleware:
+    ''' Проставляет ETag, вычисленный декоратором cafe.cache.conditional, на успешные ответы.
+
+    Работает и в синхронном, и в асинхронном режиме, чтобы под ASGI запрос
+    не переключался на поток ради этого middleware.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self.process(request, self.get_response(request))
+
+    async def __acall__(self, request):
+        return self.process(request, await self.get_response(request))
+
+    def process(self, request, response):
+        etag = getattr(request, 'etag', None)
+        if etag and response.status_code == 200 and not response.has_header('ETag'):
+            response['ETag'] = etag
+        return response
+
+
+class InstrumentationMiddleware:
+    ''' Замеряет запросы: число и время SQL, сериализацию и общее время обработки.
+
+    Добавляет заголовок Server-Timing и пишет в лог cafe.instrumentation запросы,
+    превысившие пороги CAFE_INSTRUMENTATION. Если замеры выключены, middleware
+    исключается из цепочки при старте и ничего не стоит.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.config = instrumentation_config()
+        if not self.config['ENABLED']:
+            raise MiddlewareNotUsed
+        install()
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        metrics, token = start(self.config['SLOWEST'])
+        try:
+            response = self.get_response(request)
+        finally:
+            finish(token)
+        return self.process(request, response, metrics)
+
+    async def __acall__(self, request):
+        metrics, token = start(self.config['SLOWEST'])
+        try:
+            response = await self.get_response(request)
+        finally:
+            finish(token)
+        return self.process(request, response, metrics)
+
+    def process(self, request, response, metrics):
+        total = metrics.total_time()
+        if self.config['SERVER_TIMING']:
+            response['Server-Timing'] = server_timing(metrics, total)
+        log_slow(request, response, metrics, total, self.config)
+        return response
+
+
+class MetricsMiddleware:
+    ''' Считает запросы, их длительность и число одновременно обрабатываемых для /metrics.
+
+    Маршрут берётся из шаблона URL (api/menu/<category_id>), чтобы число рядов
+    метрик не зависело от id в пути. При выключенных метриках middleware
+    исключается из цепочки при старте.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        if not metrics_config()['ENABLED']:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        started = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            registry.add('cafe_http_requests_in_flight', -1)
+        return self.process(request, response, started)
+
+    async def __acall__(self, request):
+        started = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            registry.add('cafe_http_requests_in_flight', -1)
+        return self.process(request, response, started)
+
+    def start(self) -> float:
+        registry.add('cafe_http_requests_in_flight', 1)
+        return time.perf_counter()
+
+    def process(self, request, response, started: float):
+        duration = time.perf_counter() - started
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match is not None else '<unmatched>'
+        registry.inc('cafe_http_requests_total', method = request.method, route = route, status = str(response.status_code))
+        registry.observe('cafe_http_request_duration_seconds', duration, method = request.method, route = route)
+        flusher.flush()
+        return response
+
+
+class ImageUploadMiddleware:
+    ''' Загрузка изображений на IMAGE_ROUTES: тело больше max_request_bytes отклоняется
+    с 413 по Content-Length, не читаясь, а файл принимает ImageUploadHandler.
+
+    Обработчик ставится в process_view, до того как ninja (проверка CSRF,
+    разбор параметров) прочитает тело запроса.
+    '''
+
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        return self.get_response(request)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        match = request.resolver_match
+        if request.method != 'POST' or match is None or match.route not in IMAGE_ROUTES:
+            return None
+        try:
+            length = int(request.META.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length > max_request_bytes():
+            return JsonResponse({ 'detail': 'Файл слишком большой!' }, status = 413)
+        request.upload_handlers.insert(0, ImageUploadHandler(request))
+        return None
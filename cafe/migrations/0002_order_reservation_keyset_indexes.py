@@ -0,0 +1,35 @@
+# Generated by Django 5.1.5 on 2026-10-17 03:25
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafe', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='orderstatus',
+            options={'verbose_name': 'Статус заказа', 'verbose_name_plural': 'Статусы заказов'},
+        ),
+        migrations.AlterModelOptions(
+            name='tablestatus',
+            options={'verbose_name': 'Статус столика', 'verbose_name_plural': 'Статусы столиков'},
+        ),
+        migrations.AlterField(
+            model_name='order',
+            name='reservation',
+            field=models.OneToOneField(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, to='cafe.reservation', verbose_name='Клиент'),
+        ),
+        migrations.AddIndex(
+            model_name='order',
+            index=models.Index(fields=['created_at', 'id'], name='order_created_at_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['datetime', 'id'], name='reservation_datetime_id_idx'),
+        ),
+    ]
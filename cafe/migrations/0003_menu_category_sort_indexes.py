@@ -0,0 +1,21 @@
+# Generated by Django 5.1.5 on 2026-10-17 03:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafe', '0002_order_reservation_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='menu',
+            index=models.Index(fields=['category', 'price'], name='menu_category_price_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='menu',
+            index=models.Index(fields=['category', 'name'], name='menu_category_name_idx'),
+        ),
+    ]
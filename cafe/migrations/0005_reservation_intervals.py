@@ -0,0 +1,46 @@
+from datetime import timedelta
+
+import django.core.validators
+from django.db import migrations, models
+
+
+def fill_ends_at(apps, schema_editor):
+    Reservation = apps.get_model('cafe', 'Reservation')
+    for reservation in Reservation.objects.only('id', 'datetime', 'duration').iterator():
+        reservation.ends_at = reservation.datetime + timedelta(minutes = reservation.duration)
+        reservation.save(update_fields = ['ends_at'])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafe', '0004_order_total_default'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='table',
+            name='seats',
+            field=models.PositiveIntegerField(blank=True, help_text='Пусто - без ограничения', null=True, verbose_name='Количество мест'),
+        ),
+        migrations.AddField(
+            model_name='reservation',
+            name='duration',
+            field=models.PositiveIntegerField(default=120, validators=[django.core.validators.MaxValueValidator(1440)], verbose_name='Продолжительность, мин'),
+        ),
+        migrations.AddField(
+            model_name='reservation',
+            name='ends_at',
+            field=models.DateTimeField(editable=False, null=True, verbose_name='Окончание'),
+        ),
+        migrations.RunPython(fill_ends_at, migrations.RunPython.noop),
+        migrations.AlterField(
+            model_name='reservation',
+            name='ends_at',
+            field=models.DateTimeField(editable=False, verbose_name='Окончание'),
+        ),
+        migrations.AddIndex(
+            model_name='reservation',
+            index=models.Index(fields=['table', 'datetime', 'ends_at'], name='reservation_table_interval_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.1.5 on 2026-10-17 03:44
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cafe', '0005_reservation_intervals'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyMenuSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Дата')),
+                ('quantity', models.PositiveBigIntegerField(default=0, verbose_name='Количество')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Выручка')),
+                ('menu', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='cafe.menu', verbose_name='Позиция меню')),
+            ],
+            options={
+                'verbose_name': 'Продажи позиции меню за день',
+                'verbose_name_plural': 'Продажи позиций меню по дням',
+                'constraints': [models.UniqueConstraint(fields=('date', 'menu'), name='daily_menu_sales_date_menu_uniq')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyTableSales',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(verbose_name='Дата')),
+                ('orders', models.PositiveIntegerField(default=0, verbose_name='Оплаченных заказов')),
+                ('revenue', models.DecimalField(decimal_places=2, default=0, max_digits=12, verbose_name='Выручка')),
+                ('table', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='daily_sales', to='cafe.table', verbose_name='Столик')),
+            ],
+            options={
+                'verbose_name': 'Продажи столика за день',
+                'verbose_name_plural': 'Продажи столиков по дням',
+                'constraints': [models.UniqueConstraint(fields=('date', 'table'), name='daily_table_sales_date_table_uniq')],
+            },
+        ),
+    ]
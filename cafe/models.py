@@ -1,7 +1,16 @@
+from datetime import timedelta
+
+from django.core.validators import MaxValueValidator
 from django.db import models
+from django.db.models import DecimalField, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
 from django.urls import reverse
 
 
+# предел продолжительности бронирования: даёт нижнюю границу поиска пересечений
+MAX_RESERVATION_MINUTES = 24 * 60
+
+
 class Category(models.Model):
     name = models.CharField(verbose_name = 'Наименование', max_length = 250)
     slug = models.SlugField(verbose_name = 'Slug', max_length = 250, unique = True)
@@ -27,6 +36,10 @@ class Menu(models.Model):
 
     class Meta:
         ordering = ('name', )
+        indexes = [
+            models.Index(fields = ['category', 'price'], name = 'menu_category_price_idx'),
+            models.Index(fields = ['category', 'name'], name = 'menu_category_name_idx'),
+        ]
         verbose_name = 'Позиция меню'
         verbose_name_plural = 'Позиции меню'
 
@@ -51,6 +64,7 @@ class TableStatus(models.Model):
 class Table(models.Model):
     number = models.PositiveIntegerField(verbose_name = 'Номер столика', unique = True)
     status = models.ForeignKey(TableStatus, verbose_name = 'Статус', on_delete = models.CASCADE)
+    seats = models.PositiveIntegerField(verbose_name = 'Количество мест', blank = True, null = True, help_text = 'Пусто - без ограничения')
 
     class Meta:
         verbose_name = 'Столик'
@@ -65,17 +79,31 @@ class Reservation(models.Model):
     client_name = models.CharField(verbose_name = 'Фамилия Имя Отчество', max_length = 250)
     client_phone = models.CharField(verbose_name = 'Номер телефона', max_length = 20)
     datetime = models.DateTimeField(verbose_name = 'Дата и время')
+    duration = models.PositiveIntegerField(verbose_name = 'Продолжительность, мин', default = 120, validators = [MaxValueValidator(MAX_RESERVATION_MINUTES)])
+    ends_at = models.DateTimeField(verbose_name = 'Окончание', editable = False)
     quest_count = models.PositiveIntegerField(verbose_name = 'Количество', default = 1)
     comment = models.TextField(verbose_name = 'Примечания', blank = True, null = True)
 
     class Meta:
         ordering = ('datetime', )
+        indexes = [
+            models.Index(fields = ['datetime', 'id'], name = 'reservation_datetime_id_idx'),
+            models.Index(fields = ['table', 'datetime', 'ends_at'], name = 'reservation_table_interval_idx'),
+        ]
         verbose_name = 'Бронирование'
         verbose_name_plural = 'Бронирования'
 
     def __str__(self):
         return self.client_name + ' (' + self.client_phone + ')'
 
+    def save(self, *args, **kwargs):
+        self.datetime = self._meta.get_field('datetime').to_python(self.datetime)
+        self.ends_at = self.datetime + timedelta(minutes = self.duration)
+        update_fields = kwargs.get('update_fields')
+        if update_fields is not None and ('datetime' in update_fields or 'duration' in update_fields):
+            kwargs['update_fields'] = {*update_fields, 'ends_at'}
+        super().save(*args, **kwargs)
+
 
 class OrderStatus(models.Model):
     name = models.CharField(verbose_name = 'Наименование', max_length = 250)
@@ -88,15 +116,40 @@ class OrderStatus(models.Model):
         return self.name
 
 
+def _items_total():
+    return Coalesce(
+        Subquery(
+            OrderItem.objects.filter(order = OuterRef('pk')).order_by().values('order')
+                .annotate(total = Sum('price')).values('total')[:1]
+        ),
+        Value(0),
+        output_field = DecimalField(max_digits = 10, decimal_places = 2),
+    )
+
+
+class OrderQuerySet(models.QuerySet):
+    def with_items_total(self):
+        return self.annotate(items_total = _items_total())
+
+    def with_wrong_total(self):
+        return self.with_items_total().exclude(totalAmount = models.F('items_total'))
+
+    def recalculate_totals(self):
+        return self.update(totalAmount = _items_total())
+
+
 class Order(models.Model):
     table = models.ForeignKey(Table, verbose_name = 'Столик', on_delete = models.CASCADE)
     reservation = models.OneToOneField(Reservation, verbose_name = 'Клиент', on_delete = models.CASCADE, blank = True, null = True)
     status = models.ForeignKey(OrderStatus, verbose_name = 'Статус', on_delete = models.CASCADE)
-    totalAmount = models.DecimalField(verbose_name = 'Итоговая стоимость', max_digits = 10, decimal_places = 2)
+    totalAmount = models.DecimalField(verbose_name = 'Итоговая стоимость', max_digits = 10, decimal_places = 2, default = 0)
     created_at = models.DateTimeField(verbose_name = 'Дата создания', auto_now_add = True)
 
+    objects = OrderQuerySet.as_manager()
+
     class Meta:
         ordering = ('created_at', )
+        indexes = [models.Index(fields = ['created_at', 'id'], name = 'order_created_at_id_idx')]
         verbose_name = 'Заказ'
         verbose_name_plural = 'Заказы'
 
@@ -104,7 +157,11 @@ class Order(models.Model):
         return 'Заказ №' + str(self.id)
 
     def get_total_amount(self):
-        return sum(item.get_amount() for item in self.order_items.all())  
+        return self.order_items.aggregate(total = Sum('price'))['total'] or 0
+
+    def recalculate_total(self):
+        Order.objects.filter(pk = self.pk).recalculate_totals()
+        self.refresh_from_db(fields = ['totalAmount'])
 
 
 class OrderItem(models.Model):
@@ -131,4 +188,40 @@ class Payment(models.Model):
         verbose_name_plural = 'Оплаты'
 
     def __str__(self):
-        return 'Оплата для заказа №' + str(self.order.id)
\ No newline at end of file
+        return 'Оплата для заказа №' + str(self.order.id)
+
+
+class DailyMenuSales(models.Model):
+    date = models.DateField(verbose_name = 'Дата')
+    menu = models.ForeignKey(Menu, verbose_name = 'Позиция меню', related_name = 'daily_sales', on_delete = models.CASCADE)
+    quantity = models.PositiveBigIntegerField(verbose_name = 'Количество', default = 0)
+    revenue = models.DecimalField(verbose_name = 'Выручка', max_digits = 12, decimal_places = 2, default = 0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields = ['date', 'menu'], name = 'daily_menu_sales_date_menu_uniq')]
+        verbose_name = 'Продажи позиции меню за день'
+        verbose_name_plural = 'Продажи позиций меню по дням'
+
+
+class DailyTableSales(models.Model):
+    date = models.DateField(verbose_name = 'Дата')
+    table = models.ForeignKey(Table, verbose_name = 'Столик', related_name = 'daily_sales', on_delete = models.CASCADE)
+    orders = models.PositiveIntegerField(verbose_name = 'Оплаченных заказов', default = 0)
+    revenue = models.DecimalField(verbose_name = 'Выручка', max_digits = 12, decimal_places = 2, default = 0)
+
+    class Meta:
+        constraints = [models.UniqueConstraint(fields = ['date', 'table'], name = 'daily_table_sales_date_table_uniq')]
+        verbose_name = 'Продажи столика за день'
+        verbose_name_plural = 'Продажи столиков по дням'
+
+
+class CacheVersion(models.Model):
+    namespace = models.CharField(verbose_name = 'Раздел', max_length = 50, primary_key = True)
+    version = models.PositiveBigIntegerField(verbose_name = 'Версия')
+
+    class Meta:
+        verbose_name = 'Версия кэша'
+        verbose_name_plural = 'Версии кэша'
+
+    def __str__(self):
+        return self.namespace + ' v' + str(self.version)
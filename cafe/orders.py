@@ -0,0 +1,120 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import F
+from django.http import Http404
+from django.shortcuts import get_object_or_404
+
+from .events import publish_instance, publish_rows
+from .models import Menu, Order, OrderItem
+
+
+''' Операции над позициями заказа '''
+
+
+def apply_total_delta(order_id: int, delta):
+    ''' Атомарно сдвигает итоговую стоимость заказа на delta одним UPDATE '''
+    if delta:
+        Order.objects.filter(pk = order_id).update(totalAmount = F('totalAmount') + delta)
+        publish_rows('order', Order.objects.filter(pk = order_id))
+
+
+def _reprice(item: OrderItem, unit_price, quantity: int):
+    ''' Единое правило для всех операций: строка пересчитывается по текущей цене меню
+    на новое количество, итог заказа сдвигается на разницу новой и старой цены строки '''
+    price = unit_price * quantity
+    delta = price - item.price
+    item.quantity, item.price = quantity, price
+    return delta
+
+
+def add_item(order_id: int, menu_id: int, quantity: int) -> OrderItem:
+    ''' Добавляет позицию в заказ, а если она уже есть - увеличивает её количество на quantity '''
+    with transaction.atomic():
+        order = get_object_or_404(Order.objects.only('id'), id = order_id)
+        menu = get_object_or_404(Menu.objects.only('id', 'price'), id = menu_id)
+        order_item = OrderItem.objects.select_for_update().filter(order = order, menu = menu) \
+            .only('id', 'quantity', 'price').order_by('id').first()
+        if order_item is None:
+            order_item = OrderItem.objects.create(order = order, menu = menu, quantity = quantity, price = menu.price * quantity)
+            apply_total_delta(order.id, order_item.price)
+        else:
+            delta = _reprice(order_item, menu.price, order_item.quantity + quantity)
+            OrderItem.objects.filter(pk = order_item.pk).update(quantity = order_item.quantity, price = order_item.price)
+            publish_rows('order_item', OrderItem.objects.filter(pk = order_item.pk))
+            apply_total_delta(order.id, delta)
+    return order_item
+
+
+def change_quantity(order_item_id: int, step: int, queryset = None) -> OrderItem:
+    ''' Меняет количество позиции на step (+1/-1) под блокировкой строки.
+
+    Строка пересчитывается по текущей цене меню (см. _reprice), одновременные
+    нажатия ждут блокировки и не теряют изменений. Если количество дошло бы
+    до нуля, строка удаляется в той же транзакции: второе одновременное
+    уменьшение получает 404. Возвращает позицию, прочитанную из queryset
+    после изменения (или до удаления).
+    '''
+    queryset = OrderItem.objects.all() if queryset is None else queryset
+    with transaction.atomic():
+        item = OrderItem.objects.select_for_update().filter(pk = order_item_id).only('id', 'order_id', 'menu_id', 'quantity', 'price').first()
+        if item is None:
+            raise Http404('Позиция заказа не найдена!')
+
+        if item.quantity + step > 0:
+            unit_price = Menu.objects.filter(pk = item.menu_id).values_list('price', flat = True).get()
+            delta = _reprice(item, unit_price, item.quantity + step)
+            OrderItem.objects.filter(pk = item.pk).update(quantity = item.quantity, price = item.price)
+            apply_total_delta(item.order_id, delta)
+            order_item = get_object_or_404(queryset, pk = order_item_id)
+            publish_instance('order_item', order_item)
+            return order_item
+
+        order_item = get_object_or_404(queryset, pk = order_item_id)
+        apply_total_delta(item.order_id, -item.price)
+        OrderItem.objects.filter(pk = item.pk).delete()
+
+    order_item.order.totalAmount -= order_item.price
+    order_item.quantity, order_item.price = 0, 0
+    return order_item
+
+
+def add_items(order_id: int, lines) -> Order:
+    ''' Добавляет в заказ несколько позиций за одну транзакцию.
+
+    Одинаковые позиции в запросе складываются, цены читаются одним IN-запросом,
+    существующие строки заказа блокируются и обновляются через bulk_update, новые
+    создаются через bulk_create. Существующие строки пересчитываются по _reprice.
+    '''
+    quantities = defaultdict(int)
+    for line in lines:
+        quantities[line.menu] += line.quantity
+
+    with transaction.atomic():
+        order = get_object_or_404(Order.objects.select_for_update().only('id'), id = order_id)
+        prices = dict(Menu.objects.filter(id__in = quantities).values_list('id', 'price'))
+        if len(prices) != len(quantities):
+            raise Http404('Позиция меню не найдена!')
+
+        # блокировка строк не даёт bulk_update затереть параллельный change_quantity
+        existing = {}
+        items = OrderItem.objects.select_for_update().filter(order = order, menu_id__in = quantities)
+        for item in items.only('id', 'menu_id', 'quantity', 'price').order_by('id'):
+            existing.setdefault(item.menu_id, item)
+
+        to_update, to_create, delta = [], [], 0
+        for menu_id, quantity in quantities.items():
+            item = existing.get(menu_id)
+            if item is None:
+                item = OrderItem(order = order, menu_id = menu_id, quantity = quantity, price = prices[menu_id] * quantity)
+                to_create.append(item)
+                delta += item.price
+            else:
+                delta += _reprice(item, prices[menu_id], item.quantity + quantity)
+                to_update.append(item)
+
+        OrderItem.objects.bulk_update(to_update, ['quantity', 'price'])
+        OrderItem.objects.bulk_create(to_create)
+        publish_rows('order_item', OrderItem.objects.filter(order = order, menu_id__in = quantities))
+        apply_total_delta(order.id, delta)
+    return order
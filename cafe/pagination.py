@@ -0,0 +1,89 @@
+import base64
+import json
+from typing import Any, List, Optional
+
+from django.conf import settings
+from django.db.models import Q, QuerySet
+from ninja import Field, Schema
+from ninja.errors import HttpError
+from ninja.pagination import AsyncPaginationBase
+
+
+def _page_sizes():
+    config = getattr(settings, 'CAFE_PAGINATION', {})
+    return config.get('PAGE_SIZE', 50), config.get('MAX_PAGE_SIZE', 500)
+
+
+class CursorPagination(AsyncPaginationBase):
+    ''' Keyset-пагинация по индексированным полям.
+
+    Следующая страница выбирается условием "ключ больше последнего отданного",
+    поэтому глубокие страницы стоят столько же, сколько первая, в отличие от OFFSET.
+    Курсор - base64 от значений ключа последней записи.
+    '''
+
+    class Input(Schema):
+        cursor: Optional[str] = Field(None, description = 'Курсор следующей страницы')
+        limit: Optional[int] = Field(None, ge = 1, description = 'Размер страницы')
+
+    class Output(Schema):
+        items: List[Any]
+        next: Optional[str] = None
+
+    def __init__(self, ordering: tuple = ('id', ), page_size: int = None, max_page_size: int = None, **kwargs):
+        super().__init__(**kwargs)
+        default_page_size, default_max_page_size = _page_sizes()
+        self.ordering = tuple(ordering)
+        self.page_size = page_size or default_page_size
+        self.max_page_size = max_page_size or default_max_page_size
+
+    def _fields(self, model):
+        return [(model._meta.get_field(key.lstrip('-')), key.startswith('-')) for key in self.ordering]
+
+    def encode_cursor(self, obj) -> str:
+        values = [field.value_to_string(obj) for field, descending in self._fields(type(obj))]
+        return base64.urlsafe_b64encode(json.dumps(values).encode()).decode().rstrip('=')
+
+    def decode_cursor(self, model, cursor: str) -> list:
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)))
+            fields = self._fields(model)
+            if not isinstance(values, list) or len(values) != len(fields):
+                raise ValueError(cursor)
+            return [(field, descending, field.to_python(value)) for (field, descending), value in zip(fields, values)]
+        except Exception:
+            raise HttpError(400, 'Некорректный курсор!')
+
+    def _after(self, model, cursor: str) -> Q:
+        keys = self.decode_cursor(model, cursor)
+        condition = Q()
+        for index, (field, descending, value) in enumerate(keys):
+            step = Q(**{f'{field.attname}__{"lt" if descending else "gt"}': value})
+            for previous_field, previous_descending, previous_value in keys[:index]:
+                step &= Q(**{previous_field.attname: previous_value})
+            condition |= step
+        return condition
+
+    def _page(self, queryset: QuerySet, pagination: Input):
+        limit = min(pagination.limit or self.page_size, self.max_page_size)
+        queryset = queryset.order_by(*[
+            ('-' if descending else '') + field.attname for field, descending in self._fields(queryset.model)
+        ])
+        if pagination.cursor:
+            queryset = queryset.filter(self._after(queryset.model, pagination.cursor))
+        return queryset[:limit + 1], limit
+
+    def _result(self, items: list, limit: int) -> dict:
+        next_cursor = None
+        if len(items) > limit:
+            items = items[:limit]
+            next_cursor = self.encode_cursor(items[-1])
+        return { 'items': items, 'next': next_cursor }
+
+    def paginate_queryset(self, queryset: QuerySet, pagination: Input, **params: Any) -> Any:
+        page, limit = self._page(queryset, pagination)
+        return self._result(list(page), limit)
+
+    async def apaginate_queryset(self, queryset: QuerySet, pagination: Input, **params: Any) -> Any:
+        page, limit = self._page(queryset, pagination)
+        return self._result([obj async for obj in page], limit)
@@ -0,0 +1,87 @@
+from django.conf import settings
+from django.contrib.auth.models import Permission
+from django.db.models import Q
+
+from .cache import LRUCache, aget_version, arequest_version, bump_version, get_version, request_version
+
+
+NAMESPACE = 'permissions'
+
+
+class PermissionIndex:
+    ''' Индекс прав процесса: пользователь -> frozenset кодов вида "app_label.codename".
+
+    Записи помечены поколением - версией NAMESPACE в таблице CacheVersion, общей
+    для воркеров. Изменение пользователей, групп или прав сдвигает её в той же
+    транзакции, и при следующем запросе каждый воркер перечитывает права.
+    Поколение читается один раз за запрос и только для обычных пользователей.
+    '''
+
+    def __init__(self, max_size: int = 4096, ttl: float = 600):
+        self._cache = LRUCache(max_size = max_size, ttl = ttl)
+
+    def _rows(self, user_id):
+        return Permission.objects.filter(Q(user = user_id) | Q(group__user = user_id)) \
+            .values_list('content_type__app_label', 'codename').distinct()
+
+    def _load(self, user_id) -> frozenset:
+        return frozenset(f'{app_label}.{codename}' for app_label, codename in self._rows(user_id))
+
+    async def _aload(self, user_id) -> frozenset:
+        return frozenset([f'{app_label}.{codename}' async for app_label, codename in self._rows(user_id)])
+
+    def get_permissions(self, user_obj, generation: int) -> frozenset:
+        entry = self._cache.get(user_obj.pk)
+        if entry is not None and entry[0] == generation:
+            return entry[1]
+        permissions = self._load(user_obj.pk)
+        self._cache.set(user_obj.pk, (generation, permissions))
+        return permissions
+
+    async def aget_permissions(self, user_obj, generation: int) -> frozenset:
+        entry = self._cache.get(user_obj.pk)
+        if entry is not None and entry[0] == generation:
+            return entry[1]
+        permissions = await self._aload(user_obj.pk)
+        self._cache.set(user_obj.pk, (generation, permissions))
+        return permissions
+
+    def _decide(self, user_obj):
+        ''' Решение без загрузки прав: True/False или None, если нужны права пользователя '''
+        if not user_obj or not user_obj.is_active or user_obj.pk is None:
+            return False
+        if user_obj.is_superuser:
+            return True
+        return None
+
+    def has_perms(self, user_obj, permissions, request = None) -> bool:
+        decision = self._decide(user_obj)
+        if decision is not None:
+            return decision
+        generation = request_version(request, NAMESPACE) if request is not None else get_version(NAMESPACE)
+        return self.get_permissions(user_obj, generation).issuperset(permissions)
+
+    async def ahas_perms(self, user_obj, permissions, request = None) -> bool:
+        decision = self._decide(user_obj)
+        if decision is not None:
+            return decision
+        generation = await arequest_version(request, NAMESPACE) if request is not None else await aget_version(NAMESPACE)
+        return (await self.aget_permissions(user_obj, generation)).issuperset(permissions)
+
+    def invalidate_user(self, user_id):
+        self._cache.delete(user_id)
+        self.invalidate()
+
+    def invalidate(self):
+        bump_version(NAMESPACE)
+
+    def stats(self):
+        return self._cache.stats()
+
+
+def _build_permission_index():
+    config = getattr(settings, 'CAFE_PERMISSION_INDEX', {})
+    return PermissionIndex(max_size = config.get('MAX_SIZE', 4096), ttl = config.get('TTL', 600))
+
+
+permission_index = _build_permission_index()
@@ -0,0 +1,109 @@
+from functools import lru_cache, wraps
+from typing import List, Union, get_args, get_origin
+
+from asgiref.sync import iscoroutinefunction
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models import Prefetch, QuerySet
+from ninja import Schema
+
+
+''' Планировщик выборок: select_related / prefetch_related / only() по схеме ответа '''
+
+
+def _unwrap(annotation):
+    ''' Возвращает (тип, is_many) для Optional[...] и List[...] аннотаций '''
+    many = False
+    while True:
+        origin = get_origin(annotation)
+        if origin is Union:
+            args = [arg for arg in get_args(annotation) if arg is not type(None)]
+            if len(args) != 1:
+                return annotation, many
+            annotation = args[0]
+        elif origin in (list, List, tuple, set, frozenset):
+            many = True
+            annotation = get_args(annotation)[0]
+        else:
+            return annotation, many
+
+
+def _is_schema(annotation) -> bool:
+    return isinstance(annotation, type) and issubclass(annotation, Schema)
+
+
+def _walk(model, schema, prefix, only, select, prefetch):
+    only.add(prefix + model._meta.pk.attname)
+    for name, field_info in schema.model_fields.items():
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            continue
+
+        annotation, many = _unwrap(field_info.annotation)
+        if not field.is_relation:
+            only.add(prefix + field.attname)
+            continue
+
+        if not _is_schema(annotation):
+            if field.concrete:
+                only.add(prefix + field.attname)
+            continue
+
+        if (field.many_to_one or field.one_to_one) and field.concrete and not many:
+            only.add(prefix + name)
+            select.append(prefix + name)
+            _walk(field.related_model, annotation, prefix + name + '__', only, select, prefetch)
+        else:
+            related_only, related_select, related_prefetch = get_plan(field.related_model, annotation)
+            if not field.concrete and not field.many_to_many:
+                related_only = related_only + [field.field.attname]
+            queryset = field.related_model._default_manager.select_related(*related_select) \
+                .prefetch_related(*related_prefetch).only(*related_only)
+            prefetch.append(Prefetch(prefix + name, queryset = queryset))
+
+
+@lru_cache(maxsize = None)
+def get_plan(model, schema):
+    only, select, prefetch = set(), [], []
+    _walk(model, schema, '', only, select, prefetch)
+    return sorted(only), tuple(select), tuple(prefetch)
+
+
+def apply_plan(queryset: QuerySet, schema) -> QuerySet:
+    only, select, prefetch = get_plan(queryset.model, schema)
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    return queryset.only(*only)
+
+
+async def alist(queryset: QuerySet) -> list:
+    ''' Выполняет QuerySet асинхронно: синхронная сериализация ninja не может обращаться к БД '''
+    return [obj async for obj in queryset]
+
+
+def planned(schema):
+    ''' Применяет план выборки к QuerySet, который возвращает обработчик.
+
+    Для async-обработчиков QuerySet сразу выполняется и возвращается списком,
+    поэтому под @paginate их оборачивать не нужно - там план применяется явно.
+    '''
+    def decorator(view_func):
+        if iscoroutinefunction(view_func):
+            @wraps(view_func)
+            async def async_wrapped_view(request, *args, **kwargs):
+                result = await view_func(request, *args, **kwargs)
+                if isinstance(result, QuerySet):
+                    result = await alist(apply_plan(result, schema))
+                return result
+            return async_wrapped_view
+
+        @wraps(view_func)
+        def wrapped_view(request, *args, **kwargs):
+            result = view_func(request, *args, **kwargs)
+            if isinstance(result, QuerySet):
+                result = apply_plan(result, schema)
+            return result
+        return wrapped_view
+    return decorator
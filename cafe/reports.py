@@ -0,0 +1,102 @@
+from datetime import datetime, time, timedelta
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate
+from django.utils import timezone
+
+from .events import publish_rows
+from .models import DailyMenuSales, DailyTableSales, Order, OrderItem, Payment
+
+
+''' Агрегаты продаж по дням для отчётов '''
+
+
+def _increment(model, date, key: str, rows: dict):
+    ''' Прибавляет значения к строкам (date, key) агрегата.
+
+    Недостающие строки сначала вставляются нулями с ignore_conflicts, затем
+    каждая увеличивается UPDATE с F-выражениями - параллельные оплаты не теряют сумм.
+    '''
+    model.objects.bulk_create([model(date = date, **{ key: value }) for value in rows], ignore_conflicts = True)
+    for value, increments in rows.items():
+        model.objects.filter(date = date, **{ key: value }).update(**{
+            field: F(field) + amount for field, amount in increments.items()
+        })
+
+
+def pay(payment_id: int) -> bool:
+    ''' Отмечает чек оплаченным и добавляет заказ в агрегаты дня его создания.
+
+    Статус меняется условным UPDATE, поэтому повторная или параллельная отметка
+    того же чека агрегаты не увеличивает. Возвращает True, если чек был оплачен сейчас.
+    '''
+    with transaction.atomic():
+        if not Payment.objects.filter(pk = payment_id, status = False).update(status = True):
+            return False
+        order = Order.objects.only('id', 'table_id', 'totalAmount', 'created_at').get(order_payments = payment_id)
+        date = timezone.localdate(order.created_at)
+        items = OrderItem.objects.filter(order = order).values('menu_id').order_by() \
+            .annotate(quantity = Sum('quantity'), revenue = Sum('price'))
+
+        _increment(DailyMenuSales, date, 'menu_id', {
+            item['menu_id']: { 'quantity': item['quantity'], 'revenue': item['revenue'] } for item in items
+        })
+        _increment(DailyTableSales, date, 'table_id', {
+            order.table_id: { 'orders': 1, 'revenue': order.totalAmount },
+        })
+        publish_rows('payment', Payment.objects.filter(pk = payment_id))
+    return True
+
+
+def rebuild(date_from = None, date_to = None) -> tuple:
+    ''' Пересчитывает агрегаты за период (или за всё время) из оплаченных заказов '''
+    day = TruncDate('order__created_at', tzinfo = timezone.get_current_timezone())
+    created = {}
+    if date_from:
+        created['order__created_at__gte'] = timezone.make_aware(datetime.combine(date_from, time.min))
+    if date_to:
+        created['order__created_at__lt'] = timezone.make_aware(datetime.combine(date_to + timedelta(days = 1), time.min))
+    items = OrderItem.objects.filter(order__order_payments__status = True, **created).annotate(day = day)
+    orders = Payment.objects.filter(status = True, **created).annotate(day = day)
+    menu_sales = _period(DailyMenuSales.objects.all(), date_from, date_to)
+    table_sales = _period(DailyTableSales.objects.all(), date_from, date_to)
+
+    with transaction.atomic():
+        menu_sales.delete()
+        table_sales.delete()
+        menu_rows = DailyMenuSales.objects.bulk_create([
+            DailyMenuSales(date = row['day'], menu_id = row['menu_id'], quantity = row['quantity'], revenue = row['revenue'])
+            for row in items.values('day', 'menu_id').order_by().annotate(quantity = Sum('quantity'), revenue = Sum('price')).iterator()
+        ], batch_size = 1000)
+        table_rows = DailyTableSales.objects.bulk_create([
+            DailyTableSales(date = row['day'], table_id = row['order__table_id'], orders = row['orders'], revenue = row['revenue'])
+            for row in orders.values('day', 'order__table_id').order_by()
+                .annotate(orders = Count('order_id'), revenue = Sum('order__totalAmount')).iterator()
+        ], batch_size = 1000)
+    return len(menu_rows), len(table_rows)
+
+
+def _period(queryset, date_from, date_to):
+    if date_from:
+        queryset = queryset.filter(date__gte = date_from)
+    if date_to:
+        queryset = queryset.filter(date__lte = date_to)
+    return queryset
+
+
+def daily_revenue(date_from = None, date_to = None):
+    return _period(DailyTableSales.objects.all(), date_from, date_to).values('date').order_by('date') \
+        .annotate(orders = Sum('orders'), revenue = Sum('revenue'))
+
+
+def top_dishes(date_from = None, date_to = None, limit: int = 10):
+    return _period(DailyMenuSales.objects.all(), date_from, date_to) \
+        .values('menu_id', name = F('menu__name')).order_by() \
+        .annotate(quantity = Sum('quantity'), revenue = Sum('revenue')).order_by('-quantity', '-revenue')[:limit]
+
+
+def table_turnover(date_from = None, date_to = None):
+    return _period(DailyTableSales.objects.all(), date_from, date_to) \
+        .values('table_id', number = F('table__number')).order_by() \
+        .annotate(orders = Sum('orders'), revenue = Sum('revenue')).order_by('number')
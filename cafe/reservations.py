@@ -0,0 +1,66 @@
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import Exists, F, OuterRef, Q
+from django.utils import timezone
+
+from .models import MAX_RESERVATION_MINUTES, Reservation, Table
+
+
+''' Бронирование столиков по интервалам времени '''
+
+
+MAX_DURATION = timedelta(minutes = MAX_RESERVATION_MINUTES)
+
+
+class ReservationConflict(Exception):
+    pass
+
+
+def aware(value):
+    value = Reservation._meta.get_field('datetime').to_python(value)
+    if timezone.is_naive(value):
+        value = timezone.make_aware(value)
+    return value
+
+
+def overlapping(start, end):
+    ''' Бронирования, пересекающиеся с полуинтервалом [start, end).
+
+    Бронирование не длиннее MAX_DURATION, поэтому начало пересекающегося лежит
+    в (start - MAX_DURATION, end) и индекс (table, datetime, ends_at) читается
+    диапазоном с обеих сторон, а не от начала истории столика.
+    '''
+    return Reservation.objects.filter(datetime__gt = start - MAX_DURATION, datetime__lt = end, ends_at__gt = start)
+
+
+def available_tables(start, end, guests: int = 1):
+    ''' Столики минимум на guests мест (или без ограничения), свободные на всём интервале - одним запросом '''
+    start, end = aware(start), aware(end)
+    busy = overlapping(start, end).filter(table = OuterRef('pk'))
+    return (Table.objects.filter(Q(seats__gte = guests) | Q(seats__isnull = True)).exclude(Exists(busy))
+            .order_by(F('seats').asc(nulls_last = True), 'number'))
+
+
+def reserve(reservation: Reservation) -> Reservation:
+    ''' Сохраняет бронирование, если столик вмещает гостей и свободен на его интервале.
+
+    Строка столика блокируется до конца транзакции, поэтому два параллельных
+    бронирования одного столика проверяются и сохраняются по очереди.
+    '''
+    if reservation.duration > MAX_RESERVATION_MINUTES:
+        raise ReservationConflict('Слишком долгое бронирование!')
+    reservation.datetime = aware(reservation.datetime)
+    end = reservation.datetime + timedelta(minutes = reservation.duration)
+
+    with transaction.atomic():
+        table = Table.objects.select_for_update().only('id', 'seats').get(pk = reservation.table_id)
+        if table.seats is not None and table.seats < reservation.quest_count:
+            raise ReservationConflict('Столик не вмещает указанное количество гостей!')
+        conflicts = overlapping(reservation.datetime, end).filter(table = table)
+        if reservation.pk is not None:
+            conflicts = conflicts.exclude(pk = reservation.pk)
+        if conflicts.exists():
+            raise ReservationConflict('Столик уже занят!')
+        reservation.save()
+    return reservation
@@ -1,5 +1,9 @@
-from ninja import Schema
-from datetime import datetime
+from ninja import Schema, Field
+from datetime import date, datetime
+from decimal import Decimal
+from typing import List, Optional
+
+from .models import MAX_RESERVATION_MINUTES
 
 
 class CategoryIn(Schema):
@@ -26,9 +30,9 @@ class MenuOut(Schema):
     category: CategoryOut
     name: str
     slug: str
-    weight: float
-    capacity: float
-    description: str
+    weight: Optional[float]
+    capacity: Optional[float]
+    description: Optional[str]
     price: float 
 
 
@@ -39,11 +43,13 @@ class TableStatusOut(Schema):
 class TableIn(Schema):
     number: int
     status: int
+    seats: Optional[int] = Field(None, ge = 1)
 
 
 class TableOut(Schema):
     number: int
     status: TableStatusOut
+    seats: Optional[int]
 
 
 class ReservationIn(Schema):
@@ -51,6 +57,7 @@ class ReservationIn(Schema):
     client_name: str
     client_phone: str
     datetime: str
+    duration: int = Field(120, ge = 1, le = MAX_RESERVATION_MINUTES)
     quest_count: int
     comment: str
 
@@ -60,6 +67,7 @@ class ReservationOut(Schema):
     client_name: str
     client_phone: str
     datetime: datetime
+    duration: int
     quest_count: int
     comment: str 
 
@@ -72,7 +80,7 @@ class OrderIn(Schema):
     table: int
     reservation: int
     status: int
-    totalAmount: float
+    totalAmount: float = None
 
 
 class OrderOut(Schema):
@@ -96,10 +104,70 @@ class OrderItemOut(Schema):
     quantity: int
 
 
+class OrderLineIn(Schema):
+    menu: int
+    quantity: int = Field(1, ge = 1)
+
+
+class OrderItemsIn(Schema):
+    items: List[OrderLineIn] = Field(..., min_length = 1)
+
+
 class PaymentIn(Schema):
     order: int
 
 
 class PaymentOut(Schema):
     order: OrderOut
-    status: bool
\ No newline at end of file
+    status: bool
+
+
+class EventsOut(Schema):
+    last: int
+    reset: bool
+    events: List[dict]
+
+
+class DailyRevenueOut(Schema):
+    date: date
+    orders: int
+    revenue: float
+
+
+class DishSalesOut(Schema):
+    menu_id: int
+    name: str
+    quantity: int
+    revenue: float
+
+
+class TableSalesOut(Schema):
+    table_id: int
+    number: int
+    orders: int
+    revenue: float
+
+
+class MenuImportRow(Schema):
+    slug: str = Field(..., min_length = 1, max_length = 250, pattern = r'^[-\w]+$')
+    category: Optional[str] = Field(None, max_length = 250)
+    category_name: Optional[str] = Field(None, max_length = 250)
+    name: Optional[str] = Field(None, min_length = 1, max_length = 250)
+    price: Optional[Decimal] = Field(None, ge = 0, max_digits = 10, decimal_places = 2)
+    weight: Optional[Decimal] = Field(None, ge = 0, max_digits = 10, decimal_places = 2)
+    capacity: Optional[Decimal] = Field(None, ge = 0, max_digits = 10, decimal_places = 2)
+    description: Optional[str] = None
+
+
+class MenuImportErrorOut(Schema):
+    row: int
+    slug: Optional[str] = None
+    errors: List[str]
+
+
+class MenuImportReport(Schema):
+    created: int
+    updated: int
+    categories: int
+    dry_run: bool
+    errors: List[MenuImportErrorOut]
@@ -0,0 +1,178 @@
+import logging
+import re
+import threading
+from collections import defaultdict
+
+from django.db import connections
+
+from .cache import get_version
+
+
+''' Поисковый индекс по позициям меню '''
+
+
+logger = logging.getLogger('cafe.search')
+
+# версия в CacheVersion, которую сдвигает каждое изменение позиций меню
+NAMESPACE = 'search'
+
+_WORD = re.compile(r'\w+')
+
+
+def normalize(text: str) -> str:
+    return (text or '').casefold().replace('ё', 'е')
+
+
+def tokenize(text: str) -> list:
+    return _WORD.findall(normalize(text))
+
+
+def trigrams(token: str) -> frozenset:
+    padded = f'  {token} '
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class MenuSearchIndex:
+    ''' Триграммный индекс по названию и описанию позиций меню.
+
+    Поддерживает совпадение по префиксу и опечатки (сходство триграмм слова).
+    Изменения из сигналов этого процесса применяются поштучно; версия индекса
+    сдвигается, только если изменение следует сразу за ней. Если версия в базе
+    ушла вперёд (другой воркер, массовые операции), индекс перестраивается
+    в фоновом потоке, а поиск до тех пор отвечает по текущему индексу.
+    '''
+
+    NAME_WEIGHT = 1.0
+    DESCRIPTION_WEIGHT = 0.4
+
+    def __init__(self, threshold: float = 0.3):
+        self.threshold = threshold
+        self.version = None
+        self._documents = {}
+        self._postings = defaultdict(set)
+        self._lock = threading.RLock()
+        self._refreshing = False
+
+    def _document(self, name: str, description: str, category_id: int):
+        words = {}
+        for token in tokenize(description):
+            words[token] = self.DESCRIPTION_WEIGHT
+        for token in tokenize(name):
+            words[token] = self.NAME_WEIGHT
+        return category_id, normalize(name), {token: (weight, trigrams(token)) for token, weight in words.items()}
+
+    def _add(self, menu_id, document):
+        self._documents[menu_id] = document
+        for token, (weight, grams) in document[2].items():
+            for gram in grams:
+                self._postings[gram].add(menu_id)
+
+    def _remove(self, menu_id):
+        document = self._documents.pop(menu_id, None)
+        if document is None:
+            return
+        for token, (weight, grams) in document[2].items():
+            for gram in grams:
+                postings = self._postings.get(gram)
+                if postings is not None:
+                    postings.discard(menu_id)
+                    if not postings:
+                        del self._postings[gram]
+
+    def rebuild(self):
+        from .models import Menu
+
+        version = get_version(NAMESPACE)
+        fresh = MenuSearchIndex(self.threshold)
+        for menu_id, category_id, name, description in Menu.objects.values_list('id', 'category_id', 'name', 'description'):
+            fresh._add(menu_id, fresh._document(name, description, category_id))
+        with self._lock:
+            self._documents, self._postings = fresh._documents, fresh._postings
+            self.version = version
+
+    def refresh(self):
+        ''' Перестраивает индекс в фоновом потоке, не более одного потока за раз '''
+        with self._lock:
+            if self._refreshing:
+                return
+            self._refreshing = True
+        threading.Thread(target = self._refresh, name = 'cafe-search-rebuild', daemon = True).start()
+
+    def _refresh(self):
+        try:
+            self.rebuild()
+        except Exception:
+            logger.exception('search index rebuild failed')
+        finally:
+            self._refreshing = False
+            connections.close_all()
+
+    def _applied(self, version: int):
+        # изменение, пропущенное между версиями, оставляет индекс позади версии в базе
+        if self.version is not None and self.version == version - 1:
+            self.version = version
+
+    def update(self, menu, version: int):
+        with self._lock:
+            self._remove(menu.pk)
+            self._add(menu.pk, self._document(menu.name, menu.description, menu.category_id))
+            self._applied(version)
+
+    def remove(self, menu_id, version: int):
+        with self._lock:
+            self._remove(menu_id)
+            self._applied(version)
+
+    def _match(self, query_token: str, query_grams: frozenset, document) -> float:
+        best = 0.0
+        for token, (weight, grams) in document[2].items():
+            if token.startswith(query_token):
+                similarity = 1.0
+            else:
+                similarity = len(query_grams & grams) / len(query_grams | grams)
+                if similarity < self.threshold:
+                    continue
+            best = max(best, similarity * weight)
+        return best
+
+    def search(self, query: str, category_id: int = None, limit: int = 20, version: int = None) -> list:
+        ''' Возвращает id позиций меню, отсортированные по релевантности.
+        version - уже прочитанная версия индекса в базе '''
+        if version is None:
+            version = get_version(NAMESPACE)
+        if self.version is None:
+            self.rebuild()
+        elif self.version != version:
+            self.refresh()
+
+        query_tokens = tokenize(query)
+        if not query_tokens:
+            return []
+
+        with self._lock:
+            scores = None
+            for query_token in query_tokens:
+                query_grams = trigrams(query_token)
+                candidates = set()
+                for gram in query_grams:
+                    candidates |= self._postings.get(gram, set())
+                if scores is not None:
+                    candidates &= scores.keys()
+
+                token_scores = {}
+                for menu_id in candidates:
+                    document = self._documents[menu_id]
+                    if category_id is not None and document[0] != category_id:
+                        continue
+                    score = self._match(query_token, query_grams, document)
+                    if score:
+                        token_scores[menu_id] = score + (scores[menu_id] if scores else 0)
+                scores = token_scores
+                if not scores:
+                    return []
+
+            ranked = sorted(scores, key = lambda menu_id: (-scores[menu_id], self._documents[menu_id][1]))
+        return ranked[:limit]
+
+
+search_index = MenuSearchIndex()
@@ -0,0 +1,113 @@
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.db.models.signals import post_save, post_delete, m2m_changed
+from django.db import transaction
+from django.dispatch import receiver
+
+from .cache import bump_version
+from .events import publish_instance
+from .models import Category, Menu, Table, TableStatus, Order, OrderItem, Payment
+from .permissions import permission_index
+from .search import NAMESPACE as SEARCH_NAMESPACE, search_index
+
+
+User = get_user_model()
+
+
+''' Сброс индекса прав '''
+
+
+def invalidate_user(user_id):
+    permission_index.invalidate_user(user_id)
+
+
+def invalidate_all():
+    permission_index.invalidate()
+
+
+@receiver([post_save, post_delete], sender = User)
+def user_changed(sender, instance, **kwargs):
+    invalidate_user(instance.pk)
+
+
+@receiver(m2m_changed, sender = User.groups.through)
+@receiver(m2m_changed, sender = User.user_permissions.through)
+def user_relations_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        invalidate_user(instance.pk)
+    elif pk_set:
+        for user_id in pk_set:
+            invalidate_user(user_id)
+    else:
+        invalidate_all()
+
+
+@receiver(m2m_changed, sender = Group.permissions.through)
+def group_permissions_changed(sender, action, **kwargs):
+    if action.startswith('post_'):
+        invalidate_all()
+
+
+@receiver(post_delete, sender = Group)
+@receiver(post_delete, sender = Permission)
+def permissions_deleted(sender, **kwargs):
+    invalidate_all()
+
+
+''' Версии кэшируемых ресурсов '''
+
+
+@receiver([post_save, post_delete], sender = Category)
+@receiver([post_save, post_delete], sender = Menu)
+def menu_changed(sender, **kwargs):
+    bump_version('menu')
+
+
+''' Поисковый индекс меню '''
+
+
+@receiver(post_save, sender = Menu)
+def menu_saved(sender, instance, **kwargs):
+    version = bump_version(SEARCH_NAMESPACE)
+    transaction.on_commit(lambda: search_index.update(instance, version))
+
+
+@receiver(post_delete, sender = Menu)
+def menu_deleted(sender, instance, **kwargs):
+    menu_id, version = instance.pk, bump_version(SEARCH_NAMESPACE)
+    transaction.on_commit(lambda: search_index.remove(menu_id, version))
+
+
+@receiver([post_save, post_delete], sender = Table)
+@receiver([post_save, post_delete], sender = TableStatus)
+def tables_changed(sender, **kwargs):
+    bump_version('tables')
+
+
+''' События для экранов кухни и зала '''
+
+
+EVENT_TYPES = {
+    Order: 'order',
+    OrderItem: 'order_item',
+    Table: 'table',
+    Payment: 'payment',
+}
+
+
+@receiver(post_save, sender = Order)
+@receiver(post_save, sender = OrderItem)
+@receiver(post_save, sender = Table)
+@receiver(post_save, sender = Payment)
+def event_saved(sender, instance, **kwargs):
+    publish_instance(EVENT_TYPES[sender], instance)
+
+
+@receiver(post_delete, sender = Order)
+@receiver(post_delete, sender = OrderItem)
+@receiver(post_delete, sender = Table)
+@receiver(post_delete, sender = Payment)
+def event_deleted(sender, instance, **kwargs):
+    publish_instance(EVENT_TYPES[sender], instance, deleted = True)
@@ -1 +1,1358 @@
-from django.test import TestCase
\ No newline at end of file
+import asyncio
+import base64
+import csv
+import hashlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import timedelta
+from decimal import Decimal
+from types import SimpleNamespace
+from unittest import mock
+
+from django.contrib.auth import get_user_model
+from django.contrib.auth.models import Group, Permission
+from django.contrib.auth.hashers import make_password
+from django.core.files.base import ContentFile
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, transaction
+from django.http import Http404
+from django.utils import timezone
+from PIL import Image
+from django.db.utils import ConnectionHandler
+from django.test.utils import CaptureQueriesContext
+from django.test import RequestFactory, SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from .api import MENU_SORTING
+from .auth import CredentialCache
+from .cache import LocMemBackend, bump_version, cache_response
+from .models import Category, DailyMenuSales, DailyTableSales, Menu, Order, OrderItem, OrderStatus, Payment, Reservation, Table, TableStatus
+from .pagination import CursorPagination
+from .orders import add_item, add_items, change_quantity
+from .permissions import PermissionIndex
+from .reports import pay
+from .reservations import ReservationConflict, available_tables, reserve
+from .schemas import OrderLineIn
+from .search import NAMESPACE as SEARCH_NAMESPACE, MenuSearchIndex
+from .db.pool import close_pools
+from .benchmark import MIX, async_mix, plan, run_client, seed
+from .metrics import RETIRED, MetricsRegistry, collect, process_name, render
+from .exports import ORDER_COLUMNS, PAYMENT_COLUMNS
+from .events import EventBroker, apoll, parse_types, poll, stream
+from .images import VariantCache
+from .instrumentation import finish, start
+from .idempotency import LocMemStore, _scope
+from .throttling import DjangoCacheBuckets, LocMemBuckets, request_throttle
+
+
+def retry_locked(operation, attempts: int = 1000):
+    ''' SQLite в памяти не ждёт блокировку таблицы, а сразу отвечает ошибкой. Транзакция
+    при этом откатывается целиком, поэтому повтор не может скрыть потерянное изменение.
+    '''
+    for attempt in range(attempts):
+        try:
+            return operation()
+        except OperationalError as error:
+            if 'locked' not in str(error) or attempt == attempts - 1:
+                raise
+            time.sleep(0.001)
+
+
+class OrderItemQuantityTests(TransactionTestCase):
+    def setUp(self):
+        category = Category.objects.create(name = 'Супы', slug = 'soups')
+        self.menu = Menu.objects.create(category = category, name = 'Борщ', slug = 'borsch', price = Decimal('150.00'))
+        table = Table.objects.create(number = 1, status = TableStatus.objects.create(name = 'Свободен'))
+        self.order = Order.objects.create(table = table, status = OrderStatus.objects.create(name = 'Новый'), totalAmount = Decimal('150.00'))
+        self.order_item = OrderItem.objects.create(order = self.order, menu = self.menu, price = Decimal('150.00'), quantity = 1)
+
+    def test_concurrent_increments_are_not_lost(self):
+        threads_count, taps = 4, 10
+        errors = []
+
+        def tap():
+            try:
+                for _ in range(taps):
+                    retry_locked(lambda: change_quantity(self.order_item.id, 1))
+            except Exception as error:
+                errors.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target = tap) for _ in range(threads_count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(errors, [])
+        self.order_item.refresh_from_db()
+        self.order.refresh_from_db()
+        quantity = 1 + threads_count * taps
+        self.assertEqual(self.order_item.quantity, quantity)
+        self.assertEqual(self.order_item.price, self.menu.price * quantity)
+        self.assertEqual(self.order.totalAmount, self.menu.price * quantity)
+
+    def test_concurrent_decrements_to_zero_delete_once(self):
+        barrier = threading.Barrier(2)
+        results = []
+
+        def tap():
+            try:
+                barrier.wait()
+                retry_locked(lambda: change_quantity(self.order_item.id, -1))
+                results.append('deleted')
+            except Http404:
+                results.append('missing')
+            except Exception as error:
+                results.append(error)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target = tap) for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(sorted(results, key = str), ['deleted', 'missing'])
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.totalAmount, 0)
+
+    def test_bulk_add_reprices_existing_line(self):
+        Menu.objects.filter(pk = self.menu.pk).update(price = Decimal('200.00'))
+        add_items(self.order.id, [OrderLineIn(menu = self.menu.id, quantity = 2)])
+
+        self.order_item.refresh_from_db()
+        self.order.refresh_from_db()
+        self.assertEqual(self.order_item.quantity, 3)
+        self.assertEqual(self.order_item.price, Decimal('600.00'))
+        self.assertEqual(self.order.totalAmount, Decimal('600.00'))
+        self.assertEqual(self.order.totalAmount, self.order.get_total_amount())
+
+    def test_every_operation_reprices_at_current_menu_price(self):
+        self.assertEqual(add_item(self.order.id, self.menu.id, 2).id, self.order_item.id)
+        Menu.objects.filter(pk = self.menu.pk).update(price = Decimal('200.00'))
+
+        steps = (
+            (lambda: add_item(self.order.id, self.menu.id, 2), 5),
+            (lambda: change_quantity(self.order_item.id, 1), 6),
+            (lambda: add_items(self.order.id, [OrderLineIn(menu = self.menu.id, quantity = 1)]), 7),
+            (lambda: change_quantity(self.order_item.id, -1), 6),
+        )
+        for operation, quantity in steps:
+            operation()
+            self.order_item.refresh_from_db()
+            self.order.refresh_from_db()
+            self.assertEqual(self.order_item.quantity, quantity)
+            self.assertEqual(self.order_item.price, Decimal('200.00') * quantity)
+            self.assertEqual(self.order.totalAmount, self.order.get_total_amount())
+
+    def test_decrement_to_zero_deletes_item(self):
+        order_item = change_quantity(self.order_item.id, -1)
+
+        self.assertEqual(order_item.quantity, 0)
+        self.assertFalse(OrderItem.objects.filter(pk = self.order_item.id).exists())
+        self.order.refresh_from_db()
+        self.assertEqual(self.order.totalAmount, 0)
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class CredentialCacheTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('waiter', password = 'secret')
+        self.cache = CredentialCache(enabled = True)
+
+    def test_changes_without_signals_take_effect(self):
+        self.assertEqual(self.cache.authenticate('waiter', 'secret'), self.user)
+        self.assertEqual(self.cache.authenticate('waiter', 'secret'), self.user)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+        get_user_model().objects.filter(pk = self.user.pk).update(password = make_password('changed'))
+        self.assertIsNone(self.cache.authenticate('waiter', 'secret'))
+        self.assertEqual(self.cache.authenticate('waiter', 'changed'), self.user)
+
+        get_user_model().objects.filter(pk = self.user.pk).update(is_active = False)
+        self.assertIsNone(self.cache.authenticate('waiter', 'changed'))
+
+    def test_hit_rate_is_exported_as_metrics(self):
+        with mock.patch('cafe.auth.credential_cache', self.cache):
+            self.cache.authenticate('waiter', 'secret')
+            self.cache.authenticate('waiter', 'secret')
+            text = render(collect())
+
+        self.assertIn('cafe_cache_lookups_total{cache="credentials",result="hit"} 1', text)
+        self.assertIn('cafe_cache_lookups_total{cache="credentials",result="miss"} 1', text)
+        self.assertIn('cafe_cache_entries{cache="credentials"} 1', text)
+        self.assertIn('cafe_cache_entries{cache="permissions"}', text)
+        self.assertIn('cafe_cache_entries{cache="responses"}', text)
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_user('waiter', password = 'secret')
+        self.headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'waiter:secret').decode() }
+        Category.objects.create(name = 'Супы', slug = 'soups')
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    def test_etag_is_shared_between_workers(self):
+        etag = self.client.get('/api/menu', **self.headers)['ETag']
+
+        # другой воркер: свой кэш ответов, но та же версия в базе
+        with mock.patch('cafe.cache.cache_backend', LocMemBackend()):
+            self.assertEqual(self.client.get('/api/menu', HTTP_IF_NONE_MATCH = etag, **self.headers).status_code, 304)
+            Category.objects.create(name = 'Салаты', slug = 'salads')
+            response = self.client.get('/api/menu', HTTP_IF_NONE_MATCH = etag, **self.headers)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+        self.assertEqual(len(response.json()), 2)
+
+    def test_cached_response_is_timed(self):
+        # Server-Timing выключен вне DEBUG
+        self.assertNotIn('Server-Timing', self.client.get('/api/menu', **self.headers))
+
+        view = cache_response('timing', list[int])(lambda request: [1, 2, 3])
+        metrics, token = start()
+        try:
+            self.assertEqual(view(RequestFactory().get('/timing')).content, b'[1, 2, 3]')
+        finally:
+            finish(token)
+        self.assertGreater(metrics.serialize_time, 0)
+
+
+class MenuSearchIndexTests(TestCase):
+    def setUp(self):
+        self.category = Category.objects.create(name = 'Супы', slug = 'soups')
+        self.index = MenuSearchIndex()
+        self.index.rebuild()
+
+    def test_version_advances_only_without_gaps(self):
+        version = self.index.version
+        borsch = Menu.objects.create(category = self.category, name = 'Борщ', slug = 'borsch', price = Decimal('150.00'))
+        self.index.update(borsch, version + 1)
+        self.assertEqual(self.index.search('борш'), [borsch.id])
+        self.assertEqual(self.index.version, version + 1)
+
+        # изменение из другого воркера, которого этот индекс не видел
+        bump_version(SEARCH_NAMESPACE)
+        soup = Menu.objects.create(category = self.category, name = 'Щи', slug = 'shchi', price = Decimal('120.00'))
+        self.index.update(soup, version + 3)
+        self.assertEqual(self.index.version, version + 1)
+
+        with mock.patch.object(self.index, 'refresh') as refresh:
+            self.assertEqual(self.index.search('щи'), [soup.id])
+        refresh.assert_called_once_with()
+
+    @override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+    def test_stale_worker_does_not_cache_search(self):
+        get_user_model().objects.create_user('waiter', password = 'secret')
+        headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'waiter:secret').decode() }
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+        with mock.patch('cafe.api.search_index', self.index), mock.patch('cafe.cache.cache_backend', LocMemBackend()), \
+                mock.patch.object(self.index, 'refresh') as refresh:
+            self.assertEqual(self.client.get('/api/menu/search?search=солянка', **headers).json(), [])
+
+            # позицию добавил другой воркер: версии в базе сдвинуты, индекс этого воркера отстаёт
+            Menu.objects.create(category = self.category, name = 'Солянка', slug = 'solyanka', price = Decimal('200.00'))
+            self.assertEqual(self.client.get('/api/menu/search?search=солянка', **headers).json(), [])
+            refresh.assert_called_once_with()
+
+            # фоновая перестройка завершилась: ответ не берётся из кэша устаревшим
+            self.index.rebuild()
+            response = self.client.get('/api/menu/search?search=солянка', **headers)
+        self.assertEqual([row['slug'] for row in response.json()], ['solyanka'])
+
+
+class ReservationTests(TestCase):
+    def setUp(self):
+        status = TableStatus.objects.create(name = 'Свободен')
+        self.hall = Table.objects.create(number = 1, status = status)
+        self.small = Table.objects.create(number = 2, status = status, seats = 2)
+        self.start = timezone.now().replace(microsecond = 0) + timedelta(days = 1)
+
+    def book(self, table, start, guests, duration = 120):
+        return reserve(Reservation(table = table, client_name = 'Иванов', client_phone = '1', datetime = start, duration = duration, quest_count = guests))
+
+    def test_unlimited_seats_and_overlaps(self):
+        self.book(self.hall, self.start, guests = 12)
+
+        self.assertEqual(list(available_tables(self.start + timedelta(hours = 1), self.start + timedelta(hours = 3), 2)), [self.small])
+        self.assertEqual(list(available_tables(self.start + timedelta(hours = 2), self.start + timedelta(hours = 3), 2)), [self.small, self.hall])
+        with self.assertRaises(ReservationConflict):
+            self.book(self.hall, self.start - timedelta(hours = 1), guests = 2)
+        with self.assertRaises(ReservationConflict):
+            self.book(self.small, self.start, guests = 3)
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ReservationEndpointTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_superuser('manager', password = 'secret')
+        self.headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'manager:secret').decode() }
+        self.table = Table.objects.create(number = 1, status = TableStatus.objects.create(name = 'Свободен'))
+        self.reservation = reserve(Reservation(table = self.table, client_name = 'Иванов', client_phone = '1',
+                                               datetime = timezone.now() + timedelta(days = 1), quest_count = 2, comment = ''))
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    def test_update_rejects_bad_payload_with_400(self):
+        payload = { 'table': self.table.id, 'client_name': 'Петров', 'client_phone': '2', 'quest_count': 2, 'comment': '' }
+        for prefix in ('/api', '/api/async'):
+            path = f'{prefix}/reservations/{self.reservation.id}'
+            for changes in ({ 'datetime': 'завтра' }, { 'datetime': '2030-01-01T12:00', 'table': 999 }):
+                response = self.client.put(path, json.dumps({ **payload, **changes }), content_type = 'application/json', **self.headers)
+                self.assertEqual(response.status_code, 400, (path, changes))
+            response = self.client.put(path, json.dumps({ **payload, 'datetime': '2030-01-01T12:00' }),
+                                       content_type = 'application/json', **self.headers)
+            self.assertEqual(response.status_code, 200, path)
+
+        self.reservation.refresh_from_db()
+        self.assertEqual(self.reservation.client_name, 'Петров')
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class AsyncRouterTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_superuser('manager', password = 'secret')
+        self.authorization = 'Basic ' + base64.b64encode(b'manager:secret').decode()
+        self.category = Category.objects.create(name = 'Супы', slug = 'soups')
+        self.menu = Menu.objects.create(category = self.category, name = 'Борщ', slug = 'borsch', price = Decimal('150.00'))
+        table = Table.objects.create(number = 1, status = TableStatus.objects.create(name = 'Свободен'))
+        reservation = Reservation.objects.create(table = table, client_name = 'Гость', client_phone = '+70000000000',
+                                                 datetime = timezone.now(), quest_count = 2, comment = '')
+        self.order = Order.objects.create(table = table, reservation = reservation, status = OrderStatus.objects.create(name = 'Новый'))
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    async def test_read_endpoint(self):
+        path = f'/api/async/menu/{self.category.id}'
+        self.assertEqual((await self.async_client.get(path)).status_code, 401)
+        self.assertEqual((await self.async_client.get(path, AUTHORIZATION = 'Basic ' + base64.b64encode(b'manager:wrong').decode())).status_code, 401)
+
+        response = await self.async_client.get(path, AUTHORIZATION = self.authorization)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row['name'] for row in response.json()], ['Борщ'])
+        self.assertEqual(response.content, (await self.async_client.get(f'/api/menu/{self.category.id}', AUTHORIZATION = self.authorization)).content)
+        # aget_object_or_404 отдаёт 404, а не 500
+        self.assertEqual((await self.async_client.get('/api/async/menu/999', AUTHORIZATION = self.authorization)).status_code, 404)
+
+    async def test_route_budget_answers_429(self):
+        with mock.patch.dict(request_throttle.routes, { 'api/async/menu': (60, 1) }):
+            first = await self.async_client.get('/api/async/menu', AUTHORIZATION = self.authorization)
+            second = await self.async_client.get('/api/async/menu', AUTHORIZATION = self.authorization)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 429)
+        self.assertEqual(second['Retry-After'], '60')
+
+    async def test_write_endpoint(self):
+        body = json.dumps({ 'order': self.order.id, 'menu': self.menu.id, 'price': 0, 'quantity': 2 })
+        response = await self.async_client.post('/api/async/order/add_item', body, content_type = 'application/json',
+                                                 AUTHORIZATION = self.authorization)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['quantity'], 2)
+        item = await OrderItem.objects.aget(order = self.order)
+        self.assertEqual((item.quantity, item.price), (2, Decimal('300.00')))
+        self.assertEqual((await Order.objects.aget(id = self.order.id)).totalAmount, Decimal('300.00'))
+
+        body = json.dumps({ 'order': self.order.id, 'menu': 999, 'price': 0, 'quantity': 1 })
+        response = await self.async_client.post('/api/async/order/add_item', body, content_type = 'application/json',
+                                                 AUTHORIZATION = self.authorization)
+        self.assertEqual(response.status_code, 400)
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PlannedQueryCountTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_superuser('manager', password = 'secret')
+        self.headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'manager:secret').decode() }
+        self.table = Table.objects.create(number = 1, status = TableStatus.objects.create(name = 'Свободен'))
+        self.status = OrderStatus.objects.create(name = 'Новый')
+        self.menu = Menu.objects.create(category = Category.objects.create(name = 'Супы', slug = 'soups'), name = 'Борщ',
+                                        slug = 'borsch', price = Decimal('150.00'))
+        self.order = self.create_orders(1)[0]
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    def create_orders(self, count: int) -> list:
+        orders = []
+        for _ in range(count):
+            reservation = Reservation.objects.create(table = self.table, client_name = 'Гость', client_phone = '+70000000000',
+                                                     datetime = timezone.now(), quest_count = 2, comment = '')
+            order = Order.objects.create(table = self.table, reservation = reservation, status = self.status)
+            OrderItem.objects.bulk_create([OrderItem(order = order, menu = self.menu, price = 150, quantity = 1) for _ in range(2)])
+            Payment.objects.create(order = order)
+            orders.append(order)
+        return orders
+
+    def test_nested_lists_take_constant_queries(self):
+        # пользователь, затем сами строки; /order/{id}/ ещё проверяет, что заказ существует
+        paths = { '/api/orders': 2, f'/api/order/{self.order.id}/': 3, '/api/payments': 2,
+                  '/api/async/orders': 2, f'/api/async/order/{self.order.id}/': 3, '/api/async/payments': 2 }
+        for path in paths:
+            # первый запрос кладёт пароль в кэш учётных данных
+            self.assertEqual(self.client.get(path, **self.headers).status_code, 200, path)
+
+        self.create_orders(5)
+        OrderItem.objects.bulk_create([OrderItem(order = self.order, menu = self.menu, price = 150, quantity = 1) for _ in range(5)])
+        for path, queries in paths.items():
+            with self.assertNumQueries(queries):
+                response = self.client.get(path, **self.headers)
+            rows = response.json()
+            rows = rows['items'] if isinstance(rows, dict) else rows
+            self.assertEqual(len(rows), 7 if '/order/' in path else 6 if 'payments' in path else 17, path)
+            order = rows[0]['order']
+            self.assertEqual(order['table']['status']['name'], 'Свободен', path)
+            self.assertEqual(order['reservation']['table']['number'], 1, path)
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class CursorPaginationTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_superuser('manager', password = 'secret')
+        self.headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'manager:secret').decode() }
+        table = Table.objects.create(number = 1, status = TableStatus.objects.create(name = 'Свободен'))
+        status = OrderStatus.objects.create(name = 'Новый')
+        menu = Menu.objects.create(category = Category.objects.create(name = 'Супы', slug = 'soups'), name = 'Борщ',
+                                   slug = 'borsch', price = Decimal('150.00'))
+        # по три позиции на заказ: ключ order повторяется, порядок внутри задаёт id
+        for index in range(3):
+            reservation = Reservation.objects.create(table = table, client_name = f'Гость {index}', client_phone = '+70000000000',
+                                                     datetime = timezone.now(), quest_count = 2, comment = '')
+            order = Order.objects.create(table = table, reservation = reservation, status = status)
+            OrderItem.objects.bulk_create([OrderItem(order = order, menu = menu, price = 150, quantity = quantity) for quantity in (1, 2, 3)])
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    def walk(self, pagination, limit: int) -> list:
+        ids, cursor = [], None
+        while True:
+            page = pagination.paginate_queryset(OrderItem.objects.all(), pagination.Input(cursor = cursor, limit = limit))
+            ids += [item.id for item in page['items']]
+            cursor = page['next']
+            if cursor is None:
+                return ids
+
+    def test_pages_cover_ties_exactly_once(self):
+        for ordering in (('order', 'id'), ('-order', 'id'), ('order', '-id')):
+            expected = list(OrderItem.objects.order_by(*ordering).values_list('id', flat = True))
+            for limit in (1, 2, 4, 9, 10):
+                self.assertEqual(self.walk(CursorPagination(ordering = ordering), limit), expected, (ordering, limit))
+
+    def test_limit_is_capped(self):
+        page = CursorPagination(ordering = ('id', ), max_page_size = 4).paginate_queryset(OrderItem.objects.all(), CursorPagination.Input(limit = 100))
+        self.assertEqual(len(page['items']), 4)
+        self.assertIsNotNone(page['next'])
+
+    def test_cursor_round_trip_over_http(self):
+        for path in ('/api/orders', '/api/async/orders'):
+            ids, url = [], f'{path}?limit=4'
+            while url:
+                response = self.client.get(url, **self.headers)
+                self.assertEqual(response.status_code, 200, path)
+                page = response.json()
+                ids += [(row['order']['reservation']['client_name'], row['quantity']) for row in page['items']]
+                url = f'{path}?limit=4&cursor={page["next"]}' if page['next'] else None
+            self.assertEqual(len(ids), 9, path)
+            self.assertEqual(len(set(ids)), 9, path)
+
+    def test_tampered_cursor_is_400(self):
+        def encode(value) -> str:
+            return base64.urlsafe_b64encode(json.dumps(value).encode()).decode().rstrip('=')
+
+        for cursor in ('!!!', 'bm90IGpzb24', encode(['1']), encode({ 'order': 1 }), encode(['x', 'y']), encode(['1', '2', '3'])):
+            for path in ('/api/orders', '/api/async/orders'):
+                response = self.client.get(path, { 'cursor': cursor }, **self.headers)
+                self.assertEqual(response.status_code, 400, (path, cursor))
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class MenuSortTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_user('waiter', password = 'secret')
+        self.headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'waiter:secret').decode() }
+        self.category = Category.objects.create(name = 'Супы', slug = 'soups')
+        other = Category.objects.create(name = 'Напитки', slug = 'drinks')
+        for name, price, weight, capacity in (('Борщ', 150, 300, None), ('Уха', 200, 250, None), ('Бульон', 100, None, 0.3),
+                                              ('Солянка', 200, 350, None)):
+            Menu.objects.create(category = self.category, name = name, slug = name, price = price, weight = weight, capacity = capacity)
+        Menu.objects.create(category = other, name = 'Морс', slug = 'mors', price = 120, capacity = 0.5)
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    def names(self, **params) -> list:
+        response = self.client.get(f'/api/menu/{self.category.id}/sort', params, **self.headers)
+        self.assertEqual(response.status_code, 200, params)
+        return [row['name'] for row in response.json()]
+
+    def test_sort_keys(self):
+        # равные цены упорядочены по id в ту же сторону, что и цена
+        self.assertEqual(self.names(), ['Бульон', 'Борщ', 'Уха', 'Солянка'])
+        self.assertEqual(self.names(sort = 'price'), ['Бульон', 'Борщ', 'Уха', 'Солянка'])
+        self.assertEqual(self.names(sort = 'desc'), ['Солянка', 'Уха', 'Борщ', 'Бульон'])
+        self.assertEqual(self.names(sort = '-price'), ['Солянка', 'Уха', 'Борщ', 'Бульон'])
+        self.assertEqual(self.names(sort = 'name'), ['Борщ', 'Бульон', 'Солянка', 'Уха'])
+        self.assertEqual(self.names(sort = '-name'), ['Уха', 'Солянка', 'Бульон', 'Борщ'])
+
+    def test_filters(self):
+        self.assertEqual(self.names(price_min = 150, price_max = 200), ['Борщ', 'Уха', 'Солянка'])
+        self.assertEqual(self.names(price_max = 120), ['Бульон'])
+        self.assertEqual(self.names(weight_min = 260, sort = 'name'), ['Борщ', 'Солянка'])
+        self.assertEqual(self.names(weight_max = 300), ['Борщ', 'Уха'])
+        self.assertEqual(self.names(capacity_min = 0.1), ['Бульон'])
+        self.assertEqual(self.names(capacity_max = 0.1), [])
+        self.assertEqual(self.names(name = 'Бу'), ['Бульон'])
+        self.assertEqual(self.names(name = 'Б', sort = '-name', price_min = 120), ['Борщ'])
+
+    def test_invalid_requests(self):
+        self.assertEqual(self.client.get(f'/api/menu/{self.category.id}/sort', { 'sort': 'weight' }, **self.headers).status_code, 400)
+        self.assertEqual(self.client.get(f'/api/menu/{self.category.id}/sort', { 'price_min': 'дёшево' }, **self.headers).status_code, 422)
+        self.assertEqual(self.client.get('/api/menu/999/sort', **self.headers).status_code, 404)
+
+    def test_sorting_uses_category_indexes(self):
+        if connection.vendor != 'sqlite':
+            self.skipTest('план запроса проверяется на SQLite')
+        for sort, index in (('price', 'menu_category_price_idx'), ('-price', 'menu_category_price_idx'),
+                            ('name', 'menu_category_name_idx'), ('-name', 'menu_category_name_idx')):
+            queryset = Menu.objects.filter(category = self.category).order_by(*MENU_SORTING[sort])
+            plan = queryset.explain()
+            self.assertIn(index, plan, sort)
+            self.assertNotIn('TEMP B-TREE', plan, sort)
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class VariantCacheTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_user('waiter', password = 'secret')
+        self.headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'waiter:secret').decode() }
+        self.category = Category.objects.create(name = 'Супы', slug = 'soups')
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        media_root = override_settings(MEDIA_ROOT = media.name)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        self.directory = os.path.join(media.name, 'variants')
+        self.cache = VariantCache(self.directory, max_bytes = 1024 * 1024)
+        variants = mock.patch('cafe.api.variant_cache', self.cache)
+        variants.start()
+        self.addCleanup(variants.stop)
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    def dish(self, slug: str, size = (640, 480)) -> Menu:
+        content = io.BytesIO()
+        Image.new('RGB', size, 'red').save(content, 'PNG')
+        menu = Menu.objects.create(category = self.category, name = slug, slug = slug, price = 100)
+        menu.image.save(f'{slug}.png', ContentFile(content.getvalue()))
+        return menu
+
+    def get(self, menu_id: int, **params):
+        return self.client.get(f'/api/menu/{menu_id}/image', params, **self.headers)
+
+    def test_variants_are_rendered_once(self):
+        menu = self.dish('borsch')
+        with mock.patch.object(VariantCache, '_render', autospec = True, side_effect = VariantCache._render) as render:
+            for format, content_type, width, expected in (('webp', 'image/webp', 160, (160, 120)), ('jpeg', 'image/jpeg', 320, (320, 240)),
+                                                          ('webp', 'image/webp', 1280, (640, 480))):
+                for _ in range(2):
+                    response = self.get(menu.id, width = width, format = format)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(response['Content-Type'], content_type)
+                    with Image.open(io.BytesIO(b''.join(response.streaming_content))) as image:
+                        self.assertEqual((image.format.lower(), image.size), (format, expected))
+        # уже отрисованная копия отдаётся с диска
+        self.assertEqual(render.call_count, 3)
+
+    def test_widths_and_formats_are_whitelisted(self):
+        menu = self.dish('borsch')
+        self.assertEqual(self.get(menu.id, width = 100).status_code, 400)
+        self.assertEqual(self.get(menu.id, width = 160, format = 'png').status_code, 400)
+        self.assertEqual(self.get(menu.id).status_code, 422)
+        # отклонённые запросы ничего не рендерят
+        self.assertFalse(os.path.exists(self.directory))
+        with self.settings(CAFE_IMAGE_VARIANTS = { 'WIDTHS': [100] }):
+            self.assertEqual(self.get(menu.id, width = 100).status_code, 200)
+        bare = Menu.objects.create(category = self.category, name = 'Уха', slug = 'ukha', price = 100)
+        self.assertEqual(self.get(bare.id, width = 160).status_code, 404)
+        self.assertEqual(self.get(999, width = 160).status_code, 404)
+
+    def test_least_recently_used_variants_are_evicted(self):
+        first, second, third = (self.dish(slug) for slug in ('borsch', 'ukha', 'shchi'))
+        first_path = self.cache.get(first.image, 160, 'webp')
+        size = first_path.stat().st_size
+        self.cache.max_bytes = int(size * 2.5)
+        second_path = self.cache.get(second.image, 160, 'webp')
+        # вторая копия запрашивалась давно, первая - только что
+        os.utime(second_path, (1, 1))
+        self.cache.get(first.image, 160, 'webp')
+        third_path = self.cache.get(third.image, 160, 'webp')
+
+        self.assertEqual(sorted(os.listdir(self.directory)), sorted([first_path.name, third_path.name]))
+        self.assertEqual(self.cache._size, 2 * size)
+        # вытесненная копия рендерится заново при следующем запросе
+        with self.cache.open(second.image, 160, 'webp') as file:
+            self.assertEqual(len(file.read()), size)
+        self.assertLessEqual(self.cache._size, self.cache.max_bytes)
+
+
+class EventBrokerTests(SimpleTestCase):
+    def setUp(self):
+        self.broker = EventBroker(history = 3, buffer = 2)
+        broker = mock.patch('cafe.events.event_broker', self.broker)
+        broker.start()
+        self.addCleanup(broker.stop)
+
+    def test_since_and_reset(self):
+        for number in range(1, 4):
+            self.broker.publish('table', id = number)
+        self.broker.publish('order', id = 1)
+
+        # первое событие вытеснено из истории: клиент с since=0 должен перечитать состояние
+        events, reset, last = self.broker.since(0)
+        self.assertEqual(([event['seq'] for event in events], reset, last), ([2, 3, 4], True, 4))
+        events, reset, last = self.broker.since(1, frozenset({ 'order' }))
+        self.assertEqual(([event['seq'] for event in events], reset), ([4], False))
+        self.assertEqual(self.broker.since(4), ([], False, 4))
+        # seq из будущего - процесс перезапущен
+        self.assertEqual(self.broker.since(10), ([], True, 4))
+
+    def test_poll_waits_for_matching_event(self):
+        self.assertEqual(poll(0, timeout = 0), { 'last': 0, 'reset': False, 'events': [] })
+
+        publisher = threading.Timer(0.1, self.broker.publish, ('payment', ), { 'id': 7 })
+        publisher.start()
+        started = time.monotonic()
+        result = poll(0, parse_types('payment,unknown'), timeout = 5)
+        publisher.join()
+
+        self.assertLess(time.monotonic() - started, 5)
+        self.assertEqual([(event['type'], event['id']) for event in result['events']], [('payment', 7)])
+        self.assertIsNone(parse_types('unknown'))
+
+    async def test_apoll_and_subscription_overflow(self):
+        self.assertEqual((await apoll(0, timeout = 0))['events'], [])
+        asyncio.get_running_loop().call_later(0.05, lambda: self.broker.publish('order', id = 1))
+        result = await apoll(0, frozenset({ 'order' }), timeout = 5)
+        self.assertEqual([event['id'] for event in result['events']], [1])
+        self.assertEqual(self.broker.stats()['subscribers'], 0)
+
+        subscription = self.broker.subscribe(asyncio.get_running_loop(), frozenset({ 'table' }))
+        for number in range(1, 4):
+            self.broker.publish('table', id = number)
+        self.broker.publish('order', id = 2)
+        events, reset = subscription.drain()
+        self.assertEqual(([event['id'] for event in events], reset), ([2, 3], True))
+        self.assertEqual(subscription.drain(), ([], False))
+        subscription.close()
+
+    async def test_stream_replays_history_and_follows(self):
+        for number in range(1, 5):
+            self.broker.publish('table', id = number)
+        events = stream(last_event_id = 0, types = frozenset({ 'table' }))
+        try:
+            self.assertTrue((await anext(events)).startswith('retry: '))
+            self.assertIn('event: reset', await anext(events))
+            self.assertEqual([(await anext(events)).split('\n')[0] for _ in range(3)], ['id: 2', 'id: 3', 'id: 4'])
+            self.broker.publish('order', id = 1)
+            self.broker.publish('table', id = 5)
+            self.assertTrue((await anext(events)).startswith('id: 6\nevent: table\n'))
+        finally:
+            await events.aclose()
+        self.assertEqual(self.broker.stats()['subscribers'], 0)
+
+
+class EventPublishTests(TestCase):
+    def setUp(self):
+        self.broker = EventBroker()
+        for module in ('cafe.events', 'cafe.api', 'cafe.api_async'):
+            broker = mock.patch(f'{module}.event_broker', self.broker)
+            broker.start()
+            self.addCleanup(broker.stop)
+        self.status = TableStatus.objects.create(name = 'Свободен')
+
+    def test_published_on_commit_only(self):
+        with self.captureOnCommitCallbacks(execute = True):
+            table = Table.objects.create(number = 1, status = self.status)
+            # до коммита событие не видно
+            self.assertEqual(self.broker.seq, 0)
+        self.assertEqual(self.broker.since(0)[0][0]['type'], 'table')
+        self.assertEqual(self.broker.since(0)[0][0]['id'], table.id)
+
+        with self.captureOnCommitCallbacks(execute = True) as callbacks:
+            with self.assertRaises(RuntimeError):
+                with transaction.atomic():
+                    Table.objects.create(number = 2, status = self.status)
+                    raise RuntimeError
+        self.assertEqual(callbacks, [])
+        self.assertEqual(self.broker.seq, 1)
+
+        table_id = table.id
+        with self.captureOnCommitCallbacks(execute = True):
+            table.delete()
+        event = self.broker.since(1)[0][0]
+        self.assertEqual((event['type'], event['id'], event['deleted']), ('table', table_id, True))
+
+    @override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+    def test_events_endpoints(self):
+        get_user_model().objects.create_superuser('manager', password = 'secret')
+        headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'manager:secret').decode() }
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+        self.broker.publish('table', id = 1)
+        self.broker.publish('order', id = 1)
+
+        for path in ('/api/events', '/api/async/events'):
+            self.assertEqual(self.client.get(path, **headers).json(), { 'last': 2, 'reset': True, 'events': [] })
+            result = self.client.get(path, { 'since': 0, 'types': 'order', 'timeout': 0 }, **headers).json()
+            self.assertEqual(([event['type'] for event in result['events']], result['reset'], result['last']), (['order'], False, 2))
+            self.assertTrue(self.client.get(path, { 'since': 5, 'timeout': 0 }, **headers).json()['reset'])
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class SalesRollupTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_superuser('manager', password = 'secret')
+        self.headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'manager:secret').decode() }
+        status = TableStatus.objects.create(name = 'Свободен')
+        self.tables = [Table.objects.create(number = number, status = status) for number in (1, 2)]
+        self.status = OrderStatus.objects.create(name = 'Новый')
+        category = Category.objects.create(name = 'Супы', slug = 'soups')
+        self.borsch = Menu.objects.create(category = category, name = 'Борщ', slug = 'borsch', price = Decimal('150.00'))
+        self.ukha = Menu.objects.create(category = category, name = 'Уха', slug = 'ukha', price = Decimal('200.00'))
+        self.today = timezone.localdate()
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    def payment(self, table, lines, days_ago: int = 0) -> Payment:
+        reservation = Reservation.objects.create(table = table, client_name = 'Гость', client_phone = '+70000000000',
+                                                 datetime = timezone.now(), quest_count = 2, comment = '')
+        order = Order.objects.create(table = table, reservation = reservation, status = self.status)
+        Order.objects.filter(pk = order.pk).update(created_at = timezone.now() - timedelta(days = days_ago))
+        add_items(order.id, [OrderLineIn(menu = menu.id, quantity = quantity) for menu, quantity in lines])
+        return Payment.objects.create(order = order)
+
+    def rollups(self) -> tuple:
+        return (
+            sorted(DailyMenuSales.objects.values_list('date', 'menu_id', 'quantity', 'revenue')),
+            sorted(DailyTableSales.objects.values_list('date', 'table_id', 'orders', 'revenue')),
+        )
+
+    def test_payment_is_counted_once(self):
+        payment = self.payment(self.tables[0], [(self.borsch, 2), (self.ukha, 1)])
+        for _ in range(2):
+            response = self.client.post(f'/api/payments/{payment.id}/change_status', **self.headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.json()['status'])
+        self.assertFalse(pay(payment.id))
+
+        self.assertEqual(self.rollups(), (
+            [(self.today, self.borsch.id, 2, Decimal('300.00')), (self.today, self.ukha.id, 1, Decimal('200.00'))],
+            [(self.today, self.tables[0].id, 1, Decimal('500.00'))],
+        ))
+        revenue = self.client.get('/api/reports/revenue', **self.headers).json()
+        self.assertEqual([(row['orders'], row['revenue']) for row in revenue], [(1, 500.0)])
+
+    def test_rebuild_matches_incremental_rollups(self):
+        payments = [
+            self.payment(self.tables[0], [(self.borsch, 1)]),
+            self.payment(self.tables[0], [(self.borsch, 2), (self.ukha, 1)]),
+            self.payment(self.tables[1], [(self.ukha, 3)], days_ago = 2),
+            self.payment(self.tables[1], [(self.borsch, 1)], days_ago = 2),
+        ]
+        # последний чек не оплачен и в агрегаты не попадает
+        for payment in payments[:3]:
+            self.assertTrue(pay(payment.id))
+        incremental = self.rollups()
+        self.assertEqual(incremental[1], [
+            (self.today - timedelta(days = 2), self.tables[1].id, 1, Decimal('600.00')),
+            (self.today, self.tables[0].id, 2, Decimal('650.00')),
+        ])
+
+        out = io.StringIO()
+        call_command('rebuild_sales_rollups', stdout = out)
+        self.assertEqual(self.rollups(), incremental)
+        self.assertIn('Строк по позициям меню: 3, по столикам: 2', out.getvalue())
+
+        # пересчёт за период не трогает остальные дни
+        DailyMenuSales.objects.filter(date = self.today).update(quantity = 0)
+        DailyTableSales.objects.filter(date = self.today - timedelta(days = 2)).delete()
+        call_command('rebuild_sales_rollups', '--date-from', str(self.today - timedelta(days = 2)),
+                     '--date-to', str(self.today - timedelta(days = 1)), stdout = io.StringIO())
+        self.assertEqual(self.rollups()[1], incremental[1])
+        self.assertEqual(set(DailyMenuSales.objects.filter(date = self.today).values_list('quantity', flat = True)), { 0 })
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'], CAFE_EXPORT = { 'BATCH_SIZE': 2 })
+class ExportTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_superuser('manager', password = 'secret')
+        self.headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'manager:secret').decode() }
+        table = Table.objects.create(number = 7, status = TableStatus.objects.create(name = 'Свободен'))
+        status = OrderStatus.objects.create(name = 'Новый')
+        menu = Menu.objects.create(category = Category.objects.create(name = 'Супы', slug = 'soups'), name = 'Борщ, большой',
+                                   slug = 'borsch', price = Decimal('150.00'))
+        self.created_at = timezone.now().replace(microsecond = 0) - timedelta(days = 1)
+        self.orders = []
+        # пять заказов с одинаковым created_at: граница пачки из двух проходит внутри совпадающих ключей
+        for index in range(6):
+            reservation = Reservation.objects.create(table = table, client_name = 'Гость', client_phone = '+70000000000',
+                                                     datetime = timezone.now(), quest_count = 2, comment = '')
+            order = Order.objects.create(table = table, reservation = reservation, status = status, totalAmount = 150)
+            created_at = self.created_at if index < 5 else self.created_at - timedelta(days = 3)
+            Order.objects.filter(pk = order.pk).update(created_at = created_at)
+            OrderItem.objects.bulk_create([OrderItem(order = order, menu = menu, price = 150, quantity = 1) for _ in range(2)])
+            Payment.objects.create(order = order, status = index % 2 == 0)
+            self.orders.append(order)
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    def export(self, path: str, **params):
+        response = self.client.get(path, params, **self.headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        return response, b''.join(response.streaming_content).decode()
+
+    def test_csv_is_streamed_in_keyset_batches(self):
+        with CaptureQueriesContext(connection) as context:
+            response, content = self.export('/api/export/orders')
+
+        self.assertEqual(response['Content-Type'], 'text/csv; charset=utf-8')
+        self.assertEqual(response['Content-Disposition'], 'attachment; filename="orders.csv"')
+        rows = list(csv.reader(io.StringIO(content.lstrip('\ufeff'))))
+        self.assertTrue(content.startswith('\ufeff'))
+        self.assertEqual(rows[0], [column for column, field in ORDER_COLUMNS])
+        # старый заказ первым, затем совпадающие created_at по id; каждая позиция ровно один раз
+        expected = [self.orders[5].id] + [order.id for order in self.orders[:5]]
+        self.assertEqual([int(row[0]) for row in rows[1:]], [order_id for order_id in expected for _ in range(2)])
+        self.assertEqual(len({ row[5] for row in rows[1:] }), 12)
+        self.assertEqual(rows[1][2:4], ['7', 'Новый'])
+        self.assertEqual(rows[1][6], 'Борщ, большой')
+        self.assertEqual(rows[2][1], timezone.localtime(self.created_at - timedelta(days = 3)).isoformat())
+        # шесть заказов пачками по два - три запроса позиций
+        self.assertEqual(len([query for query in context.captured_queries if 'cafe_orderitem' in query['sql']]), 3)
+
+    def test_ndjson_and_period(self):
+        day = timezone.localdate(self.created_at)
+        response, content = self.export('/api/export/payments', format = 'ndjson', date_from = day, date_to = day)
+
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson; charset=utf-8')
+        self.assertEqual(response['Content-Disposition'], f'attachment; filename="payments_{day}_{day}.ndjson"')
+        rows = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([row['order_id'] for row in rows], [order.id for order in self.orders[:5]])
+        self.assertEqual([row['paid'] for row in rows], [True, False, True, False, True])
+        self.assertEqual(set(rows[0]), { column for column, field in PAYMENT_COLUMNS })
+        self.assertEqual(rows[0]['total'], '150.00')
+
+        self.assertEqual(self.client.get('/api/export/orders', { 'format': 'xlsx' }, **self.headers).status_code, 400)
+
+
+class ConnectionPoolTests(SimpleTestCase):
+    databases = {'default'}
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.settings_dict = {
+            'ENGINE': 'cafe.db.backends.sqlite3',
+            'NAME': os.path.join(directory.name, 'pool.sqlite3'),
+            'POOL': { 'MAX_SIZE': 1, 'MAX_IDLE': 1, 'MAX_AGE': 600, 'TIMEOUT': 0.1 },
+        }
+        self.database = self.connect()
+        self.addCleanup(close_pools)
+
+    def connect(self):
+        database = ConnectionHandler({ 'default': self.settings_dict })['default']
+        database.ensure_connection()
+        return database
+
+    def test_connection_is_reused_after_close(self):
+        raw, pool = self.database.connection, self.database._pool_checkout[0]
+        self.database.close()
+        self.database.ensure_connection()
+
+        self.assertIs(self.database.connection, raw)
+        self.assertEqual(pool.stats()['created'], 1)
+        self.assertEqual(pool.stats()['reused'], 1)
+        self.database.close()
+
+    def test_stats_are_exported_as_metrics(self):
+        text = render(collect())
+        self.assertIn('cafe_db_pool_connections{alias="default",state="in_use"} 1', text)
+        self.assertIn('cafe_db_pool_max_size{alias="default"} 1', text)
+        self.assertRegex(text, r'cafe_db_pool_events_total\{alias="default",event="created"\} [1-9]')
+        self.database.close()
+
+    def test_broken_and_expired_connections_are_replaced(self):
+        pool = self.database._pool_checkout[0]
+        self.database.connection.close()
+        self.database.close()
+        self.database.ensure_connection()
+        self.assertEqual(pool.stats()['failed_ping'], 1)
+
+        pool.max_age = 0
+        self.database.close()
+        self.database.ensure_connection()
+        self.assertEqual(pool.stats()['created'], 3)
+        self.assertEqual(pool.stats()['reused'], 0)
+        self.database.close()
+
+    def test_exhausted_pool_times_out(self):
+        pool = self.database._pool_checkout[0]
+        errors = []
+
+        def checkout():
+            try:
+                self.connect()
+            except OperationalError as error:
+                errors.append(error)
+
+        thread = threading.Thread(target = checkout)
+        thread.start()
+        thread.join()
+        self.database.close()
+
+        self.assertEqual(len(errors), 1)
+        self.assertEqual(pool.stats()['timeouts'], 1)
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class BenchmarkTests(TestCase):
+    def setUp(self):
+        # прогон проверяет ответы эндпоинтов, а не лимит запросов
+        throttle = mock.patch.object(request_throttle, 'enabled', False)
+        throttle.start()
+        self.addCleanup(throttle.stop)
+
+    def test_mix_runs_against_seeded_data(self):
+        data = seed(tables = 5, categories = 3, menu = 20, orders = 50, batch_size = 20)
+        # даты заказов разнесены по дням, а auto_now_add у модели не тронут
+        self.assertLess(Order.objects.earliest('created_at').created_at, timezone.now() - timedelta(days = 1))
+        self.assertTrue(Order._meta.get_field('created_at').auto_now_add)
+        report = run_client(plan(data, 150), warmup = 10)
+
+        endpoints = report['endpoints']
+        self.assertEqual(endpoints['total']['requests'], 140)
+        self.assertEqual(endpoints['total']['errors'], 0)
+        self.assertTrue(set(endpoints) <= {name for name, weight, build in MIX} | {'total'})
+        for name, row in endpoints.items():
+            self.assertEqual(row['statuses'], { '200': row['requests'] }, name)
+        self.assertLessEqual(endpoints['total']['latency_ms']['p50'], endpoints['total']['latency_ms']['p99'])
+
+        report = run_client(plan(data, 60, mix = async_mix()), warmup = 10)
+        for name, row in report['endpoints'].items():
+            self.assertEqual(row['statuses'], { '200': row['requests'] }, name)
+
+
+class MetricsEndpointTests(TestCase):
+    def test_requires_token_or_debug(self):
+        self.assertEqual(self.client.get('/api/metrics').status_code, 401)
+        with override_settings(DEBUG = True):
+            self.assertEqual(self.client.get('/api/metrics').status_code, 200)
+        with override_settings(CAFE_METRICS = { 'ENABLED': True, 'TOKEN': 'scrape' }):
+            self.assertEqual(self.client.get('/api/metrics').status_code, 401)
+            self.assertEqual(self.client.get('/api/metrics', HTTP_AUTHORIZATION = 'Bearer scrape').status_code, 200)
+
+
+class MetricsRegistryTests(SimpleTestCase):
+    def test_threads_are_summed_and_rendered(self):
+        registry = MetricsRegistry(buckets = (0.1, 1))
+
+        def work():
+            for _ in range(100):
+                registry.inc('cafe_http_requests_total', route = 'api/menu', status = '200')
+                registry.observe('cafe_http_request_duration_seconds', 0.5, route = 'api/menu')
+
+        threads = [threading.Thread(target = work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        text = render(registry.snapshot(), registry.buckets)
+
+        self.assertIn('cafe_http_requests_total{route="api/menu",status="200"} 400', text)
+        self.assertIn('cafe_http_request_duration_seconds_bucket{route="api/menu",le="0.1"} 0', text)
+        self.assertIn('cafe_http_request_duration_seconds_bucket{route="api/menu",le="1"} 400', text)
+        self.assertIn('cafe_http_request_duration_seconds_bucket{route="api/menu",le="+Inf"} 400', text)
+        self.assertIn('cafe_http_request_duration_seconds_count{route="api/menu"} 400', text)
+
+    def test_dead_worker_snapshots_are_folded(self):
+        dead = subprocess.Popen([sys.executable, '-c', 'pass'])
+        dead.wait()
+        key = ('cafe_test_total', ())
+
+        def snapshot(directory, name, pid, written, value):
+            with open(os.path.join(directory, f'cafe-metrics-{name}.json'), 'w', encoding = 'utf-8') as file:
+                json.dump({ 'pid': pid, 'written': written, 'counters': [['cafe_test_total', [], value]],
+                            'gauges': [['cafe_test_in_flight', [], 1]], 'histograms': [] }, file)
+
+        with tempfile.TemporaryDirectory() as directory, override_settings(CAFE_METRICS = { 'ENABLED': True, 'MULTIPROCESS_DIR': directory }):
+            snapshot(directory, f'{dead.pid}-1', dead.pid, 1, 5)
+            # pid завершившегося воркера занят этим процессом: старый снимок - тоже итог
+            snapshot(directory, f'{os.getpid()}-1', os.getpid(), 1, 3)
+
+            for _ in range(2):
+                metrics = collect()
+                self.assertEqual(metrics['counters'][key], 8)
+                self.assertNotIn(('cafe_test_in_flight', ()), metrics['gauges'])
+            self.assertEqual(sorted(name for name in os.listdir(directory) if name.endswith('.json')),
+                             sorted([RETIRED, f'cafe-metrics-{process_name()}.json']))
+
+
+class IdempotencyStoreTests(SimpleTestCase):
+    def test_duplicate_waits_for_first_request(self):
+        store = LocMemStore(max_size = 10, ttl = 60)
+        self.assertTrue(store.claim('key'))
+        self.assertFalse(store.claim('key'))
+        results = []
+
+        def duplicate():
+            results.append((store.wait('key', 5), store.result('key')))
+
+        thread = threading.Thread(target = duplicate)
+        thread.start()
+        store.complete('key', ('fingerprint', 200, b'{}'))
+        thread.join()
+
+        self.assertEqual(results, [(True, ('fingerprint', 200, b'{}'))])
+        self.assertFalse(store.claim('key'))
+
+    def test_failed_request_releases_key(self):
+        store = LocMemStore(max_size = 10, ttl = 60)
+        store.claim('key')
+        store.release('key')
+
+        self.assertIsNone(store.result('key'))
+        self.assertTrue(store.claim('key'))
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class IdempotentEndpointTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_superuser('manager', password = 'secret')
+        self.headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'manager:secret').decode() }
+        self.table = Table.objects.create(number = 1, status = TableStatus.objects.create(name = 'Свободен'))
+        self.status = OrderStatus.objects.create(name = 'Новый')
+        self.order = self.create_order()
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    def create_order(self):
+        reservation = Reservation.objects.create(table = self.table, client_name = 'Гость', client_phone = '+70000000000',
+                                                 datetime = timezone.now(), quest_count = 2, comment = '')
+        return Order.objects.create(table = self.table, reservation = reservation, status = self.status)
+
+    def post(self, body: str, key: str):
+        return self.client.post('/api/payments', body, content_type = 'application/json', HTTP_IDEMPOTENCY_KEY = key, **self.headers)
+
+    def test_replay_and_conflicting_body(self):
+        body = json.dumps({ 'order': self.order.id })
+        first = self.post(body, 'pay-1')
+        replayed = self.post(body, 'pay-1')
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(replayed.status_code, 200)
+        self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+        self.assertEqual(replayed.content, first.content)
+        self.assertEqual(Payment.objects.count(), 1)
+
+        other = self.create_order()
+        self.assertEqual(self.post(json.dumps({ 'order': other.id }), 'pay-1').status_code, 422)
+        self.assertEqual(Payment.objects.count(), 1)
+
+    def test_duplicate_waits_for_request_in_flight(self):
+        body = json.dumps({ 'order': self.order.id })
+        store = LocMemStore(max_size = 10, ttl = 60)
+        scope = _scope(SimpleNamespace(auth = self.user, method = 'POST', path = '/api/payments'), 'pay-2')
+        stored = (hashlib.sha256(body.encode()).hexdigest(), 200, b'{"stored": true}')
+
+        # первый запрос ещё выполняется и завершается, пока дубликат ждёт
+        self.assertTrue(store.claim(scope))
+        finisher = threading.Timer(0.2, store.complete, (scope, stored))
+        with mock.patch('cafe.idempotency.idempotency_store', store):
+            finisher.start()
+            response = self.post(body, 'pay-2')
+        finisher.join()
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Idempotent-Replayed'], 'true')
+        self.assertEqual(response.json(), { 'stored': True })
+        self.assertFalse(Payment.objects.exists())
+
+    def test_async_write_endpoint_replays(self):
+        menu = Menu.objects.create(category = Category.objects.create(name = 'Супы', slug = 'soups'), name = 'Борщ',
+                                   slug = 'borsch', price = Decimal('150.00'))
+        body = json.dumps({ 'order': self.order.id, 'menu': menu.id, 'price': 150, 'quantity': 2 })
+        first = self.client.post('/api/async/order/add_item', body, content_type = 'application/json',
+                                 HTTP_IDEMPOTENCY_KEY = 'item-1', **self.headers)
+        replayed = self.client.post('/api/async/order/add_item', body, content_type = 'application/json',
+                                    HTTP_IDEMPOTENCY_KEY = 'item-1', **self.headers)
+
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(replayed['Idempotent-Replayed'], 'true')
+        self.assertEqual(replayed.content, first.content)
+        self.assertEqual(OrderItem.objects.get(order = self.order).quantity, 2)
+
+
+class TokenBucketTests(SimpleTestCase):
+    def test_burst_then_refill(self):
+        buckets = LocMemBuckets(max_keys = 10)
+        interval, burst = 0.5, 3
+
+        self.assertEqual([buckets.take('user:1', interval, burst, 100.0) for _ in range(3)], [0, 0, 0])
+        self.assertAlmostEqual(buckets.take('user:1', interval, burst, 100.0), 0.5)
+        self.assertEqual(buckets.take('user:2', interval, burst, 100.0), 0)
+        self.assertEqual(buckets.take('user:1', interval, burst, 100.5), 0)
+        self.assertGreater(buckets.take('user:1', interval, burst, 100.5), 0)
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ThrottleEndpointTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_user('waiter', password = 'secret')
+        Category.objects.create(name = 'Супы', slug = 'soups')
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    def get(self, path: str, password: str):
+        return self.client.get(path, HTTP_AUTHORIZATION = 'Basic ' + base64.b64encode(f'waiter:{password}'.encode()).decode())
+
+    def test_failed_logins_are_limited_before_auth(self):
+        interval, burst = request_throttle.login
+        self.assertEqual(self.get('/api/menu', 'secret').status_code, 200)
+        self.assertEqual([self.get('/api/menu', 'wrong').status_code for _ in range(burst)], [401] * burst)
+
+        # корзина пуста: отказ до проверки пароля, в том числе для верного
+        for path in ('/api/menu', '/api/async/menu'):
+            response = self.get(path, 'secret')
+            self.assertEqual(response.status_code, 429, path)
+            self.assertGreaterEqual(int(response['Retry-After']), 1)
+
+    def test_route_budget_answers_retry_after(self):
+        with mock.patch.dict(request_throttle.routes, { 'api/menu': (60, 2) }):
+            statuses = [self.get('/api/menu', 'secret').status_code for _ in range(3)]
+            response = self.get('/api/menu', 'secret')
+
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '60')
+
+    @override_settings(CACHES = { 'default': { 'BACKEND': 'django.core.cache.backends.locmem.LocMemCache', 'LOCATION': 'throttle-tests' } })
+    async def test_async_router_reads_shared_buckets_off_the_loop(self):
+        buckets = DjangoCacheBuckets()
+        on_loop = []
+        take = buckets.take
+
+        def recording_take(*args):
+            try:
+                asyncio.get_running_loop()
+                on_loop.append(True)
+            except RuntimeError:
+                on_loop.append(False)
+            return take(*args)
+
+        authorization = 'Basic ' + base64.b64encode(b'waiter:secret').decode()
+        with mock.patch.object(request_throttle, 'buckets', buckets), mock.patch.object(buckets, 'take', recording_take), \
+                mock.patch.dict(request_throttle.routes, { 'api/async/menu': (60, 2) }):
+            statuses = [(await self.async_client.get('/api/async/menu', AUTHORIZATION = authorization)).status_code for _ in range(3)]
+            response = await self.async_client.get('/api/async/menu', AUTHORIZATION = authorization)
+
+        # ninja не проверяет тот же бюджет второй раз: ровно BURST запросов проходят
+        self.assertEqual(statuses, [200, 200, 429])
+        self.assertEqual(response['Retry-After'], '60')
+        self.assertEqual(on_loop, [False] * 4)
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class MenuImportTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_superuser('manager', password = 'secret')
+        self.headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'manager:secret').decode() }
+        self.category = Category.objects.create(name = 'Супы', slug = 'soups')
+        self.menu = Menu.objects.create(category = self.category, name = 'Борщ', slug = 'borsch', price = Decimal('150.00'),
+                                        weight = Decimal('300.00'), capacity = Decimal('0.00'), description = 'Со сметаной')
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    def upload(self, name: str, content: bytes, **params):
+        query = '?dry_run=true' if params.get('dry_run') else ''
+        return self.client.post(f'/api/menu/import{query}', { 'file': SimpleUploadedFile(name, content) }, **self.headers)
+
+    def test_endpoint_creates_rows_that_menu_can_serve(self):
+        content = 'slug;category;category_name;name;price\nborsch;;;;175\nsolyanka;soups;;Солянка;200\nmors;drinks;Напитки;Морс;90\n'
+        response = self.upload('menu.csv', content.encode())
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual((response.json()['created'], response.json()['updated'], response.json()['categories']), (2, 1, 1))
+        self.menu.refresh_from_db()
+        self.assertEqual((self.menu.price, self.menu.name, self.menu.weight), (Decimal('175.00'), 'Борщ', Decimal('300.00')))
+
+        # новые позиции без веса, объёма и описания отдаются меню
+        response = self.client.get(f'/api/menu/{self.category.id}', **self.headers)
+        self.assertEqual(response.status_code, 200)
+        rows = { row['slug']: row for row in response.json() }
+        self.assertEqual((rows['solyanka']['weight'], rows['solyanka']['description']), (None, None))
+        self.assertEqual(Menu.objects.get(slug = 'mors').category.slug, 'drinks')
+
+    def test_endpoint_rejects_whole_file_on_row_errors(self):
+        content = json.dumps([{ 'slug': 'borsch', 'price': 10 }, { 'slug': 'okroshka', 'name': 'Окрошка' }, { 'slug': 'bad slug' }])
+        response = self.upload('menu.json', content.encode())
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual([error['row'] for error in response.json()['errors']], [2, 3])
+        self.assertEqual(Menu.objects.get(slug = 'borsch').price, Decimal('150.00'))
+        self.assertFalse(Menu.objects.filter(slug = 'okroshka').exists())
+        self.assertEqual(self.upload('menu.xml', b'<menu/>').status_code, 400)
+
+    def test_command_imports_and_dry_runs(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'prices.json')
+            with open(path, 'w', encoding = 'utf-8') as file:
+                json.dump({ 'rows': [{ 'slug': 'borsch', 'price': '180.50' }] }, file)
+
+            out = io.StringIO()
+            call_command('import_menu', path, '--dry-run', stdout = out)
+            self.assertIn('Проверка', out.getvalue())
+            self.assertEqual(Menu.objects.get(slug = 'borsch').price, Decimal('150.00'))
+
+            call_command('import_menu', path, stdout = io.StringIO())
+            self.assertEqual(Menu.objects.get(slug = 'borsch').price, Decimal('180.50'))
+
+            with open(path, 'w', encoding = 'utf-8') as file:
+                json.dump([{ 'slug': 'new-dish' }], file)
+            with self.assertRaises(CommandError):
+                call_command('import_menu', path, stdout = io.StringIO(), stderr = io.StringIO())
+        self.assertFalse(Menu.objects.filter(slug = 'new-dish').exists())
+
+
+class PermissionIndexTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('cook', password = 'secret')
+        self.group = Group.objects.create(name = 'Кухня')
+        self.group.permissions.add(*Permission.objects.filter(content_type__app_label = 'cafe', codename__in = ('view_order', 'change_orderitem')))
+        self.user.groups.add(self.group)
+        self.required = frozenset(('cafe.view_order', 'cafe.change_orderitem'))
+
+    def test_group_change_reaches_other_workers(self):
+        workers = (PermissionIndex(), PermissionIndex())
+        self.assertTrue(all(worker.has_perms(self.user, self.required) for worker in workers))
+        with self.assertNumQueries(1):
+            self.assertTrue(workers[1].has_perms(self.user, self.required))
+
+        # право снято в админке через один воркер, второй видит новое поколение в базе
+        self.group.permissions.remove(Permission.objects.get(codename = 'view_order'))
+        self.assertFalse(workers[1].has_perms(self.user, self.required))
+        self.assertTrue(workers[1].has_perms(self.user, { 'cafe.change_orderitem' }))
+
+    def test_inactive_and_superusers_skip_lookup(self):
+        index = PermissionIndex()
+        admin = get_user_model().objects.create_superuser('admin', password = 'secret')
+        self.user.is_active = False
+        with self.assertNumQueries(0):
+            self.assertTrue(index.has_perms(admin, self.required))
+            self.assertFalse(index.has_perms(self.user, self.required))
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class CheckPermissionTests(TestCase):
+    def setUp(self):
+        self.user = get_user_model().objects.create_user('manager', password = 'secret')
+        self.headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'manager:secret').decode() }
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    def grant(self, *codenames):
+        self.user.user_permissions.add(*Permission.objects.filter(content_type__app_label = 'cafe', codename__in = codenames))
+
+    def upload(self):
+        return self.client.post('/api/menu/import', { 'file': SimpleUploadedFile('menu.json', b'[]') }, **self.headers)
+
+    def test_every_permission_is_required(self):
+        self.grant('add_menu', 'change_menu', 'add_category')
+        self.assertEqual(self.upload().status_code, 403)
+
+        self.grant('change_category')
+        self.assertEqual(self.upload().status_code, 200)
+
+        self.user.user_permissions.clear()
+        self.assertEqual(self.upload().status_code, 403)
+
+
+@override_settings(PASSWORD_HASHERS = ['django.contrib.auth.hashers.MD5PasswordHasher'])
+class ImageUploadTests(TestCase):
+    def setUp(self):
+        get_user_model().objects.create_superuser('manager', password = 'secret')
+        self.headers = { 'HTTP_AUTHORIZATION': 'Basic ' + base64.b64encode(b'manager:secret').decode() }
+        self.category = Category.objects.create(name = 'Супы', slug = 'soups')
+        media = tempfile.TemporaryDirectory()
+        self.addCleanup(media.cleanup)
+        self.media = media.name
+        media_root = override_settings(MEDIA_ROOT = self.media)
+        media_root.enable()
+        self.addCleanup(media_root.disable)
+        buckets = mock.patch.object(request_throttle, 'buckets', LocMemBuckets())
+        buckets.start()
+        self.addCleanup(buckets.stop)
+
+    def png(self) -> bytes:
+        content = io.BytesIO()
+        Image.new('RGB', (40, 30), 'red').save(content, 'PNG')
+        return content.getvalue()
+
+    def post(self, image: bytes, **extra):
+        payload = json.dumps({ 'category': self.category.id, 'name': 'Борщ', 'slug': 'borsch', 'weight': 300,
+                               'capacity': 0, 'description': '', 'price': 150 })
+        data = { 'payload': payload, 'image': SimpleUploadedFile('borsch.png', image, 'image/png') }
+        return self.client.post('/api/menu', data, **self.headers, **extra)
+
+    def files(self) -> list:
+        return sorted(os.path.relpath(os.path.join(root, name), self.media) for root, dirs, names in os.walk(self.media) for name in names)
+
+    def test_image_is_moved_into_storage(self):
+        with mock.patch('cafe.uploads._spool') as spool:
+            response = self.post(self.png())
+
+        self.assertEqual(response.status_code, 200)
+        spool.assert_not_called()
+        menu = Menu.objects.get(slug = 'borsch')
+        self.assertEqual(self.files(), [menu.image.name])
+        self.assertEqual(os.stat(menu.image.path).st_mode & 0o777, 0o644)
+
+    @override_settings(CAFE_UPLOADS = { 'MAX_BYTES': 1024, 'MAX_FORM_BYTES': 4096 })
+    def test_oversized_uploads_are_rejected(self):
+        image = self.png() + b'\0' * 2048
+        self.assertEqual(self.post(image).status_code, 413)
+        self.assertEqual(self.files(), [])
+
+        # тело больше предела отклоняется по Content-Length, не читаясь
+        with mock.patch('cafe.middleware.ImageUploadHandler') as handler:
+            response = self.post(image + b'\0' * 8192)
+        self.assertEqual(response.status_code, 413)
+        handler.assert_not_called()
+        self.assertFalse(Menu.objects.exists())
@@ -0,0 +1,179 @@
+import threading
+import time
+from collections import OrderedDict
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from ninja.errors import Throttled
+from ninja.throttling import BaseThrottle
+
+from .metrics import registry
+
+
+''' Ограничение частоты запросов по пользователю или IP (token bucket) '''
+
+
+PERIODS = { 's': 1, 'sec': 1, 'm': 60, 'min': 60, 'h': 3600, 'hour': 3600 }
+
+
+def parse_budget(budget: dict) -> tuple:
+    ''' {'RATE': '300/m', 'BURST': 30} -> (секунд на один токен, ёмкость корзины) '''
+    count, period = budget['RATE'].split('/', 1)
+    interval = PERIODS[period] / int(count)
+    return interval, budget.get('BURST', int(count))
+
+
+def throttle_config() -> dict:
+    config = getattr(settings, 'CAFE_THROTTLE', {})
+    return {
+        'ENABLED': config.get('ENABLED', False),
+        'BACKEND': config.get('BACKEND', 'locmem'),
+        'ALIAS': config.get('ALIAS', 'default'),
+        'MAX_KEYS': config.get('MAX_KEYS', 100000),
+        'DEFAULT': config.get('DEFAULT', { 'RATE': '20/s', 'BURST': 40 }),
+        'ROUTES': config.get('ROUTES', {}),
+        'LOGIN': config.get('LOGIN', { 'RATE': '10/m', 'BURST': 5 }),
+    }
+
+
+class LocMemBuckets:
+    ''' Корзины в памяти процесса. Состояние корзины - одно число (GCRA): время,
+    к которому корзина снова будет полной; LRU ограничивает число ключей '''
+
+    def __init__(self, max_keys: int = 100000):
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+
+    def take(self, key: str, interval: float, burst: int, now: float) -> float:
+        ''' Берёт токен; возвращает 0 или сколько секунд ждать следующего токена '''
+        with self._lock:
+            full_at = max(self._buckets.get(key, now), now) + interval
+            wait = full_at - burst * interval - now
+            if wait > 0:
+                return wait
+            self._buckets[key] = full_at
+            self._buckets.move_to_end(key)
+            if len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last = False)
+        return 0
+
+    def wait(self, key: str, interval: float, burst: int, now: float) -> float:
+        ''' Как take, но токен не забирается '''
+        with self._lock:
+            full_at = max(self._buckets.get(key, now), now) + interval
+        return max(full_at - burst * interval - now, 0)
+
+
+class DjangoCacheBuckets:
+    ''' Корзины в кэше Django, общие для воркеров.
+
+    Чтение и запись не атомарны, поэтому при гонке воркеров за один ключ
+    корзина может пропустить лишний запрос; сверх лимита это не накапливается.
+    '''
+
+    def __init__(self, alias: str = 'default', prefix: str = 'cafe:throttle'):
+        from django.core.cache import caches
+        self._cache = caches[alias]
+        self.prefix = prefix
+
+    def take(self, key: str, interval: float, burst: int, now: float) -> float:
+        key = f'{self.prefix}:{key}'
+        full_at = max(self._cache.get(key, now), now) + interval
+        wait = full_at - burst * interval - now
+        if wait > 0:
+            return wait
+        self._cache.set(key, full_at, max(1, int(full_at - now) + 1))
+        return 0
+
+    def wait(self, key: str, interval: float, burst: int, now: float) -> float:
+        full_at = max(self._cache.get(f'{self.prefix}:{key}', now), now) + interval
+        return max(full_at - burst * interval - now, 0)
+
+
+class TokenBucketThrottle(BaseThrottle):
+    ''' Throttle django-ninja: корзина на пару (бюджет, пользователь или IP).
+
+    Бюджет выбирается по шаблону маршрута из ROUTES (например 'api/menu'),
+    остальные маршруты делят корзину DEFAULT. Пользователь берётся из
+    request.auth, без авторизации - IP клиента (с учётом NINJA_NUM_PROXIES).
+    Неудачные входы считаются в корзине LOGIN на IP.
+    '''
+
+    timer = time.time
+
+    def __init__(self, config: dict = None):
+        config = config or throttle_config()
+        self.enabled = config['ENABLED']
+        self.default = parse_budget(config['DEFAULT'])
+        self.routes = { route: parse_budget(budget) for route, budget in config['ROUTES'].items() }
+        self.login = parse_budget(config['LOGIN'])
+        if config['BACKEND'] == 'django':
+            self.buckets = DjangoCacheBuckets(alias = config['ALIAS'])
+        else:
+            self.buckets = LocMemBuckets(max_keys = config['MAX_KEYS'])
+        # экземпляр общий для потоков, а ninja спрашивает wait() после allow_request()
+        self._local = threading.local()
+
+    def take(self, request, user) -> float:
+        ''' Берёт токен из корзины маршрута; 0 или сколько секунд ждать '''
+        match = getattr(request, 'resolver_match', None)
+        route = match.route if match is not None else None
+        budget = self.routes.get(route)
+        scope = route if budget is not None else 'default'
+        user_id = getattr(user, 'pk', None) if user else None
+        ident = f'user:{user_id}' if user_id is not None else f'ip:{self.get_ident(request)}'
+
+        interval, burst = budget or self.default
+        wait = self.buckets.take(f'{scope}:{ident}', interval, burst, self.timer())
+        if wait:
+            registry.inc('cafe_throttled_total', scope = scope)
+        return wait
+
+    def allow_request(self, request) -> bool:
+        if not self.enabled:
+            return True
+        wait = self.take(request, getattr(request, 'auth', None))
+        self._local.wait = wait
+        return not wait
+
+    async def acheck_request(self, request, user):
+        ''' Проверка для async-роутера после входа.
+
+        ninja вызывает allow_request синхронно прямо в цикле событий, поэтому
+        async-роутер отключает throttle-ы ninja и проверяет корзину здесь:
+        корзина в кэше Django читается через sync_to_async, в памяти - на месте.
+        '''
+        if not self.enabled:
+            return
+        if isinstance(self.buckets, LocMemBuckets):
+            wait = self.take(request, user)
+        else:
+            wait = await sync_to_async(self.take)(request, user)
+        if wait:
+            raise Throttled(wait)
+
+    def wait(self):
+        return getattr(self._local, 'wait', None) or None
+
+    def check_login(self, request):
+        ''' Вызывается до проверки пароля: throttle-ы ninja работают после авторизации
+        и неудачные входы не видят, поэтому у них отдельная корзина на IP '''
+        if not self.enabled:
+            return
+        wait = self.buckets.wait(f'login:ip:{self.get_ident(request)}', *self.login, self.timer())
+        if wait:
+            registry.inc('cafe_throttled_total', scope = 'login')
+            raise Throttled(wait)
+
+    def login_failed(self, request):
+        if self.enabled:
+            self.buckets.take(f'login:ip:{self.get_ident(request)}', *self.login, self.timer())
+
+
+request_throttle = TokenBucketThrottle()
+
+
+def api_throttle() -> list:
+    ''' Throttle-ы для NinjaAPI: при выключенном ограничении список пуст и проверок нет вовсе '''
+    return [request_throttle] if request_throttle.enabled else []
@@ -0,0 +1,195 @@
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files import File
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+from PIL import Image, UnidentifiedImageError
+
+
+''' Потоковая загрузка изображений позиций меню '''
+
+
+class ImageRejected(Exception):
+    def __init__(self, message: str, status: int = 400):
+        super().__init__(message)
+        self.status = status
+
+
+def _limits():
+    config = getattr(settings, 'CAFE_UPLOADS', {})
+    return {
+        'MAX_BYTES': config.get('MAX_BYTES', 5 * 1024 * 1024),
+        'MAX_PIXELS': config.get('MAX_PIXELS', 24_000_000),
+        'MAX_DIMENSION': config.get('MAX_DIMENSION', 8000),
+        'CHUNK_SIZE': config.get('CHUNK_SIZE', 64 * 1024),
+        'FORMATS': config.get('FORMATS', ('JPEG', 'PNG', 'WEBP')),
+        'MAX_FORM_BYTES': config.get('MAX_FORM_BYTES', 64 * 1024),
+    }
+
+
+# маршруты, на которых изображение принимает ImageUploadHandler (POST)
+IMAGE_ROUTES = ('api/menu', )
+
+
+def max_request_bytes() -> int:
+    ''' Предельный размер тела запроса с изображением: файл и остальные поля формы '''
+    limits = _limits()
+    return limits['MAX_BYTES'] + limits['MAX_FORM_BYTES']
+
+
+def _storage_directory(storage, name: str = ''):
+    try:
+        return os.path.dirname(storage.path(name)) if name else storage.path('')
+    except NotImplementedError:
+        return None
+
+
+class SpooledImage(UploadedFile):
+    ''' Файл запроса, записанный сразу во временный файл в каталоге хранилища.
+
+    store_image переносит его на место через os.replace без повторного
+    копирования; если файл остался на месте, он удаляется при закрытии запроса.
+    '''
+
+    def __init__(self, directory, name, content_type, charset, content_type_extra = None):
+        if directory:
+            os.makedirs(directory, exist_ok = True)
+        descriptor, self.path = tempfile.mkstemp(dir = directory, suffix = '.upload')
+        super().__init__(os.fdopen(descriptor, 'w+b'), name, content_type, 0, charset, content_type_extra)
+
+    def temporary_file_path(self):
+        return self.path
+
+    def close(self):
+        try:
+            return self.file.close()
+        finally:
+            try:
+                os.unlink(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class ImageUploadHandler(FileUploadHandler):
+    ''' Обработчик загрузки для IMAGE_ROUTES: пишет файл во временный файл хранилища
+    и перестаёт записывать, как только он превысил MAX_BYTES. Размер продолжает
+    считаться, и store_image отвечает 413; тело запроса ограничено заранее
+    по Content-Length (max_request_bytes) '''
+
+    def __init__(self, request = None):
+        super().__init__(request)
+        self.limits = _limits()
+        self.chunk_size = self.limits['CHUNK_SIZE']
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file = SpooledImage(_storage_directory(default_storage), self.file_name, self.content_type,
+                                 self.charset, self.content_type_extra)
+
+    def receive_data_chunk(self, raw_data, start):
+        if start + len(raw_data) <= self.limits['MAX_BYTES']:
+            self.file.write(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        self.file.size = file_size
+        return self.file
+
+    def upload_interrupted(self):
+        if hasattr(self, 'file'):
+            self.file.close()
+
+
+def _validate(path: str, limits: dict):
+    ''' Проверяет заголовок изображения без декодирования пикселей '''
+    try:
+        with Image.open(path) as image:
+            format, (width, height) = image.format, image.size
+    except (UnidentifiedImageError, Image.DecompressionBombError, OSError):
+        raise ImageRejected('Файл не является изображением!')
+    if format not in limits['FORMATS']:
+        raise ImageRejected('Неподдерживаемый формат изображения!')
+    if max(width, height) > limits['MAX_DIMENSION'] or width * height > limits['MAX_PIXELS']:
+        raise ImageRejected('Слишком большое разрешение изображения!', status = 413)
+
+
+def _reserve(storage, name: str):
+    ''' Резервирует свободное имя в хранилище, создавая пустой файл эксклюзивно '''
+    while True:
+        name = storage.get_available_name(name)
+        path = storage.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+        try:
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644))
+        except FileExistsError:
+            continue
+        return name, path
+
+
+def _spool(uploaded, directory, limits: dict) -> str:
+    ''' Копирует загруженный файл кусками во временный файл каталога хранилища '''
+    descriptor, temp_path = tempfile.mkstemp(dir = directory, suffix = '.upload')
+    try:
+        written = 0
+        with os.fdopen(descriptor, 'wb') as target:
+            for chunk in uploaded.chunks(limits['CHUNK_SIZE']):
+                written += len(chunk)
+                if written > limits['MAX_BYTES']:
+                    raise ImageRejected('Файл слишком большой!', status = 413)
+                target.write(chunk)
+    except BaseException:
+        os.unlink(temp_path)
+        raise
+    return temp_path
+
+
+def store_image(uploaded, field_file):
+    ''' Записывает загруженный файл кусками во временный файл (если его уже не записал
+    ImageUploadHandler), проверяет лимиты и атомарно переносит его в хранилище
+    поля, после чего сохраняет объект.
+    Если объект сохранить не удалось, файл удаляется из хранилища.
+    '''
+    limits = _limits()
+    if uploaded.size is not None and uploaded.size > limits['MAX_BYTES']:
+        raise ImageRejected('Файл слишком большой!', status = 413)
+
+    storage = field_file.storage
+    name = field_file.field.generate_filename(field_file.instance, uploaded.name)
+    directory = _storage_directory(storage, name)
+    if directory:
+        os.makedirs(directory, exist_ok = True)
+
+    if isinstance(uploaded, SpooledImage) and directory:
+        # ImageUploadHandler уже записал файл в каталог хранилища
+        uploaded.file.flush()
+        temp_path = uploaded.temporary_file_path()
+    else:
+        temp_path = _spool(uploaded, directory, limits)
+    try:
+        _validate(temp_path, limits)
+
+        if directory:
+            # mkstemp создаёт файл с правами 0600, а медиа должен читать и веб-сервер
+            os.chmod(temp_path, getattr(storage, 'file_permissions_mode', None) or 0o644)
+            name, path = _reserve(storage, name)
+            os.replace(temp_path, path)
+        else:
+            with open(temp_path, 'rb') as source:
+                name = storage.save(name, File(source), max_length = field_file.field.max_length)
+            os.unlink(temp_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+        raise
+
+    field_file.name = name
+    setattr(field_file.instance, field_file.field.attname, name)
+    field_file._committed = True
+    try:
+        field_file.instance.save()
+    except BaseException:
+        storage.delete(name)
+        raise